@@ -0,0 +1,123 @@
+from typing import Optional
+from fastapi import APIRouter
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+from rag.embedding_cache import embedding_cache
+from services.app_state import ServiceNotReady, app_state
+from services.memory_service import memory_service
+from utils.metrics import REGISTRY
+from utils.profiler import loop_monitor, request_profiler
+
+router = APIRouter()
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Métricas del proceso en formato texto de Prometheus"""
+    return PlainTextResponse(
+        content=REGISTRY.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+@router.get("/admin/profiling")
+async def profiling_status():
+    """Estado del perfilado y perfiles guardados de peticiones lentas"""
+    return JSONResponse(content={
+        "status": "success",
+        "profiling": request_profiler.status(),
+        "profiles": request_profiler.list_profiles()
+    })
+
+@router.post("/admin/profiling")
+async def configure_profiling(enabled: Optional[bool] = None, threshold_ms: Optional[float] = None):
+    """Activa o desactiva el perfilado y ajusta el umbral de latencia"""
+    if threshold_ms is not None and threshold_ms < 0:
+        return JSONResponse(
+            status_code=400,
+            content={"status": "error", "message": "threshold_ms debe ser positivo"}
+        )
+    request_profiler.configure(enabled=enabled, threshold_ms=threshold_ms)
+    return JSONResponse(content={"status": "success", "profiling": request_profiler.status()})
+
+@router.get("/admin/profiles/{request_id}")
+async def download_profile(request_id: str, format: str = "prof", limit: int = 30):
+    """Descarga el perfil (.prof para snakeviz/pstats) o un resumen en texto con format=text"""
+    path = request_profiler.path_for(request_id)
+    if path is None:
+        return JSONResponse(
+            status_code=404,
+            content={"status": "error", "message": f"No hay perfil para la petición {request_id}"}
+        )
+    if format == "text":
+        return PlainTextResponse(request_profiler.summary(request_id, limit=limit))
+    return FileResponse(path, media_type="application/octet-stream", filename=f"{request_id}.prof")
+
+@router.get("/admin/event-loop")
+async def event_loop_status():
+    """Bloqueos del event loop detectados con la pila de la llamada bloqueante"""
+    return JSONResponse(content={
+        "status": "success",
+        "running": loop_monitor.running,
+        "threshold_ms": loop_monitor.threshold * 1000,
+        "incidents": loop_monitor.incidents()
+    })
+
+@router.get("/admin/memory")
+async def memory_status():
+    """Memoria del proceso, DataFrames registrados y vectores por colección"""
+    return JSONResponse(content={"status": "success", "memory": memory_service.report()})
+
+@router.get("/admin/embedding-cache")
+async def embedding_cache_status():
+    """Tamaño y tasa de aciertos de la caché persistente de embeddings"""
+    return JSONResponse(content={"status": "success", "embedding_cache": embedding_cache.stats()})
+
+@router.delete("/admin/embedding-cache")
+async def clear_embedding_cache():
+    """Vacía la caché de embeddings (p. ej. tras cambiar el modelo en disco sin cambiar su nombre)"""
+    if not embedding_cache.enabled:
+        return JSONResponse(
+            status_code=400,
+            content={"status": "error", "message": "La caché de embeddings está desactivada"}
+        )
+    embedding_cache.clear()
+    return JSONResponse(content={"status": "success", "embedding_cache": embedding_cache.stats()})
+
+@router.get("/admin/datasets")
+async def list_datasets(tenant: Optional[str] = None):
+    """Datasets indexados (uno por colección), el activo de cada inquilino y los abiertos en este proceso"""
+    try:
+        datasets = app_state.get("rag_retriever").datasets
+    except ServiceNotReady as e:
+        return JSONResponse(status_code=503, content={"status": "error", "message": str(e)})
+    items = datasets.list(tenant)
+    return JSONResponse(content={"status": "success", "version": datasets.version, "datasets": items})
+
+@router.get("/admin/datasets/{tenant}/{dataset_id}/rows")
+async def dataset_rows(tenant: str, dataset_id: str, ids: str):
+    """Filas exactas de un dataset por los IDs de sus documentos en ChromaDB (separados por comas)"""
+    try:
+        rag_retriever = app_state.get("rag_retriever")
+    except ServiceNotReady as e:
+        return JSONResponse(status_code=503, content={"status": "error", "message": str(e)})
+    if not rag_retriever.tables.exists(tenant, dataset_id):
+        return JSONResponse(
+            status_code=404,
+            content={"status": "error", "message": f"El dataset {dataset_id} de {tenant} no tiene tabla columnar"}
+        )
+    indexes = [rag_retriever.processor.row_index(document_id.strip()) for document_id in ids.split(",")]
+    rows = rag_retriever.tables.lookup(tenant, dataset_id, [index for index in indexes if index is not None])
+    return JSONResponse(content={"status": "success", "rows": jsonable_encoder(rows)})
+
+@router.delete("/admin/datasets/{tenant}/{dataset_id}")
+async def delete_dataset(tenant: str, dataset_id: str):
+    """Elimina un dataset y su colección"""
+    try:
+        datasets = app_state.get("rag_retriever").datasets
+    except ServiceNotReady as e:
+        return JSONResponse(status_code=503, content={"status": "error", "message": str(e)})
+    if not datasets.delete(tenant, dataset_id):
+        return JSONResponse(
+            status_code=404,
+            content={"status": "error", "message": f"No existe el dataset {dataset_id} de {tenant}"}
+        )
+    return JSONResponse(content={"status": "success", "dataset_id": dataset_id})
@@ -0,0 +1,19 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from services.app_state import app_state
+
+router = APIRouter()
+
+@router.get("/health/live")
+async def live():
+    """El proceso está vivo y el event loop responde"""
+    return JSONResponse(content={"status": "success", "live": True})
+
+@router.get("/health/ready")
+async def ready():
+    """Listo solo cuando todos los componentes (LLM, embeddings, índice) se han cargado"""
+    readiness = app_state.readiness()
+    return JSONResponse(
+        status_code=200 if readiness["ready"] else 503,
+        content={"status": "success" if readiness["ready"] else "error", **readiness}
+    )
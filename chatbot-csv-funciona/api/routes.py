@@ -1,18 +1,37 @@
-from fastapi import APIRouter, UploadFile, File, Form  # Añadido Form
+from fastapi import APIRouter, Body, UploadFile, File, Form  # Añadido Form
 from fastapi.responses import HTMLResponse, JSONResponse
+import asyncio
 import os
 import json  # Añadido json para process-mapped-file
 import logging
+from services.excel_template_service import template_service
 from services.file_service import FileService
-from rag.retriever import RAGRetriever
+from services.memory_service import MemoryBudgetExceeded, memory_service
+from rag.datasets import DEFAULT_TENANT
+from rag.dedup import RowDeduplicator
+from rag.granularity import DocumentGranularity
+from services.app_state import ServiceNotReady, app_state
 from config import settings  # Añadido settings que faltaba
+from utils.metrics import REQUESTS_TOTAL, new_request_id, span
+from utils.profiler import request_profiler
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
 # Servicios
 file_service = FileService()
-rag_retriever = RAGRetriever()
+
+
+def _granularity(mode: str, group_by: str) -> DocumentGranularity:
+    """Granularidad de los documentos del formulario (campos vacíos: los de la configuración)"""
+    keys = [key.strip() for key in group_by.split(",") if key.strip()] if group_by else None
+    return DocumentGranularity(mode or None, keys)
+
+
+def _dedup(mode: str, keys: str) -> RowDeduplicator:
+    """Deduplicación de filas del formulario (campos vacíos: los de la configuración)"""
+    columns = [key.strip() for key in keys.split(",") if key.strip()] if keys else None
+    return RowDeduplicator(mode or None, columns)
 
 @router.get("/", response_class=HTMLResponse)
 async def root():
@@ -21,9 +40,67 @@ async def root():
         html_content = f.read()
     return HTMLResponse(content=html_content)
 
+def _ingest_upload(file_path: str, filename: str, tenant: str, append: bool, dataset_id: str, template: str,
+                   document_granularity: DocumentGranularity, row_dedup: RowDeduplicator):
+    """Ingesta síncrona de /upload (se ejecuta en un hilo; el perfil es el de ese hilo)"""
+    with request_profiler.profile("ingest", filename=filename):
+        # Los Excel se convierten a CSV en streaming: el resto de la ingesta (también por bloques) es la de un CSV
+        if file_path.split('.')[-1].lower() in ['xlsx', 'xls']:
+            with span("upload_excel", filename=filename):
+                file_path = file_service.to_csv(file_path)
+        
+        # Decidir el modo de ingesta según el presupuesto de memoria (rechaza si no cabe)
+        plan = memory_service.plan_ingestion(file_path)
+        # Plan compilado de la plantilla (None: ingesta de facturas)
+        excel_template = None if append else template_service.resolve(template, file_path)
+        
+        # Procesar archivo
+        with span("upload_process", filename=filename, mode=plan["mode"]):
+            if excel_template is not None:
+                processed_path = file_path
+                columns, rows = excel_template.columns, None
+            elif plan["mode"] == "chunked":
+                columns, rows = file_service.inspect_file(file_path, plan["chunk_rows"])
+                processed_path = file_path
+            else:
+                df, processed_path = file_service.process_file(file_path)
+                columns, rows = list(df.columns), len(df)
+                # Liberar la copia antes de que la ingesta lea el archivo de nuevo
+                del df
+        
+        # Inicializar colección RAG
+        with span("request", kind="append" if append else "ingest", filename=filename, rows=rows):
+            if append:
+                dataset = app_state.get("rag_retriever").append_rows(
+                    processed_path, tenant=tenant, dataset_id=dataset_id or None
+                )
+            else:
+                dataset = app_state.get("rag_retriever").ingest_dataset(
+                    processed_path, tenant=tenant, plan=plan, template=excel_template,
+                    granularity=document_granularity, dedup=row_dedup
+                )
+    return processed_path, plan, excel_template, columns, rows, dataset
+
 @router.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    """Endpoint para subir archivos"""
+async def upload_file(file: UploadFile = File(...), tenant: str = Form(DEFAULT_TENANT),
+                      append: bool = Form(False), dataset_id: str = Form(""), template: str = Form(""),
+                      granularity: str = Form(""), group_by: str = Form(""),
+                      dedup: str = Form(""), dedup_keys: str = Form("")):
+    """Endpoint para subir archivos: se indexan como un dataset del inquilino sin afectar a los demás.
+    Con append=true las filas se anexan al dataset indicado (o al activo) actualizando sus estadísticas.
+    template elige la plantilla de Excel; vacío, se detecta por las columnas del archivo.
+    granularity (row, group o chunk) y group_by ("cliente,mes") deciden cuántas filas van en cada
+    documento; dedup (off, first o sum) y dedup_keys, qué filas repetidas se descartan antes.
+    Vacíos, los de la configuración (los anexos usan los del dataset)"""
+    request_id = new_request_id()
+    try:
+        document_granularity = _granularity(granularity, group_by)
+        row_dedup = _dedup(dedup, dedup_keys)
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={"status": "error", "message": str(e)}
+        )
     try:
         # Verificar extensión de archivo
         filename = file.filename
@@ -35,24 +112,52 @@ async def upload_file(file: UploadFile = File(...)):
             )
         
         # Guardar archivo
-        file_path = await file_service.save_upload_file(file)
-        
-        # Procesar archivo
-        df, processed_path = file_service.process_file(file_path)
+        with span("upload_save", filename=filename):
+            file_path = await file_service.save_upload_file(file)
         
-        # Inicializar colección RAG
-        rag_retriever.initialize_collection(processed_path)
+        # Conversión, lectura e indexación bloquean durante segundos: fuera del bucle de eventos
+        processed_path, plan, excel_template, columns, rows, dataset = await asyncio.to_thread(
+            _ingest_upload, file_path, filename, tenant, append, dataset_id, template,
+            document_granularity, row_dedup
+        )
+        REQUESTS_TOTAL.inc(kind="ingest", status="ok")
+        appended = {key: dataset[key] for key in (
+            "rows_added", "summary_documents_updated", "rollup_documents_updated"
+        )} if append else {}
         
         return JSONResponse(content={
             "status": "success",
             "message": "Archivo cargado correctamente",
+            "request_id": request_id,
             "file_path": processed_path,
-            "rows": len(df),
-            "columns": list(df.columns)
+            "dataset_id": dataset["dataset_id"],
+            "reused": dataset.get("reused", False),
+            "ingest_mode": "append" if append else plan["mode"],
+            "granularity": dataset.get("granularity", document_granularity.mode),
+            "dedup": dataset.get("dedup"),
+            "template": excel_template.name if excel_template is not None else None,
+            "rows": rows if rows is not None else dataset.get("rows"),
+            "columns": columns,
+            **appended
         })
         
+    except MemoryBudgetExceeded as e:
+        logger.warning(f"Archivo rechazado por memoria: {str(e)}")
+        REQUESTS_TOTAL.inc(kind="ingest", status="rejected")
+        return JSONResponse(
+            status_code=413,
+            content={"status": "error", "message": str(e)}
+        )
+    except ServiceNotReady as e:
+        logger.warning(f"Ingesta recibida durante el arranque: {str(e)}")
+        REQUESTS_TOTAL.inc(kind="ingest", status="not_ready")
+        return JSONResponse(
+            status_code=503,
+            content={"status": "error", "message": str(e)}
+        )
     except Exception as e:
         logger.error(f"Error cargando archivo: {str(e)}")
+        REQUESTS_TOTAL.inc(kind="ingest", status="error")
         return JSONResponse(
             status_code=500,
             content={"status": "error", "message": str(e)}
@@ -60,14 +165,15 @@ async def upload_file(file: UploadFile = File(...)):
 
 @router.post("/analyze-file")
 async def analyze_file(file: UploadFile = File(...)):
-    """Analiza el archivo y sugiere mapeos de columnas"""
+    """Analiza el archivo y sugiere mapeos de columnas (a partir de una muestra, sin cargarlo entero)"""
     try:
         # Guardar archivo temporalmente
         file_path = await file_service.save_upload_file(file)
-        df, _ = file_service.process_file(file_path)
+        with span("analyze_sniff", filename=file.filename):
+            sniffed = file_service.sniff_file(file_path)
         
         # Obtener columnas del archivo
-        columns = list(df.columns)
+        columns = sniffed["columns"]
         
         # Analizar columnas y sugerir mapeos
         suggested_mappings = {}
@@ -100,14 +206,20 @@ async def analyze_file(file: UploadFile = File(...)):
         if amount_cols:
             suggested_mappings["importe"] = amount_cols[0]
         
-        # Extraer una muestra pequeña para vista previa
-        preview_data = df.head(5).to_dict('records')
+        # Plantilla de Excel que coincide con las columnas, si hay alguna
+        excel_template = template_service.match(columns)
         
         return JSONResponse(content={
             "status": "success",
             "columns": columns,
             "suggested_mappings": suggested_mappings,
-            "preview_data": preview_data,
+            "preview_data": sniffed["preview"],
+            "column_types": sniffed["column_types"],
+            "delimiter": sniffed["delimiter"],
+            "encoding": sniffed["encoding"],
+            "header_row": sniffed["header_row"],
+            "sheets": sniffed["sheets"],
+            "suggested_template": excel_template["name"] if excel_template else None,
             "file_path": file_path
         })
     except Exception as e:
@@ -116,24 +228,51 @@ async def analyze_file(file: UploadFile = File(...)):
             content={"status": "error", "message": str(e)}
         )
 
+def _ingest_mapped(file_path: str, mappings_dict: dict, tenant: str, header_row: int, delimiter: str,
+                   document_granularity: DocumentGranularity, row_dedup: RowDeduplicator):
+    """Ingesta síncrona de /process-mapped-file (se ejecuta en un hilo; el perfil es el de ese hilo)"""
+    with request_profiler.profile("ingest", filename=os.path.basename(file_path)):
+        # Guardar versión mapeada (por bloques si el archivo no cabe completo en memoria)
+        plan = memory_service.plan_ingestion(file_path)
+        mapped_filename = f"mapped_{os.path.splitext(os.path.basename(file_path))[0]}.csv"
+        processed_path = os.path.join(settings["processed_dir"], mapped_filename)
+        rows, columns = file_service.map_columns(
+            file_path, mappings_dict, processed_path,
+            chunk_rows=plan.get("chunk_rows"), header_row=header_row, delimiter=delimiter or None
+        )
+        
+        # Inicializar colección RAG
+        with span("request", kind="ingest", filename=mapped_filename, rows=rows):
+            dataset = app_state.get("rag_retriever").ingest_dataset(
+                processed_path, tenant=tenant, plan=plan, granularity=document_granularity,
+                dedup=row_dedup
+            )
+    return plan, rows, columns, dataset
+
 @router.post("/process-mapped-file")
-async def process_mapped_file(file_path: str = Form(...), mappings: str = Form(...)):
-    """Procesa el archivo con los mapeos definidos por el usuario"""
+async def process_mapped_file(file_path: str = Form(...), mappings: str = Form(...), tenant: str = Form(DEFAULT_TENANT),
+                              header_row: int = Form(0), delimiter: str = Form(""),
+                              granularity: str = Form(""), group_by: str = Form(""),
+                              dedup: str = Form(""), dedup_keys: str = Form("")):
+    """Procesa el archivo con los mapeos definidos por el usuario (header_row y delimiter, los de /analyze-file;
+    granularity, group_by, dedup y dedup_keys, como en /upload)"""
+    request_id = new_request_id()
+    try:
+        document_granularity = _granularity(granularity, group_by)
+        row_dedup = _dedup(dedup, dedup_keys)
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={"status": "error", "message": str(e)}
+        )
     try:
         mappings_dict = json.loads(mappings)
         
-        # Cargar archivo
-        df, _ = file_service.process_file(file_path)
-        
-        # Crear nuevo DataFrame con columnas renombradas según mapeo
-        df_mapped = pd.DataFrame()
-        for system_col, file_col in mappings_dict.items():
-            if file_col in df.columns:
-                df_mapped[system_col] = df[file_col]
-        
-        # Verificar columnas requeridas
+        # Verificar columnas requeridas (solo con la cabecera del archivo)
+        file_columns = await asyncio.to_thread(file_service.read_columns, file_path, header_row, delimiter or None)
+        mapped_columns = [system_col for system_col, file_col in mappings_dict.items() if file_col in file_columns]
         required_columns = ["fecha", "cliente", "pais", "importe"]
-        missing_columns = [col for col in required_columns if col not in df_mapped.columns]
+        missing_columns = [col for col in required_columns if col not in mapped_columns]
         if missing_columns:
             return JSONResponse(
                 status_code=400,
@@ -143,21 +282,42 @@ async def process_mapped_file(file_path: str = Form(...), mappings: str = Form(.
                 }
             )
         
-        # Guardar versión mapeada
-        mapped_filename = f"mapped_{os.path.basename(file_path)}"
-        processed_path = os.path.join(settings["processed_dir"], mapped_filename)
-        df_mapped.to_csv(processed_path, index=False)
-        
-        # Inicializar colección RAG
-        rag_retriever.initialize_collection(processed_path)
+        # Mapeo e indexación bloquean durante segundos: fuera del bucle de eventos
+        plan, rows, columns, dataset = await asyncio.to_thread(
+            _ingest_mapped, file_path, mappings_dict, tenant, header_row, delimiter,
+            document_granularity, row_dedup
+        )
+        REQUESTS_TOTAL.inc(kind="ingest", status="ok")
         
         return JSONResponse(content={
             "status": "success",
             "message": "Archivo procesado correctamente con mapeo personalizado",
-            "rows": len(df_mapped),
-            "columns": list(df_mapped.columns)
+            "request_id": request_id,
+            "dataset_id": dataset["dataset_id"],
+            "reused": dataset["reused"],
+            "ingest_mode": plan["mode"],
+            "granularity": document_granularity.mode,
+            "dedup": dataset.get("dedup"),
+            "rows": rows,
+            "columns": columns
         })
+    except MemoryBudgetExceeded as e:
+        logger.warning(f"Archivo rechazado por memoria: {str(e)}")
+        REQUESTS_TOTAL.inc(kind="ingest", status="rejected")
+        return JSONResponse(
+            status_code=413,
+            content={"status": "error", "message": str(e)}
+        )
+    except ServiceNotReady as e:
+        logger.warning(f"Ingesta recibida durante el arranque: {str(e)}")
+        REQUESTS_TOTAL.inc(kind="ingest", status="not_ready")
+        return JSONResponse(
+            status_code=503,
+            content={"status": "error", "message": str(e)}
+        )
     except Exception as e:
+        logger.error(f"Error procesando archivo mapeado: {str(e)}")
+        REQUESTS_TOTAL.inc(kind="ingest", status="error")
         return JSONResponse(
             status_code=500,
             content={"status": "error", "message": str(e)}
@@ -200,4 +360,20 @@ async def get_templates():
         }
     ]
     
-    return JSONResponse(content=templates)
\ No newline at end of file
+    return JSONResponse(content=templates)
+
+@router.get("/api/excel-templates")
+async def get_excel_templates():
+    """Plantillas de Excel disponibles (predefinidas y guardadas)"""
+    return JSONResponse(content=template_service.list())
+
+@router.post("/api/templates")
+async def save_excel_template(template: dict = Body(...)):
+    """Guarda una plantilla de Excel; se compila en su plan de ingesta la primera vez que se usa"""
+    try:
+        return JSONResponse(content={"status": "success", "template": template_service.save(template)})
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={"status": "error", "message": str(e)}
+        )
\ No newline at end of file
@@ -1,39 +1,77 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from websockets.exceptions import ConnectionClosed
 import logging
-from services.llm_service import LLMService
-from rag.retriever import RAGRetriever
+from services.app_state import app_state
+from services.session_service import SessionService
+from utils.metrics import REQUESTS_TOTAL, new_request_id, span
+from utils.profiler import request_profiler
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
 # Servicios
-llm_service = LLMService()
-rag_retriever = RAGRetriever()
+session_service = SessionService()
 
 @router.websocket("/init")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
+    # Inquilino y dataset de la sesión (?tenant=...&dataset_id=...)
+    session = session_service.create_session(
+        tenant=websocket.query_params.get("tenant"),
+        dataset_id=websocket.query_params.get("dataset_id")
+    )
     try:
         while True:
-            # Recibir mensaje
-            data = await websocket.receive_json()
+            # Recibir mensaje (un JSON no válido se rechaza abajo como mensaje mal formado)
+            try:
+                data = await websocket.receive_json()
+            except ValueError:
+                data = None
             
             # Iniciar respuesta
             await websocket.send_json({"action": "init_system_response"})
             
-            # Obtener consulta del usuario
-            user_query = data[-1]["content"]
-            
-            # Consultar RAG para obtener contexto
-            rag_result = await rag_retriever.query(user_query)
-            
-            # Generar respuesta con LLM
-            await llm_service.generate_response(
-                context=rag_result["context"],
-                query=user_query,
-                websocket=websocket
-            )
+            new_request_id()
+            # Obtener consulta del usuario (el cliente solo envía el mensaje nuevo); si el mensaje
+            # está mal formado se avisa sin cerrar la conexión
+            try:
+                user_query = SessionService.extract_user_message(data)
+            except ValueError as e:
+                logger.warning(f"Mensaje del cliente no válido: {str(e)}")
+                await websocket.send_json({"action": "append_system_response", "content": f"Mensaje no válido: {str(e)}"})
+                await websocket.send_json({"action": "finish_system_response"})
+                REQUESTS_TOTAL.inc(kind="chat", status="invalid")
+                continue
+            if not app_state.is_ready():
+                await websocket.send_json({"action": "append_system_response", "content": app_state.not_ready_message()})
+                await websocket.send_json({"action": "finish_system_response"})
+                REQUESTS_TOTAL.inc(kind="chat", status="not_ready")
+                continue
+            # Servicios compartidos, inicializados una sola vez en el arranque de la aplicación
+            llm_service = app_state.get("llm_service")
+            rag_retriever = app_state.get("rag_retriever")
+            try:
+                with request_profiler.profile("chat", session_id=session.session_id):
+                    with span("request", kind="chat", session_id=session.session_id) as attributes:
+                        SessionService.bind_dataset(data, session)
+                        session.add_message("user", user_query)
+                        
+                        # Consultar RAG sobre el dataset de la sesión para obtener contexto
+                        rag_result = await rag_retriever.query(user_query, dataset_id=session.dataset_id, tenant=session.tenant)
+                        
+                        # Generar respuesta con LLM usando el historial acotado de la sesión
+                        response_text = await llm_service.generate_response(
+                            context=rag_result["context"],
+                            query=user_query,
+                            websocket=websocket,
+                            history=session.render_history()
+                        )
+                        session.add_message("assistant", response_text)
+                        attributes["response_chars"] = len(response_text)
+            except Exception:
+                REQUESTS_TOTAL.inc(kind="chat", status="error")
+                raise
+            REQUESTS_TOTAL.inc(kind="chat", status="ok")
             
             # Finalizar respuesta
             await websocket.send_json({"action": "finish_system_response"})
@@ -50,4 +88,6 @@ async def websocket_endpoint(websocket: WebSocket):
                 "content": f"Error: {str(e)}"
             })
         except:
-            pass
\ No newline at end of file
+            pass
+    finally:
+        session_service.close_session(session.session_id)
\ No newline at end of file
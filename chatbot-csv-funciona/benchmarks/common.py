@@ -0,0 +1,69 @@
+"""Utilidades compartidas por los benchmarks: percentiles e informes JSON comparables entre commits."""
+import json
+import platform
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """Percentil p (0-100) con interpolación lineal; None si no hay valores"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * p / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def summarize(values: List[float], scale: float = 1000.0) -> Dict[str, Optional[float]]:
+    """Resumen de una serie de duraciones en segundos (por defecto expresado en milisegundos)"""
+    def scaled(value):
+        return round(value * scale, 3) if value is not None else None
+
+    return {
+        "count": len(values),
+        "mean": scaled(sum(values) / len(values)) if values else None,
+        "p50": scaled(percentile(values, 50)),
+        "p90": scaled(percentile(values, 90)),
+        "p99": scaled(percentile(values, 99)),
+        "max": scaled(max(values)) if values else None
+    }
+
+
+def git_revision() -> Optional[str]:
+    """Commit actual del repositorio, para poder comparar resultados entre versiones"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def build_report(benchmark: str, parameters: Dict[str, Any], results: Any) -> Dict[str, Any]:
+    """Estructura común de los informes de benchmark"""
+    return {
+        "benchmark": benchmark,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "parameters": parameters,
+        "results": results
+    }
+
+
+def write_report(report: Dict[str, Any], output: Optional[str] = None):
+    """Escribe el informe en un archivo JSON o, si no se indica, en la salida estándar"""
+    text = json.dumps(report, indent=2, ensure_ascii=False, default=str)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,238 @@
+"""Benchmark de ingesta: tiempo por fase y memoria pico de RAGRetriever.initialize_collection.
+
+Genera datos sintéticos con la forma de facturas.csv y data.csv (Ventas Diarias)
+y mide por separado: lectura CSV, process_dataframe, create_documents,
+estadísticas, embedding e inserción en Chroma. Con --excel las facturas también
+se escriben como .xlsx y se mide su conversión a CSV frente a la lectura del CSV. Con --granularity
+cada caso se repite por granularidad de documentos (row, group, chunk) para comparar el número de
+documentos y el tiempo de embedding e inserción. Con --duplicates las facturas incluyen esa fracción
+de filas repetidas (un periodo exportado de nuevo) y con --dedup se mide su eliminación antes de crear
+los documentos. Cada caso se ejecuta en un proceso nuevo para que la memoria pico (RSS) sea la de ese caso.
+
+Uso (desde chatbot-csv-funciona):
+    python -m benchmarks.ingestion --sizes 10000,100000,1000000 --embed-sample 5000 --output ingesta.json
+    python -m benchmarks.ingestion --sizes 100000 --granularity row,group,chunk --skip-embedding
+    python -m benchmarks.ingestion --datasets facturas --sizes 100000 --duplicates 0.3 --dedup first
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List
+
+from benchmarks.common import build_report, write_report
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIMENSIONS = 384
+
+
+def _rss_mb() -> float:
+    import psutil
+    return round(psutil.Process().memory_info().rss / (1024 * 1024), 1)
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss está en KB en Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _timed(phases: Dict[str, Any], name: str, fn: Callable, **extra):
+    start = time.perf_counter()
+    result = fn()
+    phases[name] = {"seconds": round(time.perf_counter() - start, 4), "rss_mb": _rss_mb(), **extra}
+    return result
+
+
+def _skip(phases: Dict[str, Any], names: List[str], reason: str):
+    for name in names:
+        phases[name] = {"skipped": reason}
+
+
+def run_case(kind: str, rows: int, seed: int, workdir: str, embed_sample: int, skip_embedding: bool,
+             excel: bool = False, granularity: str = "row", duplicates: float = 0.0,
+             dedup: str = "off") -> Dict[str, Any]:
+    """Ejecuta un caso completo (en un proceso hijo) y devuelve sus tiempos por fase"""
+    import numpy as np
+    import pandas as pd
+    from benchmarks import synthetic
+    from rag.dedup import RowDeduplicator
+    from rag.granularity import DocumentGranularity
+    from rag.processor import DataProcessor
+    from rag.retriever import RAGRetriever
+
+    phases: Dict[str, Any] = {}
+    case = {"dataset": kind, "rows": rows, "granularity": granularity, "dedup": dedup, "phases": phases}
+    document_granularity = DocumentGranularity(granularity)
+    row_dedup = RowDeduplicator(dedup)
+
+    start = time.perf_counter()
+    path = os.path.join(workdir, f"{kind}_{rows}.csv")
+    if kind == "ventas":
+        df = synthetic.generate_ventas_diarias(rows, seed)
+    else:
+        df = synthetic.add_duplicates(synthetic.generate_facturas(rows, seed), duplicates, seed)
+    synthetic.write_csv(df, path, kind)
+    excel_path = None
+    if excel and kind == "facturas":
+        excel_path = os.path.join(workdir, f"{kind}_{rows}.xlsx")
+        synthetic.write_xlsx(df, excel_path)
+    del df
+    case["generate_seconds"] = round(time.perf_counter() - start, 3)
+    case["file_mb"] = round(os.path.getsize(path) / (1024 * 1024), 2)
+    case["baseline_rss_mb"] = _rss_mb()
+
+    # Ventas Diarias se ingiere con el plan compilado de su plantilla de Excel
+    template = None
+    if kind == "ventas":
+        from services.excel_template_service import template_service
+        template = template_service.compile("Ventas Diarias")
+        df = _timed(phases, "csv_parse", lambda: next(template.read(path)))
+    else:
+        df = _timed(phases, "csv_parse", lambda: pd.read_csv(path))
+    phases["csv_parse"]["dataframe_mb"] = round(df.memory_usage(deep=True).sum() / (1024 * 1024), 1)
+
+    if excel_path:
+        from config import settings
+        from services.excel_reader import convert_to_csv
+        workers = settings["excel_read_workers"]
+        converted = os.path.join(workdir, f"{kind}_{rows}_xlsx.csv")
+        _timed(phases, "excel_to_csv", lambda: convert_to_csv(excel_path, converted, workers=workers),
+               workers=workers, file_mb=round(os.path.getsize(excel_path) / (1024 * 1024), 2))
+        phases["excel_to_csv"]["vs_csv_parse"] = round(
+            phases["excel_to_csv"]["seconds"] / max(phases["csv_parse"]["seconds"], 1e-9), 1
+        )
+
+    if template is not None:
+        df = _timed(phases, "process_dataframe", lambda: template.transform(df))
+        df = _timed(phases, "dedup", lambda: row_dedup.apply(df, template.columns, template.numeric_columns))
+        documents, metadatas, ids = _timed(phases, "create_documents", lambda: template.create_documents(df, document_granularity))
+        stats = _timed(phases, "stats_generation", lambda: template.create_summary_documents(template.summarize(df)))
+    else:
+        df = _timed(phases, "process_dataframe", lambda: DataProcessor.process_dataframe(df))
+        df = _timed(phases, "dedup", lambda: row_dedup.apply(df, DataProcessor.dedup_keys(list(df.columns)),
+                                                             DataProcessor.MEASURES))
+        documents, metadatas, ids = _timed(phases, "create_documents", lambda: DataProcessor.create_row_documents(df, document_granularity))
+        stats = _timed(phases, "stats_generation", lambda: DataProcessor.create_stats_documents(df))
+    documents += stats[0]
+    metadatas += stats[1]
+    ids += stats[2]
+    case["documents"] = len(documents)
+    case["rows_removed"] = row_dedup.rows_removed
+
+    # Muestra para embedding e inserción (embeber millones de textos en CPU no es viable en un benchmark)
+    sample = len(documents) if embed_sample <= 0 else min(embed_sample, len(documents))
+    batch_size = RAGRetriever.BATCH_SIZE
+
+    embeddings = None
+    if skip_embedding:
+        _skip(phases, ["embedding"], "desactivado con --skip-embedding")
+        rng = np.random.default_rng(seed)
+        embeddings = rng.standard_normal((sample, EMBEDDING_DIMENSIONS)).astype("float32").tolist()
+    else:
+        try:
+            from rag.embeddings import EmbeddingService
+            embedding_function = EmbeddingService().get_embedding_function()
+            if embedding_function is None:
+                from chromadb.utils import embedding_functions
+                embedding_function = embedding_functions.DefaultEmbeddingFunction()
+
+            def embed():
+                vectors = []
+                for i in range(0, sample, batch_size):
+                    vectors.extend(embedding_function(documents[i:i + batch_size]))
+                return vectors
+
+            embeddings = _timed(phases, "embedding", embed, documents=sample)
+            phases["embedding"]["docs_per_sec"] = round(sample / max(phases["embedding"]["seconds"], 1e-9), 1)
+            phases["embedding"]["projected_seconds_all"] = round(len(documents) / max(phases["embedding"]["docs_per_sec"], 1e-9), 1)
+        except Exception as e:
+            phases["embedding"] = {"error": f"{type(e).__name__}: {e}"}
+
+    if embeddings is None:
+        _skip(phases, ["chroma_insert"], "sin embeddings")
+    else:
+        import chromadb
+        client = chromadb.Client()
+        collection = client.create_collection(name=f"bench_{kind}_{rows}")
+
+        def insert():
+            for i in range(0, sample, batch_size):
+                end = min(i + batch_size, sample)
+                collection.add(
+                    documents=documents[i:end],
+                    metadatas=metadatas[i:end],
+                    ids=ids[i:end],
+                    embeddings=embeddings[i:end]
+                )
+
+        _timed(phases, "chroma_insert", insert, documents=sample)
+        phases["chroma_insert"]["docs_per_sec"] = round(sample / max(phases["chroma_insert"]["seconds"], 1e-9), 1)
+        phases["chroma_insert"]["projected_seconds_all"] = round(len(documents) / max(phases["chroma_insert"]["docs_per_sec"], 1e-9), 1)
+
+    case["peak_rss_mb"] = _peak_rss_mb()
+    return case
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de ingesta por fases")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="Filas por caso, separadas por comas (hasta 5000000)")
+    parser.add_argument("--datasets", default="facturas,ventas", help="facturas y/o ventas")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--embed-sample", type=int, default=5000,
+                        help="Documentos a embeber e insertar (0 = todos); el resto se proyecta")
+    parser.add_argument("--skip-embedding", action="store_true",
+                        help="No embeber; inserta vectores aleatorios para medir solo Chroma")
+    parser.add_argument("--excel", action="store_true",
+                        help="Escribe también las facturas como .xlsx y mide su conversión a CSV")
+    parser.add_argument("--granularity", default="row",
+                        help="Granularidades de documentos a comparar, separadas por comas (row, group, chunk)")
+    parser.add_argument("--duplicates", type=float, default=0.0,
+                        help="Fracción de filas de facturas repetidas que se añaden (p. ej. 0.3)")
+    parser.add_argument("--dedup", default="off", help="Deduplicación de filas: off, first o sum")
+    parser.add_argument("--workdir", help="Directorio para los CSV generados (por defecto temporal)")
+    parser.add_argument("--output", help="Archivo JSON de resultados (por defecto stdout)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    datasets = [kind.strip() for kind in args.datasets.split(",") if kind.strip()]
+    granularities = [mode.strip() for mode in args.granularity.split(",") if mode.strip()]
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_ingesta_")
+    os.makedirs(workdir, exist_ok=True)
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for kind in datasets:
+        for rows in sizes:
+            for granularity in granularities:
+                logger.info(f"Ingesta {kind} con {rows} filas (granularidad {granularity})...")
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    case = executor.submit(run_case, kind, rows, args.seed, workdir, args.embed_sample,
+                                           args.skip_embedding, args.excel, granularity,
+                                           args.duplicates, args.dedup).result()
+                summary = {name: phase.get("seconds") for name, phase in case["phases"].items()}
+                logger.info(f"  {case['documents']} documentos ({case['rows_removed']} filas repetidas descartadas) | "
+                            f"fases (s): {summary} | pico RSS {case['peak_rss_mb']} MB")
+                results.append(case)
+
+    parameters = {
+        "sizes": sizes,
+        "datasets": datasets,
+        "seed": args.seed,
+        "embed_sample": args.embed_sample,
+        "skip_embedding": args.skip_embedding,
+        "excel": args.excel,
+        "granularity": granularities,
+        "duplicates": args.duplicates,
+        "dedup": args.dedup
+    }
+    write_report(build_report("ingestion", parameters, results), args.output)
+
+
+if __name__ == "__main__":
+    main()
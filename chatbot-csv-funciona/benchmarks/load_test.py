@@ -0,0 +1,181 @@
+"""Prueba de carga del websocket /init con sesiones concurrentes.
+
+Abre N sesiones simultáneas por nivel de concurrencia, reproduce un corpus de
+preguntas y mide a partir del stream init/append/finish_system_response:
+tiempo hasta el primer token, latencia entre tokens, latencia total y errores.
+
+Uso (desde chatbot-csv-funciona, con la aplicación en marcha):
+    python -m benchmarks.load_test --concurrency 1,4,16 --turns 3 --output load.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+import urllib.request
+from typing import Any, Dict, List, Optional
+
+import websockets
+
+from benchmarks.common import build_report, summarize, write_report
+
+logger = logging.getLogger(__name__)
+
+# Corpus de respaldo si /api/templates no está disponible
+FALLBACK_CORPUS = [
+    "¿Cuál es el cliente con mayor importe total?",
+    "¿Cuántas facturas se emitieron para clientes de España?",
+    "¿Cuál fue el mes con mayor facturación?",
+    "Dame un resumen general de las facturas",
+    "¿Qué importe facturó el cliente 2 en febrero?",
+]
+
+
+def load_corpus(http_url: str, corpus_path: Optional[str]) -> List[str]:
+    """Carga las preguntas desde un archivo, desde /api/templates o del corpus de respaldo"""
+    if corpus_path:
+        with open(corpus_path, "r", encoding="utf-8") as f:
+            if corpus_path.endswith(".json"):
+                data = json.load(f)
+                return [item["prompt"] if isinstance(item, dict) else str(item) for item in data]
+            return [line.strip() for line in f if line.strip()]
+
+    try:
+        with urllib.request.urlopen(f"{http_url}/api/templates", timeout=5) as response:
+            templates = json.loads(response.read().decode("utf-8"))
+            prompts = [template["prompt"] for template in templates if template.get("prompt")]
+            if prompts:
+                return prompts
+    except Exception as e:
+        logger.warning(f"No se pudo leer /api/templates ({e}); se usa el corpus de respaldo")
+    return FALLBACK_CORPUS
+
+
+async def run_turn(ws, question: str, timeout: float) -> Dict[str, Any]:
+    """Envía una pregunta y mide el stream de respuesta hasta finish_system_response"""
+    start = time.perf_counter()
+    await ws.send(json.dumps({"role": "user", "content": question}))
+
+    token_times: List[float] = []
+    chars = 0
+    error = None
+    while True:
+        raw = await asyncio.wait_for(ws.recv(), timeout=timeout)
+        now = time.perf_counter()
+        message = json.loads(raw)
+        action = message.get("action")
+        if action == "append_system_response":
+            token_times.append(now)
+            content = message.get("content", "")
+            chars += len(content)
+            if content.startswith("Error:"):
+                error = content
+        elif action == "error":
+            error = message.get("content", "error")
+            break
+        elif action == "finish_system_response":
+            break
+
+    end = time.perf_counter()
+    return {
+        "ttft": token_times[0] - start if token_times else None,
+        "inter_token": [b - a for a, b in zip(token_times, token_times[1:])],
+        "total": end - start,
+        "chunks": len(token_times),
+        "chars": chars,
+        "error": error
+    }
+
+
+async def run_session(url: str, questions: List[str], timeout: float) -> List[Dict[str, Any]]:
+    """Una sesión websocket que hace varias preguntas seguidas"""
+    results = []
+    try:
+        async with websockets.connect(url, open_timeout=timeout, max_size=None) as ws:
+            for question in questions:
+                try:
+                    results.append(await run_turn(ws, question, timeout))
+                except Exception as e:
+                    results.append({"error": f"{type(e).__name__}: {e}"})
+                    break
+    except Exception as e:
+        results.append({"error": f"{type(e).__name__}: {e}"})
+    return results
+
+
+async def run_level(url: str, corpus: List[str], concurrency: int, turns: int, timeout: float) -> Dict[str, Any]:
+    """Ejecuta un nivel de concurrencia y agrega sus métricas"""
+    sessions = []
+    for i in range(concurrency):
+        questions = [corpus[(i * turns + j) % len(corpus)] for j in range(turns)]
+        sessions.append(run_session(url, questions, timeout))
+
+    start = time.perf_counter()
+    session_results = await asyncio.gather(*sessions)
+    elapsed = time.perf_counter() - start
+
+    turns_results = [turn for session in session_results for turn in session]
+    ok = [turn for turn in turns_results if not turn.get("error")]
+    errors = [turn["error"] for turn in turns_results if turn.get("error")]
+    error_kinds: Dict[str, int] = {}
+    for error in errors:
+        kind = error.split(":")[0]
+        error_kinds[kind] = error_kinds.get(kind, 0) + 1
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(turns_results),
+        "successful": len(ok),
+        "errors": len(errors),
+        "error_rate": round(len(errors) / len(turns_results), 4) if turns_results else None,
+        "error_kinds": error_kinds,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed > 0 else None,
+        "ttft_ms": summarize([turn["ttft"] for turn in ok if turn["ttft"] is not None]),
+        "inter_token_ms": summarize([gap for turn in ok for gap in turn["inter_token"]]),
+        "total_ms": summarize([turn["total"] for turn in ok]),
+        "chunks_per_response": summarize([turn["chunks"] for turn in ok], scale=1.0)
+    }
+
+
+async def run(args) -> Dict[str, Any]:
+    corpus = load_corpus(args.http_url, args.corpus)
+    levels = [int(level) for level in args.concurrency.split(",") if level.strip()]
+    results = []
+    for level in levels:
+        logger.info(f"Nivel de concurrencia {level}...")
+        result = await run_level(args.url, corpus, level, args.turns, args.timeout)
+        logger.info(
+            f"  {result['successful']}/{result['requests']} correctas, "
+            f"TTFT p50={result['ttft_ms']['p50']}ms, total p99={result['total_ms']['p99']}ms"
+        )
+        results.append(result)
+
+    parameters = {
+        "url": args.url,
+        "concurrency_levels": levels,
+        "turns_per_session": args.turns,
+        "corpus_size": len(corpus),
+        "timeout_s": args.timeout
+    }
+    return build_report("websocket_load", parameters, results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga del websocket /init")
+    parser.add_argument("--url", default="ws://127.0.0.1:8000/init")
+    parser.add_argument("--http-url", default="http://127.0.0.1:8000",
+                        help="Base HTTP para leer el corpus de /api/templates")
+    parser.add_argument("--corpus", help="Archivo .json (lista o plantillas) o .txt (una pregunta por línea)")
+    parser.add_argument("--concurrency", default="1,4,16", help="Niveles de concurrencia separados por comas")
+    parser.add_argument("--turns", type=int, default=3, help="Preguntas por sesión")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--output", help="Archivo JSON de resultados (por defecto stdout)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    write_report(asyncio.run(run(args)), args.output)
+
+
+if __name__ == "__main__":
+    main()
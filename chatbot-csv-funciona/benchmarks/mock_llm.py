@@ -0,0 +1,186 @@
+"""Servidor LLM simulado compatible con la API de OpenAI (chat/completions).
+
+Sustituye a Cortex en pruebas de rendimiento: responde de forma determinista
+con un tiempo hasta el primer token, una velocidad de generación y una
+longitud de respuesta configurables, y puede inyectar fallos.
+
+Uso (desde chatbot-csv-funciona):
+    python -m benchmarks.mock_llm --port 39281 --ttft-ms 200 --tokens-per-sec 40
+    LLM_ENDPOINT=http://127.0.0.1:39281/v1 python main.py
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from typing import Any, Dict, List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+# Vocabulario para las respuestas generadas
+WORDS = (
+    "el cliente registró un importe total de ventas durante el periodo con "
+    "facturas emitidas en España y Reino Unido según los datos disponibles del "
+    "local en marzo abril mayo resumen estadístico promedio máximo mínimo"
+).split()
+
+
+class MockSettings:
+    """Parámetros del servidor simulado (variables de entorno o argumentos)"""
+
+    def __init__(self):
+        self.ttft_ms = float(os.getenv("MOCK_TTFT_MS", "200"))
+        self.tokens_per_sec = float(os.getenv("MOCK_TOKENS_PER_SEC", "50"))
+        self.response_tokens = int(os.getenv("MOCK_RESPONSE_TOKENS", "64"))
+        self.failure_rate = float(os.getenv("MOCK_FAILURE_RATE", "0"))
+        self.stream_failure_rate = float(os.getenv("MOCK_STREAM_FAILURE_RATE", "0"))
+        self.response_text = os.getenv("MOCK_RESPONSE", "")
+        self.seed = int(os.getenv("MOCK_SEED", "0"))
+
+
+mock_settings = MockSettings()
+app = FastAPI()
+
+
+def _request_rng(messages: List[Dict[str, Any]]) -> random.Random:
+    """Generador determinista: misma semilla + mismo prompt -> mismo resultado, sea cual sea el orden
+    de llegada de las peticiones concurrentes (reintentar el mismo prompt vuelve a fallar igual)"""
+    digest = hashlib.sha256(json.dumps(messages, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+    return random.Random(f"{mock_settings.seed}:{digest}")
+
+
+def _response_tokens(messages: List[Dict[str, Any]], max_tokens: int) -> List[str]:
+    """Tokens de la respuesta: texto fijo si se configuró MOCK_RESPONSE o palabras deterministas"""
+    if mock_settings.response_text:
+        words = mock_settings.response_text.split(" ")
+        return [word if i == 0 else " " + word for i, word in enumerate(words)][:max_tokens]
+
+    rng = random.Random(f"{mock_settings.seed}:" + json.dumps(messages, sort_keys=True, ensure_ascii=False))
+    count = min(mock_settings.response_tokens, max_tokens)
+    return [(" " if i else "") + rng.choice(WORDS) for i in range(count)]
+
+
+def _chunk(completion_id: str, model: str, delta: Dict[str, Any], finish_reason=None) -> str:
+    payload = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+async def _stream(completion_id: str, model: str, tokens: List[str], fail_at: int):
+    """Emite los tokens respetando el TTFT y la velocidad configurados (planificación absoluta)"""
+    start = time.perf_counter()
+    interval = 1.0 / mock_settings.tokens_per_sec if mock_settings.tokens_per_sec > 0 else 0.0
+    yield _chunk(completion_id, model, {"role": "assistant", "content": ""})
+
+    for i, token in enumerate(tokens):
+        target = start + mock_settings.ttft_ms / 1000.0 + i * interval
+        delay = target - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if i == fail_at:
+            # Fallo a mitad de la respuesta: se corta el stream sin [DONE]
+            raise RuntimeError("Fallo simulado durante el streaming")
+        yield _chunk(completion_id, model, {"content": token})
+
+    yield _chunk(completion_id, model, {}, finish_reason="stop")
+    yield "data: [DONE]\n\n"
+
+
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "benchmarks"}]}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    messages = body.get("messages", [])
+    model = body.get("model", "mock")
+    max_tokens = body.get("max_tokens") or mock_settings.response_tokens
+    rng = _request_rng(messages)
+
+    if rng.random() < mock_settings.failure_rate:
+        return JSONResponse(
+            status_code=503,
+            content={"error": {"message": "Fallo simulado", "type": "server_error"}}
+        )
+
+    tokens = _response_tokens(messages, max_tokens)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+    if body.get("stream"):
+        fail_at = rng.randrange(len(tokens)) if tokens and rng.random() < mock_settings.stream_failure_rate else -1
+        return StreamingResponse(
+            _stream(completion_id, model, tokens, fail_at),
+            media_type="text/event-stream"
+        )
+
+    # Sin streaming: se espera el tiempo total de generación y se devuelve el mensaje completo
+    total = mock_settings.ttft_ms / 1000.0
+    if mock_settings.tokens_per_sec > 0:
+        total += max(len(tokens) - 1, 0) / mock_settings.tokens_per_sec
+    await asyncio.sleep(total)
+    prompt_tokens = sum(len(str(m.get("content", ""))) // 4 for m in messages)
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": "".join(tokens)},
+            "finish_reason": "stop"
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens)
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor LLM simulado para pruebas de rendimiento")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.getenv("MOCK_PORT", "39281")))
+    parser.add_argument("--ttft-ms", type=float, default=mock_settings.ttft_ms)
+    parser.add_argument("--tokens-per-sec", type=float, default=mock_settings.tokens_per_sec)
+    parser.add_argument("--response-tokens", type=int, default=mock_settings.response_tokens)
+    parser.add_argument("--failure-rate", type=float, default=mock_settings.failure_rate)
+    parser.add_argument("--stream-failure-rate", type=float, default=mock_settings.stream_failure_rate)
+    parser.add_argument("--response", default=mock_settings.response_text,
+                        help="Texto fijo de respuesta (p. ej. un SQL para main_agentia)")
+    parser.add_argument("--seed", type=int, default=mock_settings.seed)
+    args = parser.parse_args()
+
+    mock_settings.ttft_ms = args.ttft_ms
+    mock_settings.tokens_per_sec = args.tokens_per_sec
+    mock_settings.response_tokens = args.response_tokens
+    mock_settings.failure_rate = args.failure_rate
+    mock_settings.stream_failure_rate = args.stream_failure_rate
+    mock_settings.response_text = args.response
+    mock_settings.seed = args.seed
+
+    logging.basicConfig(level=logging.INFO)
+    logger.info(
+        f"LLM simulado: TTFT={args.ttft_ms}ms, {args.tokens_per_sec} tokens/s, "
+        f"{args.response_tokens} tokens, fallos={args.failure_rate}"
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Benchmark del almacén de vectores cuantizado (VECTOR_STORE=quantized) frente al índice sin comprimir.
+
+Indexa los mismos documentos y embeddings en una colección de ChromaDB (HNSW, float32) y en
+el almacén cuantizado a int8, y para cada número de candidatos reordenados con la distancia
+exacta reporta recall@k frente a la búsqueda exacta en float32 (y el solapamiento con
+ChromaDB), latencia p50/p99 de la consulta y memoria residente por documento. candidates=k
+equivale a no reordenar más allá de los k primeros por la puntuación int8.
+
+Uso (desde chatbot-csv-funciona):
+    python -m benchmarks.quantization --rows 20000 --queries 200 --candidates 6,20,50,100,200
+    python -m benchmarks.quantization --backend hashing --rows 100000 --output cuantizacion.json
+"""
+import argparse
+import logging
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+
+from benchmarks.common import build_report, summarize, write_report
+from benchmarks.retrieval import build_documents, embed_all, load_backend, synthetic_questions
+from rag.quantized_store import QuantizedClient
+from rag.retriever import RAGRetriever
+from services.memory_service import INDEX_BYTES_PER_DOC
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# Consultas por bloque en la búsqueda exacta de referencia (acota la matriz de distancias)
+EXACT_BLOCK_QUERIES = 64
+# Tolerancia para considerar empatadas dos distancias exactas
+TIE_TOLERANCE = 1e-5
+
+
+def exact_distances(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """Distancias L2² exactas de cada consulta a sus k vecinos, sobre los vectores float32 sin comprimir"""
+    norms = np.einsum("ij,ij->i", vectors, vectors)
+    distances = []
+    for start in range(0, len(queries), EXACT_BLOCK_QUERIES):
+        block = queries[start:start + EXACT_BLOCK_QUERIES]
+        scores = norms[None, :] - 2 * block @ vectors.T
+        top = np.sort(np.partition(scores, k, axis=1)[:, :k], axis=1)
+        distances.append(top + np.einsum("ij,ij->i", block, block)[:, None])
+    return np.concatenate(distances)
+
+
+def recall(found: List[List[str]], vectors: np.ndarray, positions: Dict[str, int], queries: np.ndarray,
+           exact: np.ndarray, k: int) -> float:
+    """recall@k frente a la búsqueda exacta, con empates: un resultado acierta si su distancia
+    exacta no supera la del k-ésimo vecino exacto (documentos casi iguales dan distancias iguales)"""
+    hits = []
+    for ids, query, distances in zip(found, queries, exact):
+        found_vectors = vectors[[positions[document_id] for document_id in ids[:k]]]
+        found_distances = ((found_vectors - query) ** 2).sum(axis=1)
+        hits.append(np.count_nonzero(found_distances <= distances[k - 1] + TIE_TOLERANCE) / k)
+    return round(float(np.mean(hits)), 4)
+
+
+def overlap(found: List[List[str]], reference: List[List[str]], k: int) -> float:
+    return round(float(np.mean([len(set(f[:k]) & set(r[:k])) / k for f, r in zip(found, reference)])), 4)
+
+
+def timed_queries(collection, queries: np.ndarray, k: int):
+    ids, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        result = collection.query(query_embeddings=[query.tolist()], n_results=k, include=[])
+        latencies.append(time.perf_counter() - start)
+        ids.append(result["ids"][0])
+    return ids, summarize(latencies)
+
+
+def run(args) -> Dict[str, Any]:
+    import chromadb
+
+    question_set = synthetic_questions(args.rows, args.queries, args.seed)
+    documents, metadatas, ids = build_documents(question_set["df"])
+    texts = [question["question"] for question in question_set["questions"]]
+    logger.info(f"{len(documents)} documentos, {len(texts)} consultas, backend {args.backend}")
+
+    embedding_function = load_backend(args.backend)
+    start = time.perf_counter()
+    vectors = np.asarray(embed_all(embedding_function, documents), dtype=np.float32)
+    embed_seconds = time.perf_counter() - start
+    queries = np.asarray(embed_all(embedding_function, texts), dtype=np.float32)
+    ks = [int(k) for k in args.k.split(",")]
+    exact = exact_distances(vectors, queries, max(ks))
+    positions = {document_id: position for position, document_id in enumerate(ids)}
+
+    batch_size = RAGRetriever.BATCH_SIZE
+    chroma = chromadb.Client().create_collection(name="bench_quantization")
+    quantized = QuantizedClient(tempfile.mkdtemp(prefix="bench_quant_")).create_collection("bench_quantization")
+    timings = {}
+    for name, collection in (("chroma", chroma), ("quantized", quantized)):
+        start = time.perf_counter()
+        for i in range(0, len(documents), batch_size):
+            collection.add(ids=ids[i:i + batch_size], documents=documents[i:i + batch_size],
+                           metadatas=metadatas[i:i + batch_size], embeddings=vectors[i:i + batch_size].tolist())
+        timings[name] = round(time.perf_counter() - start, 3)
+
+    arrays = quantized._load()
+    resident = arrays["codes"].nbytes + arrays["factors"].nbytes + arrays["alive"].nbytes
+    results = []
+    for k in ks:
+        chroma_ids, latency = timed_queries(chroma, queries, k)
+        results.append({"index": "chroma_hnsw_f32", "k": k, "candidates": None,
+                        "recall_vs_exact": recall(chroma_ids, vectors, positions, queries, exact, k),
+                        "latency_p50_ms": latency["p50"], "latency_p99_ms": latency["p99"]})
+        for candidates in sorted({max(c, k) for c in (int(c) for c in args.candidates.split(","))}):
+            quantized.rerank_candidates = candidates
+            found, latency = timed_queries(quantized, queries, k)
+            results.append({"index": "quantized_int8", "k": k, "candidates": candidates,
+                            "recall_vs_exact": recall(found, vectors, positions, queries, exact, k),
+                            "overlap_with_chroma": overlap(found, chroma_ids, k),
+                            "latency_p50_ms": latency["p50"], "latency_p99_ms": latency["p99"]})
+    return {
+        "documents": len(documents),
+        "queries": len(texts),
+        "dimensions": int(vectors.shape[1]),
+        "embed_seconds": round(embed_seconds, 2),
+        "insert_seconds": timings,
+        "resident_bytes_per_doc": {"chroma_estimate": INDEX_BYTES_PER_DOC,
+                                   "quantized": round(resident / len(documents), 1)},
+        "disk_float32_mb": round(vectors.nbytes / MB, 2),
+        "results": results
+    }
+
+
+def format_table(rows: List[Dict[str, Any]]) -> str:
+    columns = ("index", "k", "candidates", "recall_vs_exact", "overlap_with_chroma", "latency_p50_ms", "latency_p99_ms")
+    widths = {col: max(len(col), *(len(str(row.get(col, ""))) for row in rows)) for col in columns}
+    lines = ["  ".join(col.ljust(widths[col]) for col in columns)]
+    for row in rows:
+        lines.append("  ".join(str(row.get(col, "")).ljust(widths[col]) for col in columns))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall y memoria del almacén de vectores cuantizado")
+    parser.add_argument("--rows", type=int, default=20000, help="Facturas sintéticas a indexar")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", default="1,6,10")
+    parser.add_argument("--candidates", default="6,20,50,100,200",
+                        help="Candidatos reordenados con la distancia exacta (VECTOR_RERANK_CANDIDATES)")
+    parser.add_argument("--backend", default="default", help="Backend de embeddings: default, hashing, onnx, onnx_int8")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Archivo JSON de resultados (por defecto stdout)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    report = run(args)
+    print(format_table(report["results"]))
+    logger.info(f"Memoria residente por documento: {report['resident_bytes_per_doc']} | "
+                f"inserción (s): {report['insert_seconds']}")
+
+    parameters = {key: value for key, value in vars(args).items() if key != "output"}
+    write_report(build_report("quantization", parameters, report), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""Benchmark de calidad frente a latencia de la recuperación (RAGRetriever.query).
+
+Con un conjunto de preguntas etiquetadas (pregunta -> IDs de documento esperados)
+barre k, backend de embeddings, parámetros del índice HNSW y el modo de filtrado
+por metadatos, y reporta en una tabla recall@k, MRR, tokens de contexto y latencia
+p50/p99 de la recuperación, junto con el rendimiento del backend de embeddings
+(documentos/s al indexar y latencia de embedding de una consulta).
+
+Backends de embeddings: hashing (línea base léxica), default (ONNX de ChromaDB) y los
+de rag/embeddings.py (onnx, onnx_int8) con --model-dir, barriendo hilos y tamaño de lote.
+
+Conjuntos de preguntas:
+  - facturas: benchmarks/data/retrieval_questions.json sobre data/facturas.csv
+  - synthetic: facturas sintéticas con preguntas etiquetadas generadas a partir de los datos
+
+Uso (desde chatbot-csv-funciona):
+    python -m benchmarks.retrieval --questions facturas,synthetic --k 2,4,6,8 --output retrieval.json
+    python -m benchmarks.retrieval --backends default,onnx,onnx_int8 --embedding-threads 1,4 --embedding-batch 32,128
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import os
+import re
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.common import build_report, summarize, write_report
+from rag.embeddings import EmbeddingService
+from rag.processor import DataProcessor
+from rag.retriever import RAGRetriever
+from services.query_router import MONTHS
+from services.session_service import estimate_tokens
+from utils.helpers import normalize_text
+
+logger = logging.getLogger(__name__)
+
+QUESTIONS_PATH = os.path.join(os.path.dirname(__file__), "data", "retrieval_questions.json")
+FILTER_MODES = ("none", "where", "post")
+# En modo "post" se recuperan más candidatos y se filtran en Python
+POST_FILTER_FACTOR = 4
+
+PAISES = {
+    "espana": "ES", "reino unido": "UK", "francia": "FR", "alemania": "DE",
+    "italia": "IT", "portugal": "PT", "ecuador": "EC", "mexico": "MX"
+}
+PAIS_CODES = set(PAISES.values())
+
+STATS_QUESTIONS = [
+    ("¿Cuál es el importe total facturado?", ["stats_general"]),
+    ("Dame un resumen general de las facturas", ["stats_general"]),
+    ("¿Qué cliente facturó más?", ["stats_clientes"]),
+    ("¿Qué país tiene mayor facturación?", ["stats_paises"]),
+    ("¿Qué mes tuvo más facturación?", ["stats_meses"])
+]
+
+
+class HashingEmbeddingFunction:
+    """Embeddings léxicos por hashing de unigramas y bigramas: línea base sin modelo ni descargas"""
+
+    def __init__(self, dimensions: int = 384):
+        self.dimensions = dimensions
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        vectors = np.zeros((len(input), self.dimensions), dtype="float32")
+        for row, text in enumerate(input):
+            tokens = normalize_text(text).split()
+            for gram in tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]:
+                digest = hashlib.md5(gram.encode("utf-8")).digest()
+                index = int.from_bytes(digest[:4], "little") % self.dimensions
+                vectors[row, index] += 1.0 if digest[4] & 1 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.maximum(norms, 1e-9)).tolist()
+
+
+def load_backend(name: str, model_dir: str = None, threads: int = None, batch_size: int = None):
+    """Función de embedding por nombre de backend"""
+    if name == "hashing":
+        return HashingEmbeddingFunction()
+    if name == "default":
+        from chromadb.utils import embedding_functions
+        return embedding_functions.DefaultEmbeddingFunction()
+    return EmbeddingService(name, model_dir=model_dir, threads=threads, batch_size=batch_size).get_embedding_function()
+
+
+def backend_grid(args) -> List[Dict[str, Any]]:
+    """Combinaciones de backend, hilos y lote (hilos y lote solo aplican a los backends ONNX propios)"""
+    grid = []
+    for backend in args.backends.split(","):
+        if backend in ("hashing", "default"):
+            grid.append({"label": backend, "name": backend})
+            continue
+        for threads, batch_size in itertools.product(
+            [int(t) for t in args.embedding_threads.split(",")],
+            [int(b) for b in args.embedding_batch.split(",")]
+        ):
+            grid.append({"label": f"{backend}/t{threads}/b{batch_size}", "name": backend,
+                         "threads": threads, "batch_size": batch_size})
+    return grid
+
+
+def extract_filters(question: str) -> Optional[Dict[str, Any]]:
+    """Filtro de metadatos de Chroma deducido de la pregunta (cliente, país, fecha, mes y año)"""
+    text = normalize_text(question)
+    conditions = []
+
+    date = re.search(r"\b(\d{1,2})/(\d{1,2})/(\d{4})\b", question)
+    if date:
+        day, month, year = date.groups()
+        conditions.append({"fecha": f"{year}-{int(month):02d}-{int(day):02d}"})
+
+    cliente = re.search(r"\bcliente (\d+)\b", text)
+    if cliente:
+        conditions.append({"cliente": int(cliente.group(1))})
+
+    paises = [code for name, code in PAISES.items() if re.search(rf"\b{name}\b", text)]
+    paises += [code for code in re.findall(r"\b[A-Z]{2}\b", question) if code in PAIS_CODES]
+    if paises:
+        conditions.append({"pais": paises[0]})
+
+    if not date:
+        for number, month in enumerate(MONTHS, start=1):
+            if re.search(rf"\b{month}\b", text):
+                conditions.append({"mes": number})
+                break
+        year = re.search(r"\b(20\d{2})\b", text)
+        if year:
+            conditions.append({"año": int(year.group(1))})
+
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+def _matches(metadata: Dict[str, Any], where: Dict[str, Any]) -> bool:
+    conditions = where.get("$and", [where])
+    return all(metadata.get(key) == value for condition in conditions for key, value in condition.items())
+
+
+def questions_from_file(path: str) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    df = pd.read_csv(data["dataset"])
+    return {"name": "facturas", "df": df, "questions": data["questions"]}
+
+
+def synthetic_questions(rows: int, count: int, seed: int) -> Dict[str, Any]:
+    """Facturas sintéticas con preguntas cuya respuesta se conoce a partir de los datos"""
+    from benchmarks.synthetic import generate_facturas
+
+    raw = generate_facturas(rows, seed=seed, clientes=max(10, rows // 20))
+    # Mismos tipos que tras leer el CSV (cliente numérico)
+    raw["cliente"] = raw["cliente"].astype(int)
+    df = DataProcessor.process_dataframe(raw.copy())
+    rng = np.random.default_rng(seed)
+    questions = []
+
+    for idx in rng.choice(df.index, size=min(count, len(df)), replace=False):
+        row = df.loc[idx]
+        fecha = row["fecha"]
+        if len(questions) % 2 == 0:
+            same = df[(df["cliente"] == row["cliente"]) & (df["fecha"] == fecha)]
+            question = f"¿Qué importe facturó el cliente {row['cliente']} el {fecha.strftime('%d/%m/%Y')}?"
+        else:
+            same = df[(df["cliente"] == row["cliente"]) & (df["mes"] == row["mes"]) & (df["año"] == row["año"])]
+            question = f"Facturas del cliente {row['cliente']} en {MONTHS[row['mes'] - 1]} de {row['año']}"
+        questions.append({"question": question, "expected_ids": [f"factura_{i}" for i in same.index]})
+
+    for question, expected in STATS_QUESTIONS:
+        questions.append({"question": question, "expected_ids": expected})
+    return {"name": f"synthetic_{rows}", "df": raw, "questions": questions}
+
+
+def build_documents(df: pd.DataFrame):
+    return DataProcessor.create_documents(DataProcessor.process_dataframe(df.copy()))
+
+
+def embed_all(embedding_function, texts: List[str]) -> List[List[float]]:
+    # Mismos lotes que RAGRetriever._add_documents
+    batch_size = max(RAGRetriever.BATCH_SIZE, getattr(embedding_function, "batch_size", 0))
+    vectors = []
+    for i in range(0, len(texts), batch_size):
+        vectors.extend(embedding_function(texts[i:i + batch_size]))
+    return vectors
+
+
+def retrieve(collection, question: str, query_embedding, stats_embedding, k: int, mode: str):
+    """Misma lógica que RAGRetriever.query, con el filtro de metadatos según el modo"""
+    where = extract_filters(question) if mode != "none" else None
+    if where and mode == "where":
+        try:
+            results = collection.query(query_embeddings=query_embedding, n_results=k, where=where)
+        except Exception:
+            # Sin resultados que cumplan el filtro
+            results = {"ids": [[]], "documents": [[]]}
+    elif where and mode == "post":
+        results = collection.query(query_embeddings=query_embedding, n_results=k * POST_FILTER_FACTOR, include=["documents", "metadatas"])
+        kept = [(i, d) for i, d, m in zip(results["ids"][0], results["documents"][0], results["metadatas"][0]) if _matches(m, where)][:k]
+        results = {"ids": [[i for i, _ in kept]], "documents": [[d for _, d in kept]]}
+    else:
+        results = collection.query(query_embeddings=query_embedding, n_results=k)
+
+    ids = list(results["ids"][0])
+    documents = list(results["documents"][0])
+    if any(palabra in question.lower() for palabra in RAGRetriever.SUMMARY_KEYWORDS):
+        stats = collection.query(
+            query_embeddings=stats_embedding,
+            where={"tipo": "estadistica"},
+            n_results=RAGRetriever.STATS_RESULTS
+        )
+        for doc_id, doc in zip(stats["ids"][0], stats["documents"][0]):
+            if doc_id not in ids:
+                ids.append(doc_id)
+                documents.append(doc)
+    return ids, documents
+
+
+def score(ids: List[str], expected: List[str], k: int) -> Dict[str, float]:
+    """recall@k normalizado (aciertos / min(k, esperados)) y rango recíproco del primer acierto"""
+    expected_set = set(expected)
+    hits = len(expected_set.intersection(ids))
+    reciprocal_rank = next((1.0 / rank for rank, doc_id in enumerate(ids, start=1) if doc_id in expected_set), 0.0)
+    return {"recall": hits / min(k, len(expected_set)), "rr": reciprocal_rank}
+
+
+def run_configuration(collection, question_set, query_embeddings, stats_embedding, k: int, mode: str) -> Dict[str, Any]:
+    recalls, reciprocal_ranks, tokens, latencies = [], [], [], []
+    for question, query_embedding in zip(question_set["questions"], query_embeddings):
+        start = time.perf_counter()
+        ids, documents = retrieve(collection, question["question"], query_embedding, stats_embedding, k, mode)
+        latencies.append(time.perf_counter() - start)
+        result = score(ids, question["expected_ids"], k)
+        recalls.append(result["recall"])
+        reciprocal_ranks.append(result["rr"])
+        tokens.append(estimate_tokens("\n\n".join(documents)))
+    latency = summarize(latencies)
+    return {
+        "recall_at_k": round(float(np.mean(recalls)), 4),
+        "mrr": round(float(np.mean(reciprocal_ranks)), 4),
+        "context_tokens": round(float(np.mean(tokens)), 1),
+        "latency_p50_ms": latency["p50"],
+        "latency_p99_ms": latency["p99"]
+    }
+
+
+def run(args) -> List[Dict[str, Any]]:
+    import chromadb
+
+    question_sets = []
+    for name in args.questions.split(","):
+        if name == "facturas":
+            question_sets.append(questions_from_file(args.questions_file))
+        elif name == "synthetic":
+            question_sets.append(synthetic_questions(args.synthetic_rows, args.synthetic_questions, args.seed))
+
+    ks = [int(k) for k in args.k.split(",")]
+    modes = [mode for mode in args.filter_modes.split(",") if mode in FILTER_MODES]
+    index_grid = list(itertools.product(
+        args.spaces.split(","),
+        [int(m) for m in args.hnsw_m.split(",")],
+        [int(ef) for ef in args.search_ef.split(",")]
+    ))
+
+    client = chromadb.Client()
+    results = []
+    for question_set in question_sets:
+        documents, metadatas, ids = build_documents(question_set["df"])
+        texts = [question["question"] for question in question_set["questions"]]
+        logger.info(f"{question_set['name']}: {len(documents)} documentos, {len(texts)} preguntas")
+
+        for spec in backend_grid(args):
+            backend = spec["label"]
+            try:
+                embedding_function = load_backend(spec["name"], args.model_dir, spec.get("threads"), spec.get("batch_size"))
+                start = time.perf_counter()
+                document_embeddings = embed_all(embedding_function, documents)
+                index_seconds = time.perf_counter() - start
+                query_latencies = []
+                query_embeddings = []
+                for text in texts:
+                    start = time.perf_counter()
+                    query_embeddings.append(embedding_function([text]))
+                    query_latencies.append(time.perf_counter() - start)
+                stats_embedding = embedding_function([RAGRetriever.STATS_QUERY])
+            except Exception as e:
+                logger.error(f"Backend {backend} no disponible: {type(e).__name__}: {e}")
+                results.append({"questions": question_set["name"], "backend": backend, "error": f"{type(e).__name__}: {e}"})
+                continue
+            embed_p50 = summarize(query_latencies)["p50"]
+
+            for space, hnsw_m, search_ef in index_grid:
+                name = f"bench_{abs(hash((question_set['name'], backend, space, hnsw_m, search_ef))) % 10**8}"
+                try:
+                    client.delete_collection(name)
+                except Exception:
+                    pass
+                collection = client.create_collection(name=name, metadata={
+                    "hnsw:space": space, "hnsw:M": hnsw_m, "hnsw:search_ef": search_ef,
+                    "hnsw:construction_ef": max(100, search_ef)
+                })
+                for i in range(0, len(documents), RAGRetriever.BATCH_SIZE):
+                    end = i + RAGRetriever.BATCH_SIZE
+                    collection.add(documents=documents[i:end], metadatas=metadatas[i:end],
+                                   ids=ids[i:end], embeddings=document_embeddings[i:end])
+
+                for mode, k in itertools.product(modes, ks):
+                    row = {
+                        "questions": question_set["name"], "backend": backend, "space": space,
+                        "hnsw_m": hnsw_m, "search_ef": search_ef, "filter": mode, "k": k,
+                        **run_configuration(collection, question_set, query_embeddings, stats_embedding, k, mode),
+                        "embed_p50_ms": embed_p50,
+                        "index_embed_docs_per_sec": round(len(documents) / max(index_seconds, 1e-9), 1)
+                    }
+                    results.append(row)
+                client.delete_collection(name)
+    return results
+
+
+TABLE_COLUMNS = ("questions", "backend", "space", "hnsw_m", "search_ef", "filter", "k",
+                 "recall_at_k", "mrr", "context_tokens", "latency_p50_ms", "latency_p99_ms", "embed_p50_ms",
+                 "index_embed_docs_per_sec")
+
+
+def format_table(rows: List[Dict[str, Any]]) -> str:
+    """Tabla de texto con una fila por configuración"""
+    rows = [row for row in rows if "error" not in row]
+    widths = {col: max(len(col), *(len(str(row.get(col, ""))) for row in rows)) if rows else len(col) for col in TABLE_COLUMNS}
+    lines = ["  ".join(col.ljust(widths[col]) for col in TABLE_COLUMNS)]
+    for row in rows:
+        lines.append("  ".join(str(row.get(col, "")).ljust(widths[col]) for col in TABLE_COLUMNS))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de calidad y latencia de la recuperación")
+    parser.add_argument("--questions", default="facturas,synthetic", help="Conjuntos de preguntas: facturas y/o synthetic")
+    parser.add_argument("--questions-file", default=QUESTIONS_PATH)
+    parser.add_argument("--synthetic-rows", type=int, default=2000)
+    parser.add_argument("--synthetic-questions", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--k", default="2,4,6,8,12")
+    parser.add_argument("--backends", default="default,hashing",
+                        help="Backends de embeddings separados por comas: hashing, default, onnx, onnx_int8")
+    parser.add_argument("--model-dir", help="Modelo ONNX para onnx/onnx_int8 (por defecto EMBEDDING_MODEL_DIR o all-MiniLM-L6-v2)")
+    parser.add_argument("--embedding-threads", default="0", help="Hilos de onnxruntime (0 = automático)")
+    parser.add_argument("--embedding-batch", default="64", help="Tamaños de lote de inferencia")
+    parser.add_argument("--spaces", default="l2,cosine", help="Distancias HNSW")
+    parser.add_argument("--hnsw-m", default="16")
+    parser.add_argument("--search-ef", default="10,100")
+    parser.add_argument("--filter-modes", default="none,where,post",
+                        help="none: solo vectores; where: filtro de metadatos en Chroma; post: filtrado tras recuperar")
+    parser.add_argument("--output", help="Archivo JSON de resultados (por defecto stdout)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    results = run(args)
+    print(format_table(results))
+
+    parameters = {key: value for key, value in vars(args).items() if key != "output"}
+    report = build_report("retrieval", parameters, results)
+    if args.output:
+        write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
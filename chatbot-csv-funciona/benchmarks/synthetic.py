@@ -0,0 +1,108 @@
+"""Generadores de datos sintéticos con la forma de data/facturas.csv y data/data.csv (Ventas Diarias)."""
+import numpy as np
+import pandas as pd
+
+PAISES = ["ES", "UK", "FR", "DE", "IT", "PT", "EC", "MX"]
+MESES_ABREVIADOS = ["ene", "feb", "mar", "abr", "may", "jun", "jul", "ago", "sep", "oct", "nov", "dic"]
+LOCALES = ["GUASMO", "PENDOLA", "PLAYITA-D", "CRISTO CONSUELO-D", "ESTEROS", "MATERNIDAD",
+           "ESTEROS-D", "PEDREGAL-D", "ESTELA MARIS", "SANTA MONICA", "QUEVEDO-D", "VERGELES"]
+
+
+def generate_facturas(rows: int, seed: int = 0, clientes: int = 1000) -> pd.DataFrame:
+    """Facturas con columnas fecha, cliente, pais, importe"""
+    rng = np.random.default_rng(seed)
+    start = np.datetime64("2020-01-01")
+    days = rng.integers(0, 5 * 365, size=rows)
+    fechas = (start + days.astype("timedelta64[D]")).astype(str)
+    cliente_ids = rng.integers(1, clientes + 1, size=rows)
+    width = len(str(clientes))
+    return pd.DataFrame({
+        "fecha": fechas,
+        "cliente": pd.Series(cliente_ids).astype(str).str.zfill(width),
+        "pais": np.array(PAISES)[rng.integers(0, len(PAISES), size=rows)],
+        "importe": np.round(rng.gamma(2.0, 60.0, size=rows), 2)
+    })
+
+
+def add_duplicates(df: pd.DataFrame, ratio: float, seed: int = 0) -> pd.DataFrame:
+    """Facturas con un periodo exportado de nuevo al final: un tramo de ratio × filas repetido, con
+    el país en minúsculas y con espacios de sobra como en los exportes del POS, y algunas filas
+    repetidas sueltas"""
+    if ratio <= 0 or not len(df):
+        return df
+    rng = np.random.default_rng(seed)
+    count = int(len(df) * ratio)
+    start = int(rng.integers(0, max(1, len(df) - count)))
+    overlap = df.iloc[start:start + count // 2].copy()
+    overlap["pais"] = " " + overlap["pais"].str.lower() + "  "
+    repeated = df.iloc[rng.integers(0, len(df), size=count - len(overlap))]
+    return pd.concat([df, overlap, repeated], ignore_index=True)
+
+
+def _formato_moneda(values: np.ndarray) -> pd.Series:
+    """Formato monetario español de los exportes del POS: $1.559,88"""
+    text = pd.Series(values).map("{:,.2f}".format)
+    return "$" + text.str.replace(",", "_", regex=False).str.replace(".", ",", regex=False).str.replace("_", ".", regex=False)
+
+
+def generate_ventas_diarias(rows: int, seed: int = 0) -> pd.DataFrame:
+    """Ventas Diarias con la estructura horizontal del exporte: el Local solo aparece en la primera
+    fila de cada bloque, fechas "01-mar" sin año y una fila "Total <local>" al final de cada bloque"""
+    rng = np.random.default_rng(seed)
+    days_per_local = 365
+    blocks = max(1, rows // (days_per_local + 1))
+    local_names = [f"{i + 2:03d}-{LOCALES[i % len(LOCALES)]}" for i in range(blocks)]
+
+    day_index = np.tile(np.arange(days_per_local), blocks)[:rows]
+    block_index = np.repeat(np.arange(blocks), days_per_local)[:rows]
+    fechas_dt = np.datetime64("2024-01-01") + day_index.astype("timedelta64[D]")
+    fechas = pd.Series(pd.to_datetime(fechas_dt))
+    fecha_text = fechas.dt.day.map("{:02d}".format) + "-" + fechas.dt.month.map(lambda m: MESES_ABREVIADOS[m - 1])
+
+    base0 = np.round(rng.gamma(9.0, 160.0, size=len(day_index)), 2)
+    base_iva = np.round(base0 * rng.uniform(0.25, 0.5, size=len(day_index)), 2)
+    impuestos = np.round(base_iva * 0.15, 2)
+    venta = base0 + base_iva + impuestos
+    sin_impuestos = venta - impuestos + rng.uniform(-5, 5, size=len(day_index))
+
+    df = pd.DataFrame({
+        "Local": np.where(day_index == 0, np.array(local_names)[block_index], ""),
+        "fecha": fecha_text.values,
+        "Base0": _formato_moneda(base0).values,
+        "Base<>0": _formato_moneda(base_iva).values,
+        "Impuestos": _formato_moneda(impuestos).values,
+        "Venta-Impuesto": _formato_moneda(venta).values,
+        "Suma de total_venta_sinimpuestos": pd.Series(sin_impuestos).map("{:.6f}".format).str.replace(".", ",", regex=False).values
+    })
+
+    # Filas de total por local, como en el exporte original
+    totals = pd.DataFrame({
+        "Local": [f"Total {name}" for name in local_names],
+        "fecha": "",
+        "Base0": _formato_moneda(pd.Series(base0).groupby(block_index).sum().values).values,
+        "Base<>0": _formato_moneda(pd.Series(base_iva).groupby(block_index).sum().values).values,
+        "Impuestos": _formato_moneda(pd.Series(impuestos).groupby(block_index).sum().values).values,
+        "Venta-Impuesto": _formato_moneda(pd.Series(venta).groupby(block_index).sum().values).values,
+        "Suma de total_venta_sinimpuestos": pd.Series(sin_impuestos).groupby(block_index).sum().map("{:.6f}".format).str.replace(".", ",", regex=False).values
+    })
+    df["_orden"] = block_index * 2
+    totals["_orden"] = np.arange(blocks) * 2 + 1
+    df = pd.concat([df, totals], ignore_index=True).sort_values("_orden", kind="stable")
+    return df.drop(columns="_orden").reset_index(drop=True)
+
+
+def write_csv(df: pd.DataFrame, path: str, kind: str):
+    """Escribe el CSV con el separador del archivo original (',' facturas, ';' ventas)"""
+    df.to_csv(path, index=False, sep=";" if kind == "ventas" else ",")
+
+
+def write_xlsx(df: pd.DataFrame, path: str):
+    """Escribe un .xlsx en streaming (openpyxl write_only), con la fecha como celda de fecha"""
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Datos")
+    sheet.append(list(df.columns))
+    frame = df.assign(fecha=pd.to_datetime(df["fecha"])) if "fecha" in df else df
+    for row in frame.itertuples(index=False):
+        sheet.append(list(row))
+    workbook.save(path)
@@ -5,8 +5,80 @@ ENDPOINT = os.getenv("LLM_ENDPOINT", "http://cortex_csv:39281/v1")
 MODEL = os.getenv("LLM_MODEL", "llama3.2:1b")
 API_KEY = "not-needed"
 
-# Configuración de ChromaDB
-COLLECTION_NAME = "facturas_enhanced"
+# Configuración de sesiones de conversación
+SESSION_MAX_TOKENS = int(os.getenv("SESSION_MAX_TOKENS", "1024"))
+SESSION_SUMMARY_MAX_TOKENS = int(os.getenv("SESSION_SUMMARY_MAX_TOKENS", "256"))
+
+# Configuración de ChromaDB: una colección por dataset (inquilino + hash del contenido).
+# Con CHROMA_PATH se guardan en disco y solo los índices usados más recientemente quedan
+# en memoria (LRU dentro de COLLECTIONS_MEMORY_MB); ruta vacía = cliente efímero en memoria
+CHROMA_PATH = os.getenv("CHROMA_PATH", "data/chroma")
+COLLECTIONS_MEMORY_MB = int(os.getenv("COLLECTIONS_MEMORY_MB", "0"))  # 0 = mitad del presupuesto de memoria
+# Varios workers de uvicorn comparten el almacén: un servidor de ChromaDB (CHROMA_SERVER_URL,
+# p. ej. http://chroma:8000) o el mismo CHROMA_PATH, y el catálogo de datasets activos
+CHROMA_SERVER_URL = os.getenv("CHROMA_SERVER_URL", "")
+DATASET_CATALOG_PATH = os.getenv("DATASET_CATALOG_PATH", "data/datasets.sqlite")  # vacío = en memoria (un worker)
+# Almacén de vectores: chroma (índice HNSW en float32) o quantized (códigos int8 en memoria y
+# vectores float32 en disco para reordenar con la distancia exacta los mejores candidatos)
+VECTOR_STORE = os.getenv("VECTOR_STORE", "chroma")
+VECTOR_STORE_PATH = os.getenv("VECTOR_STORE_PATH", "data/vectors")
+VECTOR_RERANK_CANDIDATES = int(os.getenv("VECTOR_RERANK_CANDIDATES", "100"))
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Datasets procesados en formato columnar (Arrow) para leer filas exactas; vacío = desactivado
+TABLE_STORE_PATH = os.getenv("TABLE_STORE_PATH", "data/tables")
+# Cubo de agregados (rollups) calculado en la ingesta: dimensiones, medida y límites
+ROLLUP_DIMENSIONS = os.getenv("ROLLUP_DIMENSIONS", "cliente,pais,año,mes")
+ROLLUP_MEASURE = os.getenv("ROLLUP_MEASURE", "importe")
+ROLLUP_MAX_GROUPS = int(os.getenv("ROLLUP_MAX_GROUPS", "200000"))  # filas de la tabla de rollups
+ROLLUP_MAX_DOCUMENTS = int(os.getenv("ROLLUP_MAX_DOCUMENTS", "2000"))  # documentos de rollup en ChromaDB
+# Granularidad de los documentos de filas: row (uno por fila), group (uno por entidad y periodo,
+# p. ej. cliente,mes o Local,semana; vacío = el de la plantilla) o chunk (bloques de filas consecutivas).
+# Periodos derivados de la fecha: dia, semana, mes y año. DOCUMENT_MAX_ROWS: filas máximas por documento
+DOCUMENT_GRANULARITY = os.getenv("DOCUMENT_GRANULARITY", "row")
+DOCUMENT_GROUP_BY = os.getenv("DOCUMENT_GROUP_BY", "")
+DOCUMENT_MAX_ROWS = int(os.getenv("DOCUMENT_MAX_ROWS", "20"))
+# Filas repetidas antes de crear documentos: off, first (se conserva la primera) o sum (una fila
+# con las medidas sumadas). DEDUP_KEYS: columnas que identifican la fila (vacío = las del dataset).
+# Desactivada por defecto: las facturas no tienen número, y dos distintas con la misma fecha,
+# cliente, país e importe se fundirían sin que nadie lo haya pedido
+DEDUP_MODE = os.getenv("DEDUP_MODE", "off")
+DEDUP_KEYS = os.getenv("DEDUP_KEYS", "")
+
+# Embeddings: default (ONNX de ChromaDB), onnx (modelo ONNX local en float32) u onnx_int8 (cuantizado a int8)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "default")
+# Directorio con model.onnx y tokenizer.json (vacío = all-MiniLM-L6-v2 de ChromaDB), p. ej. un modelo multilingüe
+EMBEDDING_MODEL_DIR = os.getenv("EMBEDDING_MODEL_DIR", "")
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))  # 0 = los que decida onnxruntime
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_MAX_LENGTH = int(os.getenv("EMBEDDING_MAX_LENGTH", "256"))
+# Caché persistente de embeddings por hash(modelo + texto); ruta vacía o 0 MB la desactivan
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "data/cache/embeddings.sqlite")
+EMBEDDING_CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", "512"))
+
+# Configuración de DuckDB (ruta SQL de main_agentia)
+DUCKDB_PATH = os.getenv("DUCKDB_PATH", ":memory:")
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", "200"))
+PLAN_CACHE_SIZE = int(os.getenv("PLAN_CACHE_SIZE", "512"))
+
+# Perfilado bajo demanda y monitor del event loop
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILE_THRESHOLD_MS = float(os.getenv("PROFILE_THRESHOLD_MS", "2000"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "logs/profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "200"))
+
+# Presupuestos de memoria (0 = automático: 80% del límite del contenedor o de la RAM)
+MEMORY_BUDGET_MB = int(os.getenv("MEMORY_BUDGET_MB", "0"))
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "200"))
+INGEST_CHUNK_ROWS = int(os.getenv("INGEST_CHUNK_ROWS", "50000"))
+# Bytes en memoria por byte de CSV durante la ingesta completa (DataFrame + documentos + metadatos)
+INGEST_MEMORY_FACTOR = float(os.getenv("INGEST_MEMORY_FACTOR", "35"))
+
+# Lectura de Excel: los libros se convierten a CSV en streaming, repartiendo los bloques de filas
+# de todas las hojas entre EXCEL_READ_WORKERS procesos (1 = en el propio proceso).
+# EXCEL_SHEETS: "first" lee solo la primera hoja; "matching" añade las hojas con la misma cabecera
+EXCEL_READ_WORKERS = int(os.getenv("EXCEL_READ_WORKERS", str(min(4, os.cpu_count() or 1))))
+EXCEL_SHEETS = os.getenv("EXCEL_SHEETS", "matching")
 
 # Rutas de datos
 DATA_DIR = "data"
@@ -14,13 +86,128 @@ UPLOADS_DIR = f"{DATA_DIR}/uploads"
 PROCESSED_DIR = f"{DATA_DIR}/processed"
 DEFAULT_CSV = f"{DATA_DIR}/facturas.csv"
 
+# Enrutador de consultas: preguntas registradas con la ruta que las respondió
+ROUTER_LOG_PATH = os.getenv("ROUTER_LOG_PATH", f"{DATA_DIR}/router/questions.jsonl")
+
+# Plantillas de Excel: las predefinidas y las creadas desde la API (guardadas en EXCEL_TEMPLATES_PATH).
+# Las columnas clave y de valor son las del archivo; column_mappings da nombres propios a algunas
+# (nombre del sistema: columna del archivo) y column_types fija su tipo (text, number o date).
+EXCEL_TEMPLATES_PATH = os.getenv("EXCEL_TEMPLATES_PATH", "config/templates.json")
+DEFAULT_TEMPLATES = {
+    "Ventas Diarias": {
+        "name": "Ventas Diarias",
+        "description": "Reporte de ventas diarias por local con estructura horizontal",
+        "header_row": 0,
+        "data_start_row": 1,
+        "key_columns": ["Local", "fecha"],
+        "value_columns": ["Base0", "Base<>0", "Impuestos", "Venta-Impuesto", "Suma de total_venta_sinimpuestos"],
+        "column_mappings": {},
+        "column_types": {
+            "Local": "text", "fecha": "date", "Base0": "number", "Base<>0": "number", "Impuestos": "number",
+            "Venta-Impuesto": "number", "Suma de total_venta_sinimpuestos": "number"
+        },
+        # $1.559,88: punto de miles y coma decimal; fechas "01-mar" sin año
+        "decimal": ",",
+        "year": None,
+        "skip_empty_rows": True,
+        "horizontal_data": True,
+        "row_type": "venta",
+        "measure": "Venta-Impuesto",
+        "dimensions": ["Local", "año", "mes"],
+        # Documentos agrupados (DOCUMENT_GRANULARITY=group): uno por local y semana
+        "document_group_by": ["Local", "semana"],
+        "document": (
+            "Ventas del local {Local} el {fecha:%d/%m/%Y}: base 0% {Base0:.2f}, base con IVA {Base<>0:.2f}, "
+            "impuestos {Impuestos:.2f}, venta con impuestos {Venta-Impuesto:.2f} y venta sin impuestos "
+            "{Suma de total_venta_sinimpuestos:.2f}."
+        )
+    },
+    "Inventario": {
+        "name": "Inventario",
+        "description": "Reporte de inventario y stock de productos",
+        "header_row": 0,
+        "data_start_row": 1,
+        "key_columns": ["Codigo", "Producto"],
+        "value_columns": ["Stock", "Costo", "Precio", "Ubicacion"],
+        "column_mappings": {},
+        "column_types": {
+            "Codigo": "text", "Producto": "text", "Stock": "number", "Costo": "number", "Precio": "number",
+            "Ubicacion": "text"
+        },
+        "decimal": ".",
+        "skip_empty_rows": True,
+        "horizontal_data": False,
+        "row_type": "producto",
+        "measure": "Stock",
+        "dimensions": ["Ubicacion"],
+        "document": (
+            "Producto {Producto} (código {Codigo}): stock {Stock:.0f} unidades, costo {Costo:.2f}, "
+            "precio {Precio:.2f}, ubicación {Ubicacion}."
+        )
+    },
+    "Facturas": {
+        "name": "Facturas",
+        "description": "Registros de facturas y transacciones",
+        "header_row": 0,
+        "data_start_row": 1,
+        "key_columns": ["fecha", "cliente"],
+        "value_columns": ["importe", "pais"],
+        "column_mappings": {},
+        # Usa la ingesta propia de facturas (estadísticas combinables y anexos)
+        "pipeline": "facturas"
+    }
+}
+
 # Configuración global disponible para importar
 settings = {
     "endpoint": ENDPOINT,
     "model": MODEL,
     "api_key": API_KEY,
-    "collection_name": COLLECTION_NAME,
+    "chroma_path": CHROMA_PATH,
+    "collections_memory_mb": COLLECTIONS_MEMORY_MB,
+    "chroma_server_url": CHROMA_SERVER_URL,
+    "dataset_catalog_path": DATASET_CATALOG_PATH,
+    "vector_store": VECTOR_STORE,
+    "vector_store_path": VECTOR_STORE_PATH,
+    "vector_rerank_candidates": VECTOR_RERANK_CANDIDATES,
+    "workers": WORKERS,
+    "table_store_path": TABLE_STORE_PATH,
+    "rollup_dimensions": ROLLUP_DIMENSIONS,
+    "rollup_measure": ROLLUP_MEASURE,
+    "rollup_max_groups": ROLLUP_MAX_GROUPS,
+    "rollup_max_documents": ROLLUP_MAX_DOCUMENTS,
+    "document_granularity": DOCUMENT_GRANULARITY,
+    "document_group_by": DOCUMENT_GROUP_BY,
+    "document_max_rows": DOCUMENT_MAX_ROWS,
+    "dedup_mode": DEDUP_MODE,
+    "dedup_keys": DEDUP_KEYS,
+    "embedding_backend": EMBEDDING_BACKEND,
+    "embedding_model_dir": EMBEDDING_MODEL_DIR,
+    "embedding_threads": EMBEDDING_THREADS,
+    "embedding_batch_size": EMBEDDING_BATCH_SIZE,
+    "embedding_max_length": EMBEDDING_MAX_LENGTH,
+    "embedding_cache_path": EMBEDDING_CACHE_PATH,
+    "embedding_cache_max_mb": EMBEDDING_CACHE_MAX_MB,
     "uploads_dir": UPLOADS_DIR,
     "processed_dir": PROCESSED_DIR,
-    "default_csv": DEFAULT_CSV
+    "default_csv": DEFAULT_CSV,
+    "session_max_tokens": SESSION_MAX_TOKENS,
+    "session_summary_max_tokens": SESSION_SUMMARY_MAX_TOKENS,
+    "duckdb_path": DUCKDB_PATH,
+    "sql_max_rows": SQL_MAX_ROWS,
+    "plan_cache_size": PLAN_CACHE_SIZE,
+    "router_log_path": ROUTER_LOG_PATH,
+    "excel_templates_path": EXCEL_TEMPLATES_PATH,
+    "default_templates": DEFAULT_TEMPLATES,
+    "profiling_enabled": PROFILING_ENABLED,
+    "profile_threshold_ms": PROFILE_THRESHOLD_MS,
+    "profile_dir": PROFILE_DIR,
+    "profile_max_files": PROFILE_MAX_FILES,
+    "loop_lag_threshold_ms": LOOP_LAG_THRESHOLD_MS,
+    "memory_budget_mb": MEMORY_BUDGET_MB,
+    "max_upload_mb": MAX_UPLOAD_MB,
+    "ingest_chunk_rows": INGEST_CHUNK_ROWS,
+    "excel_read_workers": EXCEL_READ_WORKERS,
+    "excel_sheets": EXCEL_SHEETS,
+    "ingest_memory_factor": INGEST_MEMORY_FACTOR
 }
\ No newline at end of file
@@ -1,3 +1,4 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
@@ -6,66 +7,141 @@ import uvicorn
 import logging
 import os
 
-# Importar servicios y módulos
-from services.llm_service import LLMService
-from rag.retriever import RAGRetriever
+# Importar servicios y módulos (los pesados, chromadb/pandas/openai, se importan al inicializar)
+from services.app_state import app_state
+from rag.vector_store import supports_workers
+from services.session_service import SessionService
+from api.admin import router as admin_router
+from api.health import router as health_router
+from api.routes import router as routes_router
 from config import settings
+from utils.logger import setup_logger
+from utils.metrics import REQUESTS_TOTAL, new_request_id, span
+from utils.profiler import loop_monitor, request_profiler
 
-# Configuración de logs
-logging.basicConfig(level=logging.INFO)
+# Configuración de logs (con request_id en cada línea)
+setup_logger()
 logger = logging.getLogger(__name__)
 
 # Crear directorios necesarios
 os.makedirs("data/uploads", exist_ok=True)
 os.makedirs("data/processed", exist_ok=True)
 
-# Inicializar servicios
-llm_service = LLMService()
-rag_retriever = RAGRetriever()
+# Servicios ligeros
+session_service = SessionService()
 
-# Inicializar colección con datos predeterminados
-try:
-    rag_retriever.initialize_collection("data/facturas.csv")
-except Exception as e:
-    logger.error(f"Error inicializando colección: {str(e)}")
+def build_llm_service():
+    from services.llm_service import LLMService
+    return LLMService()
 
+def build_rag_retriever():
+    from rag.retriever import RAGRetriever
+    return RAGRetriever()
 
+def load_index(rag_retriever):
+    """Inicializar colección con datos predeterminados"""
+    if not rag_retriever.initialize_collection(settings["default_csv"]):
+        raise RuntimeError(rag_retriever.last_error or "No se pudo cargar el índice")
 
+async def initialize_services():
+    """Carga en segundo plano los servicios pesados y el índice"""
+    await app_state.load("llm_service", build_llm_service)
+    rag_retriever = await app_state.load("rag_retriever", build_rag_retriever)
+    if rag_retriever is not None:
+        await app_state.load("index", load_index, rag_retriever)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Detecta llamadas que bloquean el event loop
+    loop_monitor.start()
+    # El puerto se abre sin esperar al índice; /health/ready informa de cuándo está listo
+    app_state.expect("llm_service", "rag_retriever", "index")
+    app_state.start_background(initialize_services())
+    yield
+    await app_state.shutdown()
+    loop_monitor.stop()
 
 # Aplicación FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
+app.include_router(admin_router)
+app.include_router(health_router)
 
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
     return RedirectResponse("/static/index.html")
 
+# Subida de datasets (inquilinos, anexos, plantillas, Excel); después de "/" para que prevalezca la redirección
+app.include_router(routes_router)
+
 @app.websocket("/init")
 async def init(websocket: WebSocket):
     await websocket.accept()
+    # Inquilino y dataset de la sesión (?tenant=...&dataset_id=...)
+    session = session_service.create_session(
+        tenant=websocket.query_params.get("tenant"),
+        dataset_id=websocket.query_params.get("dataset_id")
+    )
     try:
         while True:
-            data = await websocket.receive_json()
+            try:
+                data = await websocket.receive_json()
+            except ValueError:
+                # JSON no válido: process_messages lo rechaza como mensaje mal formado
+                data = None
             await websocket.send_json({"action": "init_system_response"})
-            await process_messages(data, websocket)
+            await process_messages(data, websocket, session)
             await websocket.send_json({"action": "finish_system_response"})
     except (WebSocketDisconnect, ConnectionClosed):
         logger.info("Conexión cerrada")
+    finally:
+        session_service.close_session(session.session_id)
 
-async def process_messages(messages, websocket):
-    # Obtener consulta del usuario
-    user_query = messages[-1]["content"]
-    
-    # Consultar RAG para obtener contexto
-    rag_result = await rag_retriever.query(user_query)
-    
-    # Generar respuesta con LLM
-    await llm_service.generate_response(
-        context=rag_result["context"],
-        query=user_query,
-        websocket=websocket
-    )
+async def process_messages(data, websocket, session):
+    new_request_id()
+    # Un mensaje mal formado se responde con un aviso sin cerrar la conexión
+    try:
+        user_query = SessionService.extract_user_message(data)
+    except ValueError as e:
+        logger.warning(f"Mensaje del cliente no válido: {str(e)}")
+        await websocket.send_json({"action": "append_system_response", "content": f"Mensaje no válido: {str(e)}"})
+        REQUESTS_TOTAL.inc(kind="chat", status="invalid")
+        return
+    if not app_state.is_ready():
+        await websocket.send_json({"action": "append_system_response", "content": app_state.not_ready_message()})
+        REQUESTS_TOTAL.inc(kind="chat", status="not_ready")
+        return
+    llm_service = app_state.get("llm_service")
+    rag_retriever = app_state.get("rag_retriever")
+    try:
+        with request_profiler.profile("chat", session_id=session.session_id):
+            with span("request", kind="chat", session_id=session.session_id) as attributes:
+                SessionService.bind_dataset(data, session)
+                session.add_message("user", user_query)
+                
+                # Consultar RAG sobre el dataset de la sesión para obtener contexto
+                rag_result = await rag_retriever.query(user_query, dataset_id=session.dataset_id, tenant=session.tenant)
+                
+                # Generar respuesta con LLM usando el historial acotado de la sesión
+                response_text = await llm_service.generate_response(
+                    context=rag_result["context"],
+                    query=user_query,
+                    websocket=websocket,
+                    history=session.render_history()
+                )
+                session.add_message("assistant", response_text)
+                attributes["response_chars"] = len(response_text)
+    except Exception:
+        REQUESTS_TOTAL.inc(kind="chat", status="error")
+        raise
+    REQUESTS_TOTAL.inc(kind="chat", status="ok")
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    workers = settings["workers"]
+    if workers > 1 and not supports_workers():
+        logger.warning("WORKERS > 1 necesita un almacén que relea las escrituras de otros procesos "
+                       "(CHROMA_SERVER_URL o VECTOR_STORE=quantized, y DATASET_CATALOG_PATH): "
+                       "se arranca un solo worker")
+        workers = 1
+    # Con varios workers uvicorn importa la aplicación en cada proceso
+    uvicorn.run("main:app" if workers > 1 else app, host="0.0.0.0", port=8000, workers=workers)
\ No newline at end of file
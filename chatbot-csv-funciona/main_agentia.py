@@ -1,13 +1,20 @@
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
-from openai import AsyncOpenAI, OpenAI
+from openai import AsyncOpenAI
 from websockets.exceptions import ConnectionClosed
 
-import duckdb
+import asyncio
+import os
 import uvicorn
 
-ENDPOINT = "http://127.0.0.1:39281/v1"
+from config import settings
+from services.duckdb_service import DuckDBService
+from services.plan_cache import PlanCache
+from services.query_router import QueryRouter, ROUTE_AGGREGATION, ROUTE_RAG
+from services.session_service import SessionService
+
+ENDPOINT = os.getenv("LLM_ENDPOINT", "http://127.0.0.1:39281/v1")
 #MODEL = "phi-3.5:3b-gguf-q4-km"
 #MODEL = "llama3.2:3b-gguf-q4-km"
 MODEL = "deepseek-r1-distill-qwen-14b:14b-gguf-q4-km"
@@ -17,10 +24,31 @@ client = AsyncOpenAI(
     api_key="not-needed"
 )
 
-client2 = OpenAI(
-    base_url=ENDPOINT,
-    api_key="not-needed"
-)
+session_service = SessionService()
+
+# Conexión DuckDB de larga duración con el dataset cargado una sola vez
+duckdb_service = DuckDBService()
+duckdb_service.load_csv( settings["default_csv"], table="facturas" )
+
+# Preguntas normalizadas -> SQL validado (se invalida si cambia el esquema)
+plan_cache = PlanCache()
+
+# Enrutador local: decide la ruta de cada pregunta sin una llamada previa al LLM
+query_router = QueryRouter()
+
+AGGREGATION_FUNCTIONS = {
+    "sum": "SUM(importe)",
+    "avg": "AVG(importe)",
+    "max": "MAX(importe)",
+    "min": "MIN(importe)",
+    "count": "COUNT(*)"
+}
+
+GROUP_EXPRESSIONS = {
+    "cliente": "cliente",
+    "pais": "pais",
+    "mes": "strftime(fecha, '%Y-%m')"
+}
 
 app = FastAPI()
 
@@ -33,52 +61,117 @@ async def root( request: Request ):
 @app.websocket("/init")
 async def init( websocket: WebSocket ):
     await websocket.accept()
+    session = session_service.create_session()
     
     try:
         while True:
-            data = await websocket.receive_json()
+            try:
+                data = await websocket.receive_json()
+            except ValueError:
+                # JSON no válido: plan_messages lo rechaza como mensaje mal formado
+                data = None
 
             await websocket.send_json( { "action": "init_system_response" } )
-            response = await plan_messages( data, websocket )
+            response = await plan_messages( data, websocket, session )
             await websocket.send_json( { "action": "finish_system_response" } )
     except (WebSocketDisconnect, ConnectionClosed):
         print( "Conexión cerrada" )
+    finally:
+        session_service.close_session( session.session_id )
 
-async def plan_messages( messages, websocket ):
+async def plan_messages( data, websocket, session ):
+    # El cliente solo envía el mensaje nuevo; el historial vive en la sesión
+    try:
+        user_query = SessionService.extract_user_message( data )
+    except ValueError as e:
+        # Un mensaje mal formado se responde con un aviso sin cerrar la conexión
+        await websocket.send_json( { "action": "append_system_response", "content": f"Mensaje no válido: {str(e)}" } )
+        return
+    session.add_message( "user", user_query )
+
+    # Recarga la tabla si el CSV se ha actualizado (p. ej. tras una subida); en un hilo, para que
+    # la recarga de un CSV grande no bloquee al resto de conexiones
+    await asyncio.to_thread( duckdb_service.refresh_if_changed )
+
+    decision = query_router.route( user_query )
+
+    # Solo se registran para reentrenar el enrutador las rutas que confirma el LLM
+    generated = False
+    if decision["route"] == ROUTE_RAG:
+        return await process_messages( session, websocket )
+
+    if decision["route"] == ROUTE_AGGREGATION:
+        # Agregaciones simples: SQL construido localmente, sin LLM
+        r = aggregation_sql( decision )
+    else:
+        # Las preguntas repetidas reutilizan el SQL validado sin pasar por el LLM
+        r = plan_cache.get( user_query, duckdb_service.schema_fingerprint )
+        if r is None:
+            r = await generate_sql( user_query )
+            generated = True
+
+    if not r.startswith("No"):
+        await websocket.send_json( { "action": "append_system_response", "content": r } )
+        try:
+            rows = await duckdb_service.query( r )
+        except Exception as e:
+            print( f"Error ejecutando SQL: {e}" )
+            return await process_messages( session, websocket )
+        result = DuckDBService.format_result( rows )
+
+        # Solo se reutilizan los planes que devuelven datos: uno que se ejecuta pero no encuentra
+        # nada (filtro mal escrito, SUM sobre cero filas) se vuelve a generar la próxima vez
+        if decision["route"] != ROUTE_AGGREGATION and DuckDBService.has_values( rows ):
+            plan_cache.put( user_query, r, duckdb_service.schema_fingerprint )
+        if generated:
+            query_router.log_decision( user_query, decision["route"] )
+        await websocket.send_json( { "action": "append_system_response", "content": "\n\n<b>Resultado: </b>" + result } )
+        session.add_message( "assistant", r + "\n\nResultado: " + result )
+
+        return
+
+    if generated:
+        query_router.log_decision( user_query, ROUTE_RAG )
+    return await process_messages( session, websocket )
+
+def aggregation_sql( decision ):
+    # "¿Cuántos clientes hay?" cuenta clientes distintos, no facturas por cliente
+    if decision.get( "distinct" ):
+        value = f"COUNT(DISTINCT {GROUP_EXPRESSIONS[ decision['distinct'] ]})"
+    else:
+        value = AGGREGATION_FUNCTIONS[ decision["metric"] ]
+    group = decision["group_by"]
+    if not group:
+        return f"SELECT {value} AS valor FROM facturas"
+
+    order = "ASC" if decision["metric"] == "min" else "DESC"
+    return f"SELECT {GROUP_EXPRESSIONS[ group ]} AS {group}, {value} AS valor FROM facturas GROUP BY 1 ORDER BY valor {order}"
+
+async def generate_sql( user_query ):
     pmsg = [ 
         { "role": "system", "content": """
         Responde solo 'No' en caso de no ser posible responder con los datos de la tabla.
         Responde solo 'No' en caso de pedir información de empresas que no sean Lostsys.
         Responde solo la sentencia SQL para la base de datos DuckDB a ejecutar en caso de poder obtener los datos de la tabla.
         Responde siempre Sin explicación, Sin notas, Sin delimitaciones.
-        Disponemos de una tabla de base de datos llamada 'facturas' que contiene estos campos: 'fecha' del tipo VARCHAR usando el formato de fecha 'YYYY-MM-DD', 'cliente' tipo INTEGER que contiene el id de cliente, 'pais' tipo VARCHAR que contiene 'ES' como España y 'UK' como reino unido, 'importe' con el total de la factura. 
+        Disponemos de una tabla de base de datos llamada 'facturas' que contiene estos campos: 'fecha' del tipo DATE, 'cliente' tipo INTEGER que contiene el id de cliente, 'pais' tipo VARCHAR que contiene 'ES' como España y 'UK' como reino unido, 'importe' con el total de la factura. 
         No puedes suponer nada ni usar otras tablas o datos que no sean los de la tabla 'facturas'.
-        Para filtrar por el campo fecha usa siempre 'LIKE', nunca utilices funciones de fecha como YEAR, MONTH, EXTRACT.
+        Para filtrar por el campo fecha compáralo con fechas, nunca uses 'LIKE': por ejemplo fecha BETWEEN DATE '2024-03-01' AND DATE '2024-03-31', EXTRACT(YEAR FROM fecha) = 2024 o date_trunc('month', fecha) = DATE '2024-03-01'.
         """ },
-        { "role": "user", "content": messages[ -1 ]["content"] }         
+        { "role": "user", "content": user_query }         
     ]
 
-    response = client2.chat.completions.create(
-        top_p=0.9,
-        temperature=0.9,
+    # Llamada asíncrona: la generación de SQL no bloquea el resto de conexiones.
+    # Temperatura 0: el plan se guarda en caché y se repite, no debe depender del muestreo
+    response = await client.chat.completions.create(
+        temperature=0,
         model=MODEL,
         messages=pmsg,
     )
 
     r = response.choices[0].message.content
     print( r )
-    r = clean_sql( r )
-
-    if not r.startswith("No"):
-        await websocket.send_json( { "action": "append_system_response", "content": r } )
-        await websocket.send_json( { "action": "append_system_response", "content": "\n\n<b>Resultado: </b>" + execute__query( r ) } )
-
-        return
-
-    return await process_messages( messages, websocket )
-
-def execute__query( sql ):
-    return str( duckdb.sql( sql ).fetchall() )
+    return clean_sql( r )
 
 def clean_sql( sql ):
     if sql.find("<|end_of_text|>") != -1: sql = sql[sql.find("<|end_of_text|>")+15:]
@@ -90,15 +183,13 @@ def clean_sql( sql ):
     if sql.startswith("```"): sql = sql[3:]
     if sql.endswith("```"): sql = sql[:len(sql)-3]
     if sql.find("```") != -1: sql = sql[sql.find("```"):]
-    sql = sql.replace( "FROM facturas", "FROM './facturas.csv'" )
-    sql = sql.replace( "fecha", "CAST(fecha AS VARCHAR)" )
     
     return sql
 
 
-async def process_messages( messages, websocket ):
+async def process_messages( session, websocket ):
     completion_payload = {
-        "messages": messages
+        "messages": session.get_messages()
     }
 
     response = await client.chat.completions.create(
@@ -116,8 +207,10 @@ async def process_messages( messages, websocket ):
             not chunk.choices[0].delta.content):
           continue
 
+        respStr += chunk.choices[0].delta.content
         await websocket.send_json( { "action": "append_system_response", "content": chunk.choices[0].delta.content } )
 
+    session.add_message( "assistant", respStr )
     return respStr
 
 
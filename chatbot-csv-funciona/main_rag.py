@@ -6,9 +6,12 @@ from websockets.exceptions import ConnectionClosed
 
 import chromadb
 import json
+import os
 import uvicorn
 
-ENDPOINT = "http://127.0.0.1:39281/v1"
+from services.session_service import SessionService
+
+ENDPOINT = os.getenv("LLM_ENDPOINT", "http://127.0.0.1:39281/v1")
 #MODEL = "phi-3.5:3b-gguf-q4-km"
 #MODEL = "deepseek-r1-distill-qwen-14b:14b-gguf-q4-km"
 MODEL = "llama3.2:3b-gguf-q4-km"
@@ -36,6 +39,8 @@ Eres un asistente de la empresa Lostsys que ayuda a sus clientes a encontrar el
 - Explica al cliente cosas relacionadas con en la siguiente lista JSON: """
 
 
+session_service = SessionService()
+
 client = AsyncOpenAI(
     base_url=ENDPOINT,
     api_key="not-needed"
@@ -52,25 +57,32 @@ async def root( request: Request ):
 @app.websocket("/init")
 async def init( websocket: WebSocket ):
     await websocket.accept()
+    session = session_service.create_session()
     
     try:
         while True:
             data = await websocket.receive_json()
 
             await websocket.send_json( { "action": "init_system_response" } )
-            response = await process_messages( data, websocket )
+            response = await process_messages( data, websocket, session )
             await websocket.send_json( { "action": "finish_system_response" } )
     except (WebSocketDisconnect, ConnectionClosed):
         print( "Conexión cerrada" )
+    finally:
+        session_service.close_session( session.session_id )
 
-async def process_messages( messages, websocket ):
+async def process_messages( data, websocket, session ):
+    # El cliente solo envía el mensaje nuevo; el historial vive en la sesión
+    user_query = SessionService.extract_user_message( data )
+    session.add_message( "user", user_query )
 
     results = collection.query(
-        query_texts=[ messages[ -1 ]["content"] ], 
+        query_texts=[ user_query ], 
         n_results=2 
     )
 
     pmsg = [ { "role": "system", "content": system_prompt + str( results["documents"][0] ) } ]
+    messages = session.get_messages()
     print( json.dumps( pmsg + messages, indent=4) )
     completion_payload = {
         "messages": pmsg + messages
@@ -91,8 +103,10 @@ async def process_messages( messages, websocket ):
             not chunk.choices[0].delta.content):
           continue
 
+        respStr += chunk.choices[0].delta.content
         await websocket.send_json( { "action": "append_system_response", "content": chunk.choices[0].delta.content } )
 
+    session.add_message( "assistant", respStr )
     return respStr
 
 
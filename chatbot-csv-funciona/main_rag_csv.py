@@ -1,17 +1,26 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
-from openai import AsyncOpenAI
 from websockets.exceptions import ConnectionClosed
 
-import chromadb
 import json
 import uvicorn
 import logging
-import pandas as pd
 from datetime import datetime
 import os
-from typing import List, Dict, Any
+from typing import TYPE_CHECKING, List, Dict, Any
+
+from services.session_service import SessionService
+from services.app_state import app_state
+from api.admin import router as admin_router
+from api.health import router as health_router
+from utils.metrics import REQUESTS_TOTAL, new_request_id, span
+from utils.profiler import loop_monitor, request_profiler
+
+# chromadb, pandas y openai se importan al inicializar en segundo plano (arranque rápido)
+if TYPE_CHECKING:
+    import pandas as pd
 
 # Configuración de logs
 logging.basicConfig(
@@ -21,23 +30,26 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Configuraciones
-ENDPOINT = "http://cortex_csv:39281/v1"
+ENDPOINT = os.getenv("LLM_ENDPOINT", "http://cortex_csv:39281/v1")
 MODEL = "llama3.2:1b"
 CSV_PATH = "data/facturas.csv"
 COLLECTION_NAME = "facturas_enhanced"
 USE_SIMPLE_MODE = False  # Cambiar a True para usar el modo simple
 
 # Cliente OpenAI (adaptado a servidor local de Cortex)
-ai_client = AsyncOpenAI(
-    base_url=ENDPOINT,
-    api_key="not-needed"
-)
+def build_ai_client():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(
+        base_url=ENDPOINT,
+        api_key="not-needed"
+    )
     
 
 # Sistema RAG simple
 def setup_simple_rag():
     """Configura el sistema RAG simple con documentos predefinidos"""
-    client = chromadb.Client()
+    from rag.vector_store import get_client
+    client = get_client()
     
     # Eliminar colección si existe
     try:
@@ -73,15 +85,20 @@ Eres un asistente de la empresa Lostsys que ayuda a sus clientes a encontrar el
 
 class EnhancedRAGSystem:
     def __init__(self, csv_path: str):
+        from rag.vector_store import get_client
         self.csv_path = csv_path
-        self.chroma_client = chromadb.Client()
+        # Mismo cliente (persistente o efímero según CHROMA_PATH) que /admin/memory
+        self.chroma_client = get_client()
+        # Último error de carga, para informar del estado en /health/ready
+        self.last_error = None
 
         logger.info(f"que tiene {self.chroma_client} chroma")
         self._setup_collection()
-        logger.info(f"que tiene {self._setup_collection()} coleccion")
+        logger.info(f"que tiene {self.collection} coleccion")
         
-    def _process_data(self, df: pd.DataFrame):
+    def _process_data(self, df: "pd.DataFrame"):
         """Procesa y limpia el DataFrame para mejorar la calidad de los datos"""
+        import pandas as pd
         try:
             # Convertir tipos de datos
             df["fecha"] = pd.to_datetime(df["fecha"], errors="coerce")
@@ -99,7 +116,7 @@ class EnhancedRAGSystem:
             logger.error(f"Error procesando datos: {str(e)}")
             return df
         
-    def _create_documents(self, df: pd.DataFrame):
+    def _create_documents(self, df: "pd.DataFrame"):
         """Crea documentos enriquecidos con información detallada de las facturas"""
         documents = []
         metadatas = []
@@ -179,6 +196,7 @@ class EnhancedRAGSystem:
         
     def _setup_collection(self):
         """Configura la colección de ChromaDB y carga los datos"""
+        import pandas as pd
         try:
             # Eliminar colección si existe
             try:
@@ -224,6 +242,7 @@ class EnhancedRAGSystem:
             
         except Exception as e:
             logger.error(f"Error configurando la colección: {str(e)}")
+            self.last_error = str(e)
             # Crear colección de respaldo con mensaje de error
             self.collection = self.chroma_client.create_collection(name=COLLECTION_NAME)
             self.collection.add(
@@ -272,19 +291,45 @@ class EnhancedRAGSystem:
             }
 
 # Inicializar sistema según el modo seleccionado
-if USE_SIMPLE_MODE:
-    logger.info("Inicializando en modo simple")
-    simple_client, simple_collection = setup_simple_rag()
-    rag_system = None
-else:
-    logger.info("Inicializando en modo avanzado")
-    rag_system = EnhancedRAGSystem(csv_path=CSV_PATH)
-    simple_client = None
-    simple_collection = None
+def check_rag_system(rag_system):
+    """La colección de respaldo con el mensaje de error no cuenta como lista"""
+    if rag_system.last_error:
+        raise RuntimeError(rag_system.last_error)
+
+async def initialize_services():
+    """Carga en segundo plano el cliente del modelo y la colección"""
+    await app_state.load("ai_client", build_ai_client)
+    if USE_SIMPLE_MODE:
+        logger.info("Inicializando en modo simple")
+        await app_state.load("simple_rag", setup_simple_rag)
+    else:
+        logger.info("Inicializando en modo avanzado")
+        rag_system = await app_state.load("rag_system", EnhancedRAGSystem, CSV_PATH)
+        if rag_system is not None:
+            await app_state.load("index", check_rag_system, rag_system)
+
+# Sesiones de conversación (una por websocket)
+session_service = SessionService()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Detecta llamadas que bloquean el event loop
+    loop_monitor.start()
+    # El puerto se abre sin esperar a la colección; /health/ready informa de cuándo está lista
+    if USE_SIMPLE_MODE:
+        app_state.expect("ai_client", "simple_rag")
+    else:
+        app_state.expect("ai_client", "rag_system", "index")
+    app_state.start_background(initialize_services())
+    yield
+    await app_state.shutdown()
+    loop_monitor.stop()
 
 # Aplicación FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
+app.include_router(admin_router)
+app.include_router(health_router)
 
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
@@ -295,11 +340,25 @@ async def root(request: Request):
 @app.websocket("/init")
 async def init(websocket: WebSocket):
     await websocket.accept()
+    session = session_service.create_session()
     try:
         while True:
             data = await websocket.receive_json()
             await websocket.send_json({"action": "init_system_response"})
-            await process_messages(data, websocket)
+            new_request_id()
+            if not app_state.is_ready():
+                await websocket.send_json({"action": "append_system_response", "content": app_state.not_ready_message()})
+                await websocket.send_json({"action": "finish_system_response"})
+                REQUESTS_TOTAL.inc(kind="chat", status="not_ready")
+                continue
+            try:
+                with request_profiler.profile("chat", session_id=session.session_id):
+                    with span("request", kind="chat", session_id=session.session_id):
+                        await process_messages(data, websocket, session)
+            except Exception:
+                REQUESTS_TOTAL.inc(kind="chat", status="error")
+                raise
+            REQUESTS_TOTAL.inc(kind="chat", status="ok")
             await websocket.send_json({"action": "finish_system_response"})
     except (WebSocketDisconnect, ConnectionClosed):
         logging.info("Conexión cerrada")
@@ -312,13 +371,20 @@ async def init(websocket: WebSocket):
             })
         except:
             pass
+    finally:
+        session_service.close_session(session.session_id)
+
+async def process_messages(data, websocket, session):
+    # El cliente solo envía el mensaje nuevo; el historial vive en la sesión
+    user_query = SessionService.extract_user_message(data)
+    session.add_message("user", user_query)
+    ai_client = app_state.get("ai_client")
 
-async def process_messages(messages, websocket):
     if USE_SIMPLE_MODE:
         # Modo simple (empresa Lostsys)
-        user_query = messages[-1]["content"]
         
         # Consulta a ChromaDB
+        simple_client, simple_collection = app_state.get("simple_rag")
         results = simple_collection.query(
             query_texts=[user_query],
             n_results=2
@@ -327,7 +393,7 @@ async def process_messages(messages, websocket):
         # Crear mensaje del sistema
         pmsg = [{"role": "system", "content": simple_system_prompt + str(results["documents"][0])}]
         completion_payload = {
-            "messages": pmsg + messages
+            "messages": pmsg + session.get_messages()
         }
         
         # Solicitud al modelo
@@ -340,10 +406,8 @@ async def process_messages(messages, websocket):
         )
     else:
         # Modo avanzado (análisis de facturas)
-        user_query = messages[-1]["content"]
-        
         # Consultar RAG
-        rag_result = await rag_system.query(user_query)
+        rag_result = await app_state.get("rag_system").query(user_query)
         
         # Crear prompt con instrucciones detalladas
         system_prompt = f"""
@@ -361,6 +425,10 @@ async def process_messages(messages, websocket):
         {rag_result["context"]}
         [FIN CONTEXTO]
         
+        [HISTORIAL]
+        {session.render_history()}
+        [FIN HISTORIAL]
+        
         [PREGUNTA]
         {user_query}
         [FIN PREGUNTA]
@@ -382,16 +450,20 @@ async def process_messages(messages, websocket):
         )
     
     # Streaming hacia el frontend (común para ambos modos)
+    response_text = ""
     async for chunk in response:
         if (not chunk.choices[0] or
             not chunk.choices[0].delta or
             not chunk.choices[0].delta.content):
             continue
 
+        response_text += chunk.choices[0].delta.content
         await websocket.send_json({
             "action": "append_system_response",
             "content": chunk.choices[0].delta.content
         })
 
+    session.add_message("assistant", response_text)
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,319 @@
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from rag.vector_store import index_bytes_per_document, store_lock
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TENANT = "default"
+COLLECTION_PREFIX = "ds_"
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def file_hashes(path: str, *salts: str) -> List[str]:
+    """Un hash del contenido del archivo por cada salt, leyéndolo una sola vez"""
+    digests = []
+    for salt in salts:
+        digest = hashlib.blake2b(digest_size=8)
+        if salt:
+            digest.update(salt.encode("utf-8"))
+        digests.append(digest)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            for digest in digests:
+                digest.update(block)
+    return [digest.hexdigest() for digest in digests]
+
+
+def file_hash(path: str, salt: str = "") -> str:
+    """Identificador del dataset: hash del contenido del archivo (y de salt, p. ej. la granularidad de sus documentos)"""
+    return file_hashes(path, salt)[0]
+
+
+def tenant_slug(tenant: Optional[str]) -> str:
+    slug = re.sub(r"[^a-z0-9]+", "-", (tenant or "").lower()).strip("-")
+    return slug[:32] or DEFAULT_TENANT
+
+
+def collection_name(tenant: str, dataset_id: str) -> str:
+    return f"{COLLECTION_PREFIX}{tenant_slug(tenant)}_{dataset_id}"
+
+
+class DatasetCatalog:
+    """Dataset activo de cada inquilino y sello de versión, en SQLite compartido por los workers.
+
+    Cada cambio (dataset nuevo, activación o borrado) incrementa la versión en la misma
+    transacción. También recuerda qué dataset se indexó por última vez a partir de cada
+    contenido de archivo, para que DuckDB encuentre la tabla columnar de un CSV aunque el
+    dataset_id incluya las opciones de la ingesta. Sin ruta el catálogo vive en memoria y
+    solo sirve a un proceso."""
+
+    def __init__(self, path: str = None):
+        self.path = path or ":memory:"
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS active ("
+                "tenant TEXT PRIMARY KEY, dataset_id TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sources ("
+                "tenant TEXT NOT NULL, source_hash TEXT NOT NULL, dataset_id TEXT NOT NULL, updated_at REAL NOT NULL, "
+                "PRIMARY KEY (tenant, source_hash))"
+            )
+            connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            connection.execute("INSERT OR IGNORE INTO state (key, value) VALUES ('version', 0)")
+            self._connection = connection
+        return self._connection
+
+    def version(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT value FROM state WHERE key = 'version'").fetchone()[0]
+
+    def active(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._connect().execute("SELECT tenant, dataset_id FROM active").fetchall())
+
+    def _write(self, statement: str = None, parameters: tuple = ()) -> int:
+        """Aplica un cambio e incrementa la versión en una sola transacción; devuelve la nueva versión"""
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                if statement:
+                    connection.execute(statement, parameters)
+                connection.execute("UPDATE state SET value = value + 1 WHERE key = 'version'")
+                version = connection.execute("SELECT value FROM state WHERE key = 'version'").fetchone()[0]
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        return version
+
+    def set_active(self, tenant: str, dataset_id: str) -> int:
+        return self._write(
+            "INSERT OR REPLACE INTO active (tenant, dataset_id, updated_at) VALUES (?, ?, ?)",
+            (tenant, dataset_id, time.time())
+        )
+
+    def clear_active(self, tenant: str, dataset_id: str) -> int:
+        return self._write("DELETE FROM active WHERE tenant = ? AND dataset_id = ?", (tenant, dataset_id))
+
+    def bump(self) -> int:
+        return self._write()
+
+    def set_source(self, tenant: str, source_hash: str, dataset_id: str):
+        """Último dataset indexado a partir de ese contenido (no cambia la versión: nadie lo tiene en caché)"""
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO sources (tenant, source_hash, dataset_id, updated_at) VALUES (?, ?, ?, ?)",
+                (tenant, source_hash, dataset_id, time.time())
+            )
+
+    def clear_sources(self, tenant: str, dataset_id: str):
+        with self._lock:
+            self._connect().execute("DELETE FROM sources WHERE tenant = ? AND dataset_id = ?", (tenant, dataset_id))
+
+    def source_dataset(self, tenant: str, source_hash: str) -> Optional[str]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT dataset_id FROM sources WHERE tenant = ? AND source_hash = ?", (tenant, source_hash)
+            ).fetchone()
+        return row[0] if row else None
+
+
+class DatasetRegistry:
+    """Datasets indexados, uno por colección de ChromaDB con nombre (inquilino, hash del contenido).
+
+    Cada inquilino tiene un dataset activo (el último ingerido), que usan las sesiones
+    no ligadas a un dataset concreto. Volver a un dataset ya indexado no reingiere nada.
+    Con ChromaDB persistente los índices se expulsan de memoria a disco por LRU; con el
+    cliente efímero se eliminan los datasets inactivos menos usados si superan el presupuesto.
+
+    Los datasets activos viven en el catálogo compartido: cuando otro worker ingiere, activa
+    o borra un dataset cambia su versión, y este proceso recarga los activos y descarta las
+    colecciones que tenía abiertas antes de resolver la siguiente consulta."""
+
+    def __init__(self, chroma_client, embedding_function, persistent: bool, memory_bytes: int,
+                 catalog: DatasetCatalog = None, tables=None):
+        self.chroma_client = chroma_client
+        self.embedding_function = embedding_function
+        self.persistent = persistent
+        self.memory_bytes = memory_bytes
+        self.catalog = catalog or DatasetCatalog()
+        # Almacén columnar con las filas de cada dataset (se borran con él)
+        self.tables = tables
+        self.version = None
+        self._active: Dict[str, str] = {}
+        # Colecciones abiertas en orden de uso (la última, la más reciente)
+        self._collections: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Recarga los activos si el catálogo ha cambiado desde la última consulta"""
+        version = self.catalog.version()
+        if version == self.version:
+            return
+        active = self.catalog.active()
+        with self._lock:
+            self._active = active
+            self._collections.clear()
+            self.version = version
+
+    def _committed(self, version: int):
+        """Cambio propio ya aplicado en memoria: si nadie más escribió entre medias no hay que recargar"""
+        with self._lock:
+            if self.version is not None and version == self.version + 1:
+                self.version = version
+
+    def get(self, tenant: str, dataset_id: str):
+        """Colección de un dataset completamente indexado, o None"""
+        self.refresh()
+        name = collection_name(tenant, dataset_id)
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is not None:
+                self._collections.move_to_end(name)
+                return collection
+        try:
+            collection = self.chroma_client.get_collection(name, embedding_function=self.embedding_function)
+        except Exception:
+            return None
+        if (collection.metadata or {}).get("status") != "ready":
+            return None
+        with self._lock:
+            self._collections[name] = collection
+        return collection
+
+    def create(self, tenant: str, dataset_id: str, source: str, template: str = None,
+               extra: Dict[str, Any] = None):
+        """Crea la colección vacía de un dataset (descarta una ingesta anterior a medias)"""
+        self.delete(tenant, dataset_id)
+        metadata = self._metadata(tenant, dataset_id, source, "loading", 0)
+        if template:
+            metadata["template"] = template
+        metadata.update(extra or {})
+        return self.chroma_client.create_collection(
+            name=collection_name(tenant, dataset_id),
+            embedding_function=self.embedding_function,
+            metadata=metadata
+        )
+
+    def mark_ready(self, collection, documents: int):
+        metadata = dict(collection.metadata or {})
+        metadata.update({"status": "ready", "documents": documents})
+        collection.modify(metadata=metadata)
+        with self._lock:
+            self._collections[collection.name] = collection
+        self._committed(self.catalog.bump())
+
+    @staticmethod
+    def _metadata(tenant: str, dataset_id: str, source: str, status: str, documents: int) -> Dict[str, Any]:
+        return {
+            "dataset_id": dataset_id,
+            "tenant": tenant_slug(tenant),
+            "source": source,
+            "status": status,
+            "documents": documents,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S")
+        }
+
+    def delete(self, tenant: str, dataset_id: str) -> bool:
+        name = collection_name(tenant, dataset_id)
+        with self._lock:
+            self._collections.pop(name, None)
+            if self._active.get(tenant_slug(tenant)) == dataset_id:
+                del self._active[tenant_slug(tenant)]
+        with store_lock:
+            self._committed(self.catalog.clear_active(tenant_slug(tenant), dataset_id))
+            self.catalog.clear_sources(tenant_slug(tenant), dataset_id)
+            if self.tables is not None:
+                self.tables.delete(tenant, dataset_id)
+            try:
+                self.chroma_client.delete_collection(name)
+            except Exception:
+                return False
+        logger.info(f"Colección {name} eliminada")
+        return True
+
+    def activate(self, tenant: str, dataset_id: str):
+        with self._lock:
+            self._active[tenant_slug(tenant)] = dataset_id
+        self._committed(self.catalog.set_active(tenant_slug(tenant), dataset_id))
+
+    def active_id(self, tenant: str) -> Optional[str]:
+        """Dataset activo propio del inquilino (sin recurrir al del inquilino por defecto)"""
+        self.refresh()
+        with self._lock:
+            return self._active.get(tenant_slug(tenant))
+
+    def resolve(self, tenant: str, dataset_id: Optional[str] = None):
+        """Colección para una sesión: su dataset si está ligada a uno, si no el activo"""
+        self.refresh()
+        if dataset_id:
+            # Los datasets del inquilino por defecto son compartidos
+            return self.get(tenant, dataset_id) or self.get(DEFAULT_TENANT, dataset_id)
+        with self._lock:
+            own = self._active.get(tenant_slug(tenant))
+            shared = self._active.get(DEFAULT_TENANT)
+        if own:
+            return self.get(tenant, own)
+        return self.get(DEFAULT_TENANT, shared) if shared else None
+
+    def list(self, tenant: Optional[str] = None) -> List[Dict[str, Any]]:
+        self.refresh()
+        with self._lock:
+            recent = list(self._collections)
+            active = dict(self._active)
+        datasets = []
+        for collection in self.chroma_client.list_collections():
+            metadata = collection.metadata or {}
+            if not collection.name.startswith(COLLECTION_PREFIX) or "dataset_id" not in metadata:
+                continue
+            if tenant is not None and metadata.get("tenant") != tenant_slug(tenant):
+                continue
+            datasets.append({
+                **metadata,
+                "collection": collection.name,
+                "active": active.get(metadata.get("tenant")) == metadata["dataset_id"],
+                "open": collection.name in recent,
+                "resident_mb_estimate": round(metadata.get("documents", 0) * index_bytes_per_document() / 1024 / 1024, 2),
+                "table_mb": self.tables.size_mb(metadata["tenant"], metadata["dataset_id"]) if self.tables else None
+            })
+        return datasets
+
+    def evict(self):
+        """Con el cliente efímero no hay disco al que expulsar: se eliminan los datasets
+        inactivos usados hace más tiempo hasta que el resto cabe en el presupuesto"""
+        if self.persistent:
+            return
+        with self._lock:
+            active_names = {collection_name(tenant, dataset_id) for tenant, dataset_id in self._active.items()}
+        datasets = [dataset for dataset in self.list() if dataset["status"] == "ready"]
+        bytes_per_document = index_bytes_per_document()
+        resident = sum(dataset["documents"] * bytes_per_document for dataset in datasets)
+        with self._lock:
+            order = {name: position for position, name in enumerate(self._collections)}
+        # Las colecciones que no se han abierto en este proceso son las menos recientes
+        for dataset in sorted(datasets, key=lambda d: order.get(d["collection"], -1)):
+            if resident <= self.memory_bytes:
+                break
+            if dataset["collection"] in active_names:
+                continue
+            self.delete(dataset["tenant"], dataset["dataset_id"])
+            resident -= dataset["documents"] * bytes_per_document
+            logger.info(f"Dataset {dataset['collection']} expulsado por memoria")
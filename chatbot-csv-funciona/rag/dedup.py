@@ -0,0 +1,179 @@
+import logging
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+from pandas.util import hash_array, hash_pandas_object
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Semánticas de la deduplicación de filas
+OFF = "off"
+FIRST = "first"
+SUM = "sum"
+DEDUP_MODES = (OFF, FIRST, SUM)
+# Los números se comparan redondeados a céntimos
+NUMBER_DECIMALS = 2
+FIRST_COLUMN = "_first"
+
+
+def _text_hashes(values: pd.Series) -> np.ndarray:
+    """Hash de cada texto normalizado (sin tildes, mayúsculas ni espacios de sobra),
+    normalizando una sola vez cada valor distinto"""
+    codes, uniques = pd.factorize(values)
+    normalized = (pd.Series(uniques, dtype=object).astype(str).str.normalize("NFKD")
+                  .str.encode("ascii", "ignore").str.decode("ascii")
+                  .str.casefold().str.split().str.join(" "))
+    # La posición extra es la de los códigos -1 de los valores vacíos
+    hashes = np.append(hash_array(normalized.to_numpy(dtype=object)), np.uint64(0))
+    return hashes[codes]
+
+
+def _column_hashes(values: pd.Series) -> np.ndarray:
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return hash_array(values.to_numpy())
+    if pd.api.types.is_numeric_dtype(values):
+        # + 0.0 convierte -0.0 en 0.0 para que ambos den el mismo hash
+        return hash_array(values.astype("float64").round(NUMBER_DECIMALS).to_numpy() + 0.0)
+    return _text_hashes(values)
+
+
+class RowDeduplicator:
+    """Elimina las filas repetidas de un dataset antes de crear sus documentos.
+
+    Cada fila se identifica por el hash de sus columnas clave normalizadas: textos sin tildes,
+    mayúsculas ni espacios de sobra y números redondeados a céntimos. first conserva la primera
+    aparición; sum la conserva con las medidas sumadas de todas sus repeticiones (las claves por
+    defecto son entonces las columnas que no son medidas). Los hashes ya vistos se recuerdan
+    entre bloques y, al anexar, incluyen los de las filas del dataset, de modo que un periodo
+    exportado de nuevo no se indexa dos veces. Una instancia por ingesta: acumula el recuento."""
+
+    def __init__(self, mode: str = None, keys: List[str] = None):
+        self.mode = (mode or settings["dedup_mode"]).strip().lower()
+        if self.mode not in DEDUP_MODES:
+            raise ValueError(f"Deduplicación de filas desconocida: {self.mode} (off, first o sum)")
+        if keys is None:
+            keys = [key.strip() for key in settings["dedup_keys"].split(",") if key.strip()]
+        self.keys = list(keys)
+        self.rows_read = 0
+        self.rows_removed = 0
+        self._resolved: Optional[List[str]] = None
+        # Hashes vistos en tramos ordenados que se fusionan al crecer (como un contador binario)
+        self._runs: List[np.ndarray] = []
+        # Semántica sum por bloques: primera fila y medidas totales de cada clave
+        self._plan: Optional[pd.DataFrame] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != OFF
+
+    def signature(self) -> str:
+        """Distingue los índices de un mismo archivo con distinta deduplicación (vacío sin ella)"""
+        if not self.enabled:
+            return ""
+        return f"dedup:{self.mode}:{','.join(self.keys)}"
+
+    def to_metadata(self) -> Dict[str, Any]:
+        """Metadatos de la colección, para deduplicar los anexos igual que el dataset"""
+        return {"dedup": self.mode, "dedup_keys": ",".join(self.keys)}
+
+    @classmethod
+    def from_metadata(cls, metadata: Dict[str, Any]) -> "RowDeduplicator":
+        # Los datasets indexados antes de existir la opción no se deduplicaron
+        if "dedup" not in metadata:
+            return cls(OFF, [])
+        keys = [key for key in metadata.get("dedup_keys", "").split(",") if key]
+        return cls(metadata["dedup"], keys)
+
+    def report(self) -> Dict[str, Any]:
+        return {"mode": self.mode, "keys": self._resolved or self.keys,
+                "rows_read": self.rows_read, "rows_removed": self.rows_removed}
+
+    def key_columns(self, df: pd.DataFrame, default: List[str], measures: List[str]) -> List[str]:
+        """Columnas clave: las configuradas o, por defecto, las del dataset (sin las medidas con sum)"""
+        if self._resolved is None:
+            keys = self.keys or [key for key in default if not (self.mode == SUM and key in measures)]
+            if not keys:
+                raise ValueError("La deduplicación de filas no tiene columnas clave")
+            self._resolved = keys
+        # Las claves se fijan con el primer bloque (al anexar, con las filas del dataset)
+        missing = [key for key in self._resolved if key not in df.columns]
+        if missing:
+            raise ValueError(f"Columnas clave de deduplicación que no están en los datos: {missing}")
+        return self._resolved
+
+    def hashes(self, df: pd.DataFrame, default: List[str], measures: List[str]) -> np.ndarray:
+        """Hash de 64 bits de las columnas clave normalizadas de cada fila"""
+        keys = self.key_columns(df, default, measures)
+        columns = pd.DataFrame({key: _column_hashes(df[key]) for key in keys}, index=df.index)
+        return hash_pandas_object(columns, index=False).to_numpy()
+
+    def _seen(self, hashes: np.ndarray) -> np.ndarray:
+        found = np.zeros(len(hashes), dtype=bool)
+        for run in self._runs:
+            positions = np.minimum(np.searchsorted(run, hashes), len(run) - 1)
+            found |= run[positions] == hashes
+        return found
+
+    def _remember(self, hashes: np.ndarray):
+        run = np.unique(hashes)
+        if not len(run):
+            return
+        self._runs.append(run)
+        while len(self._runs) > 1 and len(self._runs[-2]) <= len(self._runs[-1]):
+            last = self._runs.pop()
+            self._runs[-1] = np.union1d(self._runs[-1], last)
+
+    def remember(self, df: pd.DataFrame, default: List[str], measures: List[str] = ()):
+        """Registra filas ya indexadas (las del dataset al que se anexa) para descartar sus repeticiones"""
+        if self.enabled and len(df):
+            self._remember(self.hashes(df, default, list(measures)))
+
+    def scan(self, chunks: Iterable[pd.DataFrame], default: List[str], measures: List[str]):
+        """Primera pasada de la semántica sum en una ingesta por bloques: la primera fila de cada
+        clave y las medidas totales de sus repeticiones, para conservar cada clave una sola vez
+        aunque se repita en bloques distintos"""
+        plan = None
+        for chunk in chunks:
+            if not len(chunk):
+                continue
+            measures_present = [measure for measure in measures if measure in chunk.columns]
+            hashes = self.hashes(chunk, default, measures_present)
+            part = chunk[measures_present].groupby(hashes).sum(min_count=1)
+            part[FIRST_COLUMN] = pd.Series(chunk.index, index=chunk.index).groupby(hashes).min()
+            plan = part if plan is None else self._merge_plan(plan, part, measures_present)
+        self._plan = plan
+
+    @staticmethod
+    def _merge_plan(left: pd.DataFrame, right: pd.DataFrame, measures: List[str]) -> pd.DataFrame:
+        both = pd.concat([left, right])
+        merged = both[measures].groupby(level=0).sum(min_count=1)
+        merged[FIRST_COLUMN] = both[FIRST_COLUMN].groupby(level=0).min()
+        return merged
+
+    def apply(self, df: pd.DataFrame, default: List[str], measures: List[str] = ()) -> pd.DataFrame:
+        """Filas únicas de un bloque procesado (con las medidas sumadas en la semántica sum)"""
+        self.rows_read += len(df)
+        if not self.enabled or not len(df):
+            return df
+        measures = [measure for measure in measures if measure in df.columns] if self.mode == SUM else []
+        hashes = self.hashes(df, default, measures)
+        if self._plan is not None:
+            planned = self._plan.reindex(hashes)
+            keep = planned[FIRST_COLUMN].to_numpy() == df.index.to_numpy()
+            totals = planned[measures].to_numpy()
+        else:
+            codes, _ = pd.factorize(hashes)
+            keep = np.zeros(len(df), dtype=bool)
+            keep[np.unique(codes, return_index=True)[1]] = True
+            totals = df[measures].groupby(codes).sum(min_count=1).to_numpy()[codes] if measures else None
+        keep &= ~self._seen(hashes)
+        if measures:
+            df = df.copy()
+            df[measures] = totals
+        unique = df[keep]
+        self._remember(hashes[keep])
+        self.rows_removed += len(df) - len(unique)
+        return unique
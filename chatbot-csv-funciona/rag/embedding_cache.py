@@ -0,0 +1,179 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from config import settings
+from utils.metrics import EMBEDDING_CACHE_LOOKUPS_TOTAL
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# Al superar el límite se expulsan entradas hasta quedar en esta fracción
+EVICT_TARGET = 0.9
+# SQLite limita el número de parámetros por consulta
+LOOKUP_BATCH = 500
+
+
+class EmbeddingCache:
+    """Caché persistente en SQLite de vectores por hash(modelo + texto), con expulsión LRU por tamaño.
+
+    Los documentos de DataProcessor son deterministas: reingestar datos sin cambios
+    (nueva subida o reinicio con el cliente efímero de Chroma) no vuelve a ejecutar el modelo."""
+
+    def __init__(self, path: str = None, max_mb: int = None):
+        self.path = settings["embedding_cache_path"] if path is None else path
+        self.max_bytes = (settings["embedding_cache_max_mb"] if max_mb is None else max_mb) * MB
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path) and self.max_bytes > 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            # Debe fijarse antes de crear las tablas: las páginas expulsadas se devuelven al disco
+            connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key BLOB PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+            self._bytes = self._size_bytes(connection)
+            self._connection = connection
+            logger.info(f"Caché de embeddings {self.path}: {round(self._bytes / MB, 1)} MB")
+        return self._connection
+
+    @staticmethod
+    def _size_bytes(connection: sqlite3.Connection) -> int:
+        """Bytes ocupados en disco (páginas en uso, sin las libres)"""
+        page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+        pages = connection.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = connection.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages - free_pages) * page_size
+
+    @staticmethod
+    def key(model_id: str, text: str) -> bytes:
+        return hashlib.blake2b(f"{model_id}\0{text}".encode("utf-8"), digest_size=16).digest()
+
+    def get_many(self, model_id: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Vectores en caché para cada texto (None si no está)"""
+        keys = [self.key(model_id, text) for text in texts]
+        found: Dict[bytes, bytes] = {}
+        with self._lock:
+            connection = self._connect()
+            for start in range(0, len(keys), LOOKUP_BATCH):
+                batch = list(set(keys[start:start + LOOKUP_BATCH]))
+                placeholders = ",".join("?" * len(batch))
+                found.update(connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall())
+            if found:
+                # Marca de uso para la expulsión LRU
+                now = time.time()
+                connection.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                       [(now, key) for key in found])
+        vectors = [np.frombuffer(found[key], dtype=np.float32) if key in found else None for key in keys]
+        hits = sum(vector is not None for vector in vectors)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        EMBEDDING_CACHE_LOOKUPS_TOTAL.inc(hits, result="hit")
+        EMBEDDING_CACHE_LOOKUPS_TOTAL.inc(len(keys) - hits, result="miss")
+        return vectors
+
+    def put_many(self, model_id: str, texts: List[str], vectors: List[Any]):
+        rows = []
+        now = time.time()
+        for text, vector in zip(texts, vectors):
+            rows.append((self.key(model_id, text), np.asarray(vector, dtype=np.float32).tobytes(), now))
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN")
+            connection.executemany("INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows)
+            connection.execute("COMMIT")
+            self._bytes = self._size_bytes(connection)
+            if self._bytes > self.max_bytes:
+                self._evict(connection)
+
+    def _evict(self, connection: sqlite3.Connection):
+        """Expulsa los vectores usados hace más tiempo hasta quedar por debajo del límite"""
+        count = connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if not count:
+            return
+        excess = int((self._bytes - self.max_bytes * EVICT_TARGET) / (self._bytes / count)) + 1
+        connection.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (excess,)
+        )
+        connection.executescript("PRAGMA incremental_vacuum;")
+        self._bytes = self._size_bytes(connection)
+        self.evicted += excess
+        logger.info(f"Caché de embeddings: {excess} vectores expulsados ({round(self._bytes / MB, 1)} MB)")
+
+    def clear(self):
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM embeddings")
+            connection.executescript("PRAGMA incremental_vacuum;")
+            self._bytes = self._size_bytes(connection)
+
+    def stats(self) -> Dict[str, Any]:
+        if not self.enabled:
+            return {"enabled": False}
+        with self._lock:
+            count = self._connect().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "enabled": True,
+            "path": self.path,
+            "vectors": count,
+            "size_mb": round(self._bytes / MB, 2),
+            "max_mb": round(self.max_bytes / MB, 1),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "evicted": self.evicted
+        }
+
+
+class CachedEmbeddingFunction:
+    """Envuelve una función de embedding: solo calcula los textos que no están en la caché"""
+
+    def __init__(self, embedding_function, cache: EmbeddingCache, model_id: str = None):
+        self.embedding_function = embedding_function
+        self.cache = cache
+        self.model_id = (model_id or getattr(embedding_function, "model_id", None)
+                         or getattr(embedding_function, "MODEL_NAME", type(embedding_function).__name__))
+        self.batch_size = getattr(embedding_function, "batch_size", 0)
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        if not input:
+            return []
+        vectors = self.cache.get_many(self.model_id, input)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # Textos repetidos dentro del lote se calculan una sola vez
+            unique_texts = list(dict.fromkeys(input[i] for i in missing))
+            computed = dict(zip(unique_texts, self.embedding_function(unique_texts)))
+            self.cache.put_many(self.model_id, unique_texts, [computed[text] for text in unique_texts])
+            for i in missing:
+                vectors[i] = computed[input[i]]
+        return [np.asarray(vector, dtype=np.float32).tolist() for vector in vectors]
+
+
+# Caché compartida por el proceso (una conexión SQLite)
+embedding_cache = EmbeddingCache()
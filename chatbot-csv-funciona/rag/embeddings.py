@@ -1,15 +1,166 @@
+import hashlib
 import logging
+import os
 from typing import List, Dict, Any, Optional
 
+import numpy as np
+
+from config import settings
+
 logger = logging.getLogger(__name__)
 
+BACKENDS = ("default", "onnx", "onnx_int8")
+# all-MiniLM-L6-v2 tal como lo descarga ChromaDB; se reutiliza si no se indica otro modelo
+CHROMA_MODEL_DIR = os.path.join(os.path.expanduser("~"), ".cache", "chroma", "onnx_models", "all-MiniLM-L6-v2", "onnx")
+MODEL_FILE = "model.onnx"
+# Nombres habituales de un modelo ya cuantizado (el primero es el que se genera aquí)
+QUANTIZED_FILES = ("model_int8.onnx", "model_quantized.onnx")
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def model_digest(path: str) -> str:
+    """Hash del contenido del modelo: dos modelos distintos en directorios con el mismo
+    nombre (o un modelo reemplazado en el mismo sitio) no comparten entradas de caché"""
+    digest = hashlib.blake2b(digest_size=8)
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class OnnxEmbeddingFunction:
+    """Embeddings de un modelo sentence-transformers exportado a ONNX, ejecutado en CPU.
+
+    Frente al embebedor por defecto de ChromaDB (lotes de 32 rellenados siempre a 256
+    tokens) usa hilos y tamaño de lote configurables y padding dinámico: los textos se
+    ordenan por longitud y cada lote solo se rellena hasta su texto más largo."""
+
+    def __init__(self, model_dir: str, model_file: str = MODEL_FILE, threads: int = 0,
+                 batch_size: int = 64, max_length: int = 256):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.model_dir = model_dir
+        self.model_file = model_file
+        self.threads = threads
+        self.batch_size = batch_size
+        self.max_length = max_length
+        # Identifica el modelo (y su cuantización) para cachés de embeddings
+        model_path = os.path.join(model_dir, model_file)
+        self.model_id = (f"{os.path.basename(os.path.normpath(model_dir))}/{model_file}"
+                         f"#{model_digest(model_path)}@{max_length}")
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        pad_token = next((token for token in ("[PAD]", "<pad>") if self.tokenizer.token_to_id(token) is not None), "[PAD]")
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id(pad_token) or 0, pad_token=pad_token)
+
+        options = ort.SessionOptions()
+        options.log_severity_level = 3
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(
+            model_path,
+            sess_options=options,
+            providers=["CPUExecutionProvider"]
+        )
+        # Los modelos tipo XLM-R (multilingües) no tienen token_type_ids
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        logger.info(f"Modelo de embeddings {self.model_id} cargado (hilos={threads or 'auto'}, lote={batch_size})")
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        encoded = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.zeros_like(input_ids)
+        last_hidden_state = self.session.run(None, feeds)[0]
+
+        # Pooling medio sobre los tokens reales y normalización L2 (como sentence-transformers)
+        mask = attention_mask[..., np.newaxis].astype(np.float32)
+        embeddings = (last_hidden_state * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return (embeddings / np.clip(norms, 1e-12, None)).astype(np.float32)
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        if not input:
+            return []
+        order = np.argsort([len(text) for text in input], kind="stable")
+        embeddings = None
+        for start in range(0, len(order), self.batch_size):
+            positions = order[start:start + self.batch_size]
+            batch = self._embed_batch([input[i] for i in positions])
+            if embeddings is None:
+                embeddings = np.empty((len(input), batch.shape[1]), dtype=np.float32)
+            embeddings[positions] = batch
+        return embeddings.tolist()
+
+
 class EmbeddingService:
-    def __init__(self):
-        """El servicio de embeddings usa por defecto el embebedor interno de ChromaDB"""
-        logger.info("Usando modelo de embeddings por defecto de ChromaDB")
-        self.use_custom_model = False
-        
+    def __init__(self, backend: str = None, model_dir: str = None, threads: int = None,
+                 batch_size: int = None, max_length: int = None):
+        """Selecciona el backend de embeddings (por defecto, el de config.py)"""
+        self.backend = (backend or settings["embedding_backend"]).lower()
+        if self.backend not in BACKENDS:
+            raise ValueError(f"Backend de embeddings desconocido: {self.backend} (opciones: {', '.join(BACKENDS)})")
+        self.model_dir = model_dir or settings["embedding_model_dir"] or CHROMA_MODEL_DIR
+        self.threads = settings["embedding_threads"] if threads is None else threads
+        self.batch_size = batch_size or settings["embedding_batch_size"]
+        self.max_length = max_length or settings["embedding_max_length"]
+        self.use_custom_model = self.backend != "default"
+        if self.use_custom_model:
+            logger.info(f"Usando backend de embeddings {self.backend} con el modelo de {self.model_dir}")
+        else:
+            logger.info("Usando modelo de embeddings por defecto de ChromaDB")
+
+    def _ensure_model(self):
+        """Descarga all-MiniLM-L6-v2 con ChromaDB si se usa su modelo y aún no está en disco"""
+        if os.path.exists(os.path.join(self.model_dir, MODEL_FILE)):
+            return
+        if os.path.normpath(self.model_dir) != os.path.normpath(CHROMA_MODEL_DIR):
+            raise FileNotFoundError(f"No se encontró {MODEL_FILE} en {self.model_dir}")
+        from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+        ONNXMiniLM_L6_V2()._download_model_if_not_exists()
+
+    def _quantized_model(self) -> str:
+        """Devuelve el modelo int8 del directorio; si no existe, lo genera con cuantización dinámica"""
+        for name in QUANTIZED_FILES:
+            if os.path.exists(os.path.join(self.model_dir, name)):
+                return name
+        self._ensure_model()
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        target = os.path.join(self.model_dir, QUANTIZED_FILES[0])
+        temporary = f"{target}.{os.getpid()}.tmp"
+        logger.info(f"Cuantizando {self.model_dir}/{MODEL_FILE} a int8")
+        quantize_dynamic(os.path.join(self.model_dir, MODEL_FILE), temporary, weight_type=QuantType.QInt8)
+        # Renombrado atómico: varios procesos pueden cuantizar a la vez sin dejar un archivo a medias
+        os.replace(temporary, target)
+        return QUANTIZED_FILES[0]
+
     def get_embedding_function(self):
         """Devuelve la función de embedding para usar con ChromaDB"""
-        # Devuelve None para usar el embebedor predeterminado de ChromaDB
-        return None
\ No newline at end of file
+        if not self.use_custom_model:
+            # Devuelve None para usar el embebedor predeterminado de ChromaDB
+            return None
+        if self.backend == "onnx_int8":
+            model_file = self._quantized_model()
+        else:
+            self._ensure_model()
+            model_file = MODEL_FILE
+        return OnnxEmbeddingFunction(
+            self.model_dir, model_file,
+            threads=self.threads, batch_size=self.batch_size, max_length=self.max_length
+        )
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "model_dir": self.model_dir if self.use_custom_model else None,
+            "threads": self.threads,
+            "batch_size": self.batch_size,
+            "max_length": self.max_length
+        }
@@ -0,0 +1,168 @@
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Granularidades de los documentos de filas de un dataset
+ROW = "row"
+GROUP = "group"
+CHUNK = "chunk"
+GRANULARITIES = (ROW, GROUP, CHUNK)
+# Periodos que se derivan de la columna de fecha para agrupar ("cliente × mes", "Local × semana")
+PERIODS = {"dia": "%Y-%m-%d", "semana": "%G-W%V", "mes": "%Y-%m", "año": "%Y"}
+GROUP_ID_PREFIX = "grupo_"
+CHUNK_ID_PREFIX = "bloque_"
+# Los metadatos de Chroma solo admiten valores escalares: los IDs de fila van en un texto
+ROW_IDS_SEPARATOR = ","
+COLUMN_SEPARATOR = " | "
+
+
+def _strftime(values: pd.Series, date_format: str) -> pd.Series:
+    """Fechas como texto formateando una sola vez cada fecha distinta (vacío si falta)"""
+    codes, uniques = pd.factorize(values)
+    texts = np.append(uniques.strftime(date_format).to_numpy(dtype=object), "")
+    return pd.Series(texts[codes], index=values.index, dtype=object)
+
+
+def _text(values: pd.Series) -> pd.Series:
+    """Valores de una columna tal como aparecen en la tabla de un documento"""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return _strftime(values, "%d/%m/%Y")
+    if pd.api.types.is_float_dtype(values):
+        return values.map("{:.2f}".format).where(values.notna(), "")
+    return values.astype(object).where(values.notna(), "").astype(str)
+
+
+class DocumentGranularity:
+    """Cuántas filas entran en cada documento indexado de un dataset.
+
+    row: un documento por fila. group: un documento por entidad y periodo (cliente × mes,
+    Local × semana) con una tabla compacta de sus filas. chunk: un documento por cada max_rows
+    filas consecutivas. Los grupos de más de max_rows filas se parten en varios documentos.
+    Los IDs de las filas de origen quedan en los metadatos (row_ids), de modo que las filas
+    exactas se siguen leyendo del almacén columnar."""
+
+    def __init__(self, mode: str = None, group_by: List[str] = None, max_rows: int = None):
+        self.mode = (mode or settings["document_granularity"]).strip().lower()
+        if self.mode not in GRANULARITIES:
+            raise ValueError(f"Granularidad de documentos desconocida: {self.mode} (row, group o chunk)")
+        if group_by is None:
+            group_by = [key.strip() for key in settings["document_group_by"].split(",") if key.strip()]
+        self.group_by = list(group_by)
+        self.max_rows = int(max_rows or settings["document_max_rows"])
+
+    @property
+    def per_row(self) -> bool:
+        return self.mode == ROW
+
+    def signature(self) -> str:
+        """Distingue los índices de un mismo archivo con distinta granularidad (vacío por fila)"""
+        if self.per_row:
+            return ""
+        return f"{self.mode}:{','.join(self.group_by)}:{self.max_rows}"
+
+    def to_metadata(self) -> Dict[str, Any]:
+        """Metadatos de la colección, para anexar filas con la misma granularidad"""
+        return {"granularity": self.mode, "group_by": ",".join(self.group_by), "document_max_rows": self.max_rows}
+
+    @classmethod
+    def from_metadata(cls, metadata: Dict[str, Any]) -> "DocumentGranularity":
+        # Los datasets indexados antes de existir la opción son de un documento por fila
+        if "granularity" not in metadata:
+            return cls(ROW, [])
+        group_by = [key for key in metadata.get("group_by", "").split(",") if key]
+        return cls(metadata["granularity"], group_by, metadata.get("document_max_rows"))
+
+    @staticmethod
+    def row_ids(metadata: Optional[Dict[str, Any]]) -> List[str]:
+        """IDs de las filas de origen de un documento de grupo o bloque"""
+        value = (metadata or {}).get("row_ids")
+        return value.split(ROW_IDS_SEPARATOR) if value else []
+
+    def keys(self, df: pd.DataFrame, date_column: Optional[str], default: List[str]) -> List[str]:
+        """Claves de agrupación presentes en los datos: columnas o periodos de la fecha"""
+        keys = []
+        for key in self.group_by or default:
+            if (key in PERIODS and date_column) or key in df.columns:
+                keys.append(key)
+            else:
+                logger.warning(f"Clave de agrupación {key} ignorada: no es una columna ni un periodo de la fecha")
+        if not keys:
+            raise ValueError(f"Ninguna clave de agrupación de {self.group_by or default} está en los datos")
+        return keys
+
+    def create_documents(self, df: pd.DataFrame, id_prefix: str, columns: List[str], date_column: Optional[str],
+                         measure: Optional[str], label: str, default_group_by: List[str],
+                         extra_metadata: Dict[str, Any] = None) -> Tuple[List[str], List[Dict[str, Any]], List[str]]:
+        """Documentos de grupos o bloques de filas de un DataFrame procesado (índice = índice de fila).
+
+        Cada documento lleva un título con el recuento y el total de la medida y una tabla con
+        una línea por fila (sin las columnas de agrupación, que ya están en el título)."""
+        if not len(df):
+            return [], [], []
+        frame = pd.DataFrame(index=df.index)
+        if self.mode == GROUP:
+            keys = self.keys(df, date_column, default_group_by)
+            for key in keys:
+                if key in PERIODS and date_column:
+                    frame[key] = _strftime(df[date_column], PERIODS[key])
+                else:
+                    frame[key] = df[key].astype(object).where(df[key].notna(), "").astype(str)
+            # Orden estable: dentro de cada grupo las filas siguen en el orden del archivo
+            frame = frame.sort_values(keys, kind="stable")
+            frame["_part"] = frame.groupby(keys, sort=False).cumcount() // self.max_rows
+        else:
+            keys = []
+            frame["_part"] = np.arange(len(frame)) // self.max_rows
+        shown = [column for column in columns if column not in keys]
+        frame["_line"] = pd.Series("", index=df.index, dtype=object)
+        for position, column in enumerate(shown):
+            frame["_line"] += (COLUMN_SEPARATOR if position else "") + _text(df[column]).astype(object)
+        frame["_id"] = id_prefix + df.index.to_series().astype(str)
+        frame["_index"] = df.index
+        frame["_measure"] = df[measure] if measure else 0.0
+        if date_column:
+            frame["_date"] = df[date_column]
+
+        # Tras ordenar, las filas de cada documento son contiguas: los textos se unen por tramos
+        # (sin funciones de Python por grupo en groupby) y los agregados numéricos van en cython
+        document = frame.groupby(keys + ["_part"], sort=False).ngroup().to_numpy()
+        starts = np.flatnonzero(np.r_[True, document[1:] != document[:-1]])
+        ends = np.r_[starts[1:], len(frame)]
+        aggregations = {"_index": ["min", "max"], "_measure": "sum"}
+        if date_column:
+            aggregations["_date"] = ["min", "max"]
+        grouped = frame.groupby(document, sort=True).agg(aggregations)
+        grouped.columns = ["_".join(column) for column in grouped.columns]
+        group_values = frame[keys].iloc[starts].to_numpy().tolist() if keys else [[]] * len(starts)
+        lines = frame["_line"].to_numpy()
+        row_ids = frame["_id"].to_numpy()
+
+        header = COLUMN_SEPARATOR.join(shown)
+        documents, metadatas, ids = [], [], []
+        for start, end, values, row in zip(starts, ends, group_values, grouped.to_dict("records")):
+            values = dict(zip(keys, values))
+            first, last, count = int(row["_index_min"]), int(row["_index_max"]), int(end - start)
+            if keys:
+                title = f"{label} de " + ", ".join(f"{key} {value}" for key, value in values.items())
+                document_id = f"{GROUP_ID_PREFIX}{'|'.join(values.values())}_{first}"
+            else:
+                title = f"{label}, filas {first} a {last}"
+                document_id = f"{CHUNK_ID_PREFIX}{first}"
+            total = f", {measure} total {row['_measure_sum']:.2f}" if measure else ""
+            documents.append(f"{title} ({count} filas{total}):\n{header}\n" + "\n".join(lines[start:end]))
+            metadata = {"tipo": "grupo" if keys else "bloque", **values, **(extra_metadata or {}),
+                        "filas": count, "row_ids": ROW_IDS_SEPARATOR.join(row_ids[start:end])}
+            if measure:
+                metadata["total"] = float(row["_measure_sum"])
+            if date_column and pd.notna(row["_date_min"]):
+                metadata["fecha_min"] = row["_date_min"].strftime("%Y-%m-%d")
+                metadata["fecha_max"] = row["_date_max"].strftime("%Y-%m-%d")
+            metadatas.append(metadata)
+            ids.append(document_id)
+        return documents, metadatas, ids
@@ -1,17 +1,47 @@
 import pandas as pd
 import logging
-from typing import Tuple, List, Dict, Any
+from typing import Tuple, List, Dict, Any, Optional
+from rag.granularity import DocumentGranularity
+from rag.stats_state import DistinctSketch
 
 logger = logging.getLogger(__name__)
 
 class DataProcessor:
+    # Los IDs de los documentos de fila llevan el índice de la fila del DataFrame procesado
+    ROW_ID_PREFIX = "factura_"
+    # Prefijos de fila de las facturas y de los datasets de plantilla
+    ROW_ID_PREFIXES = (ROW_ID_PREFIX, "fila_")
+    # Columnas de las tablas de los documentos agrupados y agrupación por defecto
+    DOCUMENT_COLUMNS = ["fecha", "cliente", "pais", "importe"]
+    DOCUMENT_GROUP_BY = ["cliente", "mes"]
+    # Columnas derivadas de la fecha (no identifican la fila) y medidas que se suman al deduplicar
+    DERIVED_COLUMNS = ["mes", "año"]
+    MEASURES = ["importe"]
+    
+    @staticmethod
+    def row_index(document_id: str) -> Optional[int]:
+        """Índice de fila de un ID de documento de fila (None para documentos de estadísticas)"""
+        prefix = next((p for p in DataProcessor.ROW_ID_PREFIXES if document_id.startswith(p)), None)
+        if prefix is None:
+            return None
+        suffix = document_id[len(prefix):]
+        return int(suffix) if suffix.isdigit() else None
+    
+    @staticmethod
+    def dedup_keys(columns: List[str]) -> List[str]:
+        """Columnas que identifican una factura al deduplicar: todas las del archivo
+        (sin las derivadas ni la del índice que escribe pandas al guardar un CSV)"""
+        return [column for column in columns
+                if column not in DataProcessor.DERIVED_COLUMNS and not str(column).startswith("Unnamed:")]
+    
     @staticmethod
     def process_dataframe(df: pd.DataFrame) -> pd.DataFrame:
         """Procesa y limpia el DataFrame para mejorar la calidad de los datos"""
         try:
             # Convertir tipos de datos
             df["fecha"] = pd.to_datetime(df["fecha"], errors="coerce")
-            df["importe"] = pd.to_numeric(df["importe"], errors="coerce")
+            # Siempre decimal: un bloque o un anexo con solo enteros no debe cambiar el tipo de la columna
+            df["importe"] = pd.to_numeric(df["importe"], errors="coerce").astype("float64")
             
             # Filtrar filas inválidas
             df = df.dropna(subset=["fecha", "importe", "cliente", "pais"])
@@ -28,51 +58,120 @@ class DataProcessor:
     @staticmethod
     def create_documents(df: pd.DataFrame) -> Tuple[List[str], List[Dict[str, Any]], List[str]]:
         """Crea documentos enriquecidos con información detallada de las facturas"""
+        documents, metadatas, ids = DataProcessor.create_row_documents(df)
+        
+        stats_documents, stats_metadatas, stats_ids = DataProcessor.create_stats_documents(df)
+        documents.extend(stats_documents)
+        metadatas.extend(stats_metadatas)
+        ids.extend(stats_ids)
+        
+        return documents, metadatas, ids
+    
+    @staticmethod
+    def create_row_documents(df: pd.DataFrame, granularity: DocumentGranularity = None) -> Tuple[List[str], List[Dict[str, Any]], List[str]]:
+        """Crea un documento por factura (operaciones por columna, sin recorrer las filas),
+        o uno por grupo (cliente × mes por defecto) o bloque de facturas según la granularidad"""
+        if len(df) == 0:
+            return [], [], []
+        if granularity is not None and not granularity.per_row:
+            return granularity.create_documents(
+                df, DataProcessor.ROW_ID_PREFIX, DataProcessor.DOCUMENT_COLUMNS, "fecha", "importe",
+                "Facturas", DataProcessor.DOCUMENT_GROUP_BY
+            )
+        index = df.index.to_series().astype(str)
+        fechas = df["fecha"].dt.strftime("%d/%m/%Y")
+        
+        # Documentos de facturas individuales
+        documents = (
+            "Factura " + index + ": El día " + fechas + ", el cliente " + df["cliente"].astype(str)
+            + " de " + df["pais"].astype(str) + " generó un importe de " + df["importe"].map("{:.2f}".format) + "."
+        ).tolist()
+        metadata_frame = pd.DataFrame({
+            "cliente": df["cliente"],
+            "pais": df["pais"],
+            "fecha": df["fecha"].dt.strftime("%Y-%m-%d"),
+            "importe": df["importe"].astype("float64"),
+            "mes": df["mes"].astype("int64"),
+            "año": df["año"].astype("int64")
+        })
+        metadatas = [{"tipo": "factura", **record} for record in metadata_frame.to_dict("records")]
+        ids = (DataProcessor.ROW_ID_PREFIX + index).tolist()
+        
+        return documents, metadatas, ids
+    
+    @staticmethod
+    def summarize(df: pd.DataFrame) -> Dict[str, Any]:
+        """Agregados parciales de un bloque de facturas, combinables con merge_summaries"""
+        return {
+            "count": len(df),
+            "sum": float(df["importe"].sum()),
+            "min": df["importe"].min(),
+            "max": df["importe"].max(),
+            "fecha_min": df["fecha"].min(),
+            "fecha_max": df["fecha"].max(),
+            "clientes": df.groupby("cliente")["importe"].sum(),
+            "paises": df.groupby("pais")["importe"].sum(),
+            "meses": df.groupby(df["fecha"].dt.month)["importe"].sum(),
+            "dias": DistinctSketch.from_values(df["fecha"].dt.normalize())
+        }
+    
+    @staticmethod
+    def merge_summaries(left: Dict[str, Any], right: Dict[str, Any]) -> Dict[str, Any]:
+        """Combina los agregados de dos bloques (ingesta por bloques)"""
+        if left is None or left["count"] == 0:
+            return right
+        if right is None or right["count"] == 0:
+            return left
+        return {
+            "count": left["count"] + right["count"],
+            "sum": left["sum"] + right["sum"],
+            "min": min(left["min"], right["min"]),
+            "max": max(left["max"], right["max"]),
+            "fecha_min": min(left["fecha_min"], right["fecha_min"]),
+            "fecha_max": max(left["fecha_max"], right["fecha_max"]),
+            "clientes": left["clientes"].add(right["clientes"], fill_value=0),
+            "paises": left["paises"].add(right["paises"], fill_value=0),
+            "meses": left["meses"].add(right["meses"], fill_value=0),
+            "dias": left["dias"].merge(right["dias"])
+        }
+    
+    @staticmethod
+    def create_stats_documents(df: pd.DataFrame) -> Tuple[List[str], List[Dict[str, Any]], List[str]]:
+        """Crea los documentos de resúmenes estadísticos del conjunto de facturas"""
+        if len(df) == 0:
+            return [], [], []
+        return DataProcessor.create_summary_documents(DataProcessor.summarize(df))
+    
+    @staticmethod
+    def create_summary_documents(summary: Dict[str, Any]) -> Tuple[List[str], List[Dict[str, Any]], List[str]]:
+        """Crea los documentos de estadísticas a partir de agregados (de uno o varios bloques)"""
         documents = []
         metadatas = []
         ids = []
         
-        # Documentos de facturas individuales
-        for idx, row in df.iterrows():
-            document = (
-                f"Factura {idx}: El día {row['fecha'].strftime('%d/%m/%Y')}, "
-                f"el cliente {row['cliente']} de {row['pais']} "
-                f"generó un importe de {row['importe']:.2f}."
-            )
-            metadata = {
-                "tipo": "factura",
-                "cliente": row["cliente"],
-                "pais": row["pais"],
-                "fecha": row["fecha"].strftime("%Y-%m-%d"),
-                "importe": float(row["importe"]),
-                "mes": int(row["mes"]),
-                "año": int(row["año"])
-            }
-            documents.append(document)
-            metadatas.append(metadata)
-            ids.append(f"factura_{idx}")
-        
         # Crear resúmenes estadísticos
-        if len(df) > 0:
+        if summary and summary["count"] > 0:
             # Resumen general
             general_stats = (
                 f"Resumen general de facturas:\n"
-                f"Total de facturas: {len(df)}\n"
-                f"Importe total: {df['importe'].sum():.2f}\n"
-                f"Importe promedio: {df['importe'].mean():.2f}\n"
-                f"Importe mínimo: {df['importe'].min():.2f}\n"
-                f"Importe máximo: {df['importe'].max():.2f}\n"
-                f"Periodo: {df['fecha'].min().strftime('%d/%m/%Y')} a {df['fecha'].max().strftime('%d/%m/%Y')}\n"
-                f"Número de clientes únicos: {df['cliente'].nunique()}\n"
-                f"Número de países: {df['pais'].nunique()}"
+                f"Total de facturas: {summary['count']}\n"
+                f"Importe total: {summary['sum']:.2f}\n"
+                f"Importe promedio: {summary['sum'] / summary['count']:.2f}\n"
+                f"Importe mínimo: {summary['min']:.2f}\n"
+                f"Importe máximo: {summary['max']:.2f}\n"
+                f"Periodo: {summary['fecha_min'].strftime('%d/%m/%Y')} a {summary['fecha_max'].strftime('%d/%m/%Y')}\n"
+                f"Número de clientes únicos: {len(summary['clientes'])}\n"
+                f"Número de países: {len(summary['paises'])}"
             )
+            if "dias" in summary:
+                general_stats += f"\nDías con facturas: {summary['dias'].estimate()}"
             documents.append(general_stats)
             metadatas.append({"tipo": "estadistica", "subtipo": "general"})
             ids.append("stats_general")
             
             # Top clientes
             clientes_stats = "Estadísticas por cliente:\n"
-            top_clientes = df.groupby("cliente")["importe"].sum().sort_values(ascending=False).head(5)
+            top_clientes = summary["clientes"].sort_values(ascending=False).head(5)
             for cliente, importe in top_clientes.items():
                 clientes_stats += f"- {cliente}: {importe:.2f}\n"
             documents.append(clientes_stats)
@@ -81,7 +180,7 @@ class DataProcessor:
             
             # Top países
             paises_stats = "Estadísticas por país:\n"
-            top_paises = df.groupby("pais")["importe"].sum().sort_values(ascending=False).head(5)
+            top_paises = summary["paises"].sort_values(ascending=False).head(5)
             for pais, importe in top_paises.items():
                 paises_stats += f"- {pais}: {importe:.2f}\n"
             documents.append(paises_stats)
@@ -90,7 +189,7 @@ class DataProcessor:
             
             # Estadísticas por mes
             meses_stats = "Estadísticas por mes:\n"
-            meses_df = df.groupby(df["fecha"].dt.month)["importe"].sum().sort_values(ascending=False)
+            meses_df = summary["meses"].sort_values(ascending=False)
             meses_nombres = {
                 1: "Enero", 2: "Febrero", 3: "Marzo", 4: "Abril", 5: "Mayo", 6: "Junio",
                 7: "Julio", 8: "Agosto", 9: "Septiembre", 10: "Octubre", 11: "Noviembre", 12: "Diciembre"
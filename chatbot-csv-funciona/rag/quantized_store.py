@@ -0,0 +1,394 @@
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Archivos de una colección: vectores float32 (solo se leen por mapa de memoria), códigos int8
+# y, por vector, su escala y su norma al cuadrado; textos y metadatos en SQLite
+VECTORS_FILE = "vectors.f32"
+CODES_FILE = "codes.i8"
+FACTORS_FILE = "factors.f32"
+RECORDS_FILE = "records.sqlite"
+METADATA_FILE = "collection.json"
+INT8_MAX = 127
+# Filas de códigos convertidas a float32 a la vez al puntuar (acota la memoria temporal)
+SCORE_BLOCK_ROWS = 16384
+# Memoria residente por documento: código int8 de 384 dimensiones, escala, norma y máscara
+QUANTIZED_BYTES_PER_DOC = 384 + 2 * 4 + 1
+# Operadores de filtro de ChromaDB admitidos en where
+OPERATORS = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+
+def quantize(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Cuantización escalar int8 simétrica por vector: códigos y factores (escala, norma²)"""
+    scales = np.abs(vectors).max(axis=1)
+    scales[scales == 0] = 1.0
+    codes = np.rint(vectors / scales[:, None] * INT8_MAX).astype(np.int8)
+    norms = np.einsum("ij,ij->i", vectors, vectors)
+    return codes, np.stack([scales / INT8_MAX, norms], axis=1).astype(np.float32)
+
+
+def _field(key: str) -> Tuple[str, List[Any]]:
+    """Valor de un metadato en SQL; las claves simples van literales para usar el índice de tipo"""
+    if re.fullmatch(r"\w+", key):
+        return f"json_extract(metadata, '$.{key}')", []
+    return "json_extract(metadata, ?)", ['$."' + key.replace('"', '\\"') + '"']
+
+
+def where_clause(where: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    """Filtro de metadatos de ChromaDB ({"tipo": "estadistica"}, $and, $or, $in...) como condición SQL"""
+    conditions, parameters = [], []
+    for key, value in where.items():
+        if key in ("$and", "$or"):
+            parts = [where_clause(condition) for condition in value]
+            conditions.append("(" + f" {key[1:].upper()} ".join(sql for sql, _ in parts) + ")")
+            parameters.extend(parameter for _, values in parts for parameter in values)
+            continue
+        condition = value if isinstance(value, dict) else {"$eq": value}
+        for operator, operand in condition.items():
+            field, field_parameters = _field(key)
+            if operator in ("$in", "$nin"):
+                negation = "NOT " if operator == "$nin" else ""
+                conditions.append(f"{field} {negation}IN ({', '.join('?' * len(operand))})")
+                parameters.extend(field_parameters + list(operand))
+            elif operator in OPERATORS:
+                conditions.append(f"{field} {OPERATORS[operator]} ?")
+                parameters.extend(field_parameters + [operand])
+            else:
+                raise ValueError(f"Operador de filtro no admitido: {operator}")
+    return " AND ".join(conditions) or "1", parameters
+
+
+class QuantizedCollection:
+    """Colección con la parte de la API de ChromaDB que usa la aplicación (add, upsert, delete,
+    get, peek, query, count, modify), sobre un índice comprimido.
+
+    En memoria solo quedan los códigos int8 de los vectores (un byte por dimensión, más escala
+    y norma por vector): una consulta puntúa todos los códigos por bloques, se queda con los
+    VECTOR_RERANK_CANDIDATES mejores y los reordena con la distancia L2 exacta leyendo sus
+    vectores float32 de un archivo mapeado en memoria. Las distancias devueltas son las de
+    ChromaDB (L2 al cuadrado). Los cambios de otros workers se detectan al consultar."""
+
+    def __init__(self, path: str, name: str, embedding_function=None):
+        self.path = path
+        self.name = name
+        self._embedding_function = embedding_function
+        # Candidatos que se reordenan con la distancia exacta en cada consulta
+        self.rerank_candidates = settings["vector_rerank_candidates"]
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+        # Códigos, factores y posiciones vivas cargados; se recargan si cambian los archivos
+        self._arrays: Optional[Dict[str, Any]] = None
+        self._version = None
+
+    # Almacenamiento
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self._file(RECORDS_FILE), check_same_thread=False, isolation_level=None,
+                                         timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                "position INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, document TEXT, metadata TEXT)"
+            )
+            # El filtro habitual (documentos de estadísticas) no recorre toda la tabla
+            connection.execute("CREATE INDEX IF NOT EXISTS records_tipo ON records (json_extract(metadata, '$.tipo'))")
+            self._connection = connection
+        return self._connection
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        with open(self._file(METADATA_FILE), encoding="utf-8") as f:
+            return json.load(f)
+
+    def modify(self, metadata: Dict[str, Any] = None, name: str = None):
+        temporary = self._file(f"{METADATA_FILE}.{os.getpid()}.tmp")
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(metadata or {}, f, ensure_ascii=False)
+        os.replace(temporary, self._file(METADATA_FILE))
+
+    def count(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def _size(self) -> int:
+        """Vectores escritos (también los de documentos borrados o reemplazados)"""
+        path = self._file(FACTORS_FILE)
+        return os.path.getsize(path) // 8 if os.path.exists(path) else 0
+
+    def _load(self) -> Dict[str, Any]:
+        """Códigos en memoria, al día con los archivos (ingestas y anexos propios o de otros workers)"""
+        version = (self._size(), self._connect().execute("PRAGMA data_version").fetchone()[0])
+        if self._arrays is None or version != self._version:
+            size = version[0]
+            # Dimensiones guardadas en la base de datos: otro worker puede estar anexando a los archivos
+            dimensions = self._connect().execute("PRAGMA user_version").fetchone()[0]
+            factors = np.fromfile(self._file(FACTORS_FILE), dtype=np.float32, count=size * 2).reshape(size, 2) if size else np.zeros((0, 2), np.float32)
+            codes = np.fromfile(self._file(CODES_FILE), dtype=np.int8, count=size * dimensions) if size else np.zeros(0, np.int8)
+            alive = np.zeros(size, dtype=bool)
+            positions = np.array([row[0] for row in self._connect().execute("SELECT position FROM records")], dtype=np.int64)
+            alive[positions[positions < size]] = True
+            self._arrays = {"codes": codes.reshape(size, dimensions), "factors": factors, "alive": alive,
+                            "dimensions": dimensions}
+            self._version = version
+        return self._arrays
+
+    def _vectors(self, size: int, dimensions: int) -> np.memmap:
+        return np.memmap(self._file(VECTORS_FILE), dtype=np.float32, mode="r", shape=(size, dimensions))
+
+    # Escritura
+
+    def _positions(self, ids: Sequence[str], existing: Dict[str, int], dimensions: int) -> np.ndarray:
+        """Posición de cada vector que se escribe: la del documento al que reemplaza o, para los
+        nuevos, un hueco de un documento borrado o reemplazado; sin huecos, a continuación de los
+        archivos. Así los archivos y los códigos en memoria no crecen con cada upsert"""
+        size = self._size()
+        if not size or self._connect().execute("PRAGMA user_version").fetchone()[0] != dimensions:
+            # Colección vacía o de otro modelo: todo se añade al final
+            return np.arange(size, size + len(ids), dtype=np.int64)
+        free = iter(np.flatnonzero(~self._load()["alive"]).tolist())
+        positions = np.empty(len(ids), dtype=np.int64)
+        appended = size
+        for offset, document_id in enumerate(ids):
+            position = existing.get(document_id)
+            if position is None:
+                position = next(free, None)
+            if position is None:
+                position, appended = appended, appended + 1
+            positions[offset] = position
+        return positions
+
+    def _store(self, name: str, positions: np.ndarray, values: np.ndarray, size: int):
+        """Escribe las filas de values en sus posiciones del archivo: en su sitio las que reutilizan
+        una posición y en un único bloque al final las nuevas (consecutivas desde size)"""
+        values = np.ascontiguousarray(values)
+        in_place = np.flatnonzero(positions < size)
+        if len(in_place):
+            row_bytes = values[0].nbytes
+            with open(self._file(name), "r+b") as f:
+                for index in in_place[np.argsort(positions[in_place], kind="stable")]:
+                    f.seek(int(positions[index]) * row_bytes)
+                    f.write(values[index].tobytes())
+        appended = positions >= size
+        if appended.any():
+            with open(self._file(name), "ab") as f:
+                f.write(values[appended].tobytes())
+
+    def _embed(self, documents: Sequence[str], embeddings) -> np.ndarray:
+        if embeddings is None:
+            embeddings = self._embedding_function(list(documents))
+        return np.asarray(embeddings, dtype=np.float32)
+
+    def _write(self, ids, documents, metadatas, embeddings, replace: bool):
+        documents = documents if documents is not None else [None] * len(ids)
+        metadatas = metadatas if metadatas is not None else [None] * len(ids)
+        with self._lock:
+            connection = self._connect()
+            existing = {}
+            for start in range(0, len(ids), 500):
+                batch = list(ids[start:start + 500])
+                existing.update(connection.execute(
+                    f"SELECT id, position FROM records WHERE id IN ({', '.join('?' * len(batch))})", batch
+                ))
+            # Como en ChromaDB, add ignora los IDs que ya existen
+            keep = [i for i, document_id in enumerate(ids) if replace or document_id not in existing]
+            if not keep:
+                return
+            vectors = self._embed([documents[i] for i in keep], None if embeddings is None else [embeddings[i] for i in keep])
+            codes, factors = quantize(vectors)
+            size = self._size()
+            positions = self._positions([ids[i] for i in keep], existing, vectors.shape[1])
+            # Primero los vectores: un registro nunca apunta a un vector sin escribir
+            for name, values in ((VECTORS_FILE, vectors), (CODES_FILE, codes), (FACTORS_FILE, factors)):
+                self._store(name, positions, values, size)
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(f"PRAGMA user_version = {int(vectors.shape[1])}")
+                connection.executemany(
+                    "INSERT OR REPLACE INTO records (position, id, document, metadata) VALUES (?, ?, ?, ?)",
+                    [(int(positions[offset]), ids[i], documents[i], json.dumps(metadatas[i], ensure_ascii=False))
+                     for offset, i in enumerate(keep)]
+                )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            self._arrays = None
+
+    def add(self, ids, documents=None, metadatas=None, embeddings=None):
+        self._write(ids, documents, metadatas, embeddings, replace=False)
+
+    def upsert(self, ids, documents=None, metadatas=None, embeddings=None):
+        # Los documentos que ya existen se sobrescriben en su misma posición
+        self._write(ids, documents, metadatas, embeddings, replace=True)
+
+    def delete(self, ids=None, where=None):
+        with self._lock:
+            connection = self._connect()
+            if ids:
+                connection.executemany("DELETE FROM records WHERE id = ?", [(document_id,) for document_id in ids])
+            if where:
+                clause, parameters = where_clause(where)
+                connection.execute(f"DELETE FROM records WHERE {clause}", parameters)
+            self._arrays = None
+
+    # Lectura
+
+    def _records(self, positions: Sequence[int]) -> Dict[int, Tuple[str, str, Optional[Dict[str, Any]]]]:
+        records = {}
+        connection = self._connect()
+        positions = [int(position) for position in positions]
+        for start in range(0, len(positions), 500):
+            batch = positions[start:start + 500]
+            for position, document_id, document, metadata in connection.execute(
+                f"SELECT position, id, document, metadata FROM records WHERE position IN ({', '.join('?' * len(batch))})",
+                batch
+            ):
+                records[position] = (document_id, document, json.loads(metadata) if metadata else None)
+        return records
+
+    def get(self, ids=None, where=None, limit: int = None, offset: int = None, include=("metadatas", "documents")):
+        with self._lock:
+            clauses, parameters = [], []
+            if ids is not None:
+                clauses.append(f"id IN ({', '.join('?' * len(ids))})")
+                parameters.extend(ids)
+            if where:
+                clause, where_parameters = where_clause(where)
+                clauses.append(clause)
+                parameters.extend(where_parameters)
+            statement = f"SELECT position FROM records WHERE {' AND '.join(clauses) or '1'} ORDER BY position"
+            if limit is not None:
+                statement += f" LIMIT {int(limit)} OFFSET {int(offset or 0)}"
+            positions = [row[0] for row in self._connect().execute(statement, parameters)]
+            return self._result(positions, self._records(positions), include)
+
+    def peek(self, limit: int = 10):
+        return self.get(limit=limit, include=("metadatas", "documents", "embeddings"))
+
+    def _result(self, positions, records, include, distances=None) -> Dict[str, Any]:
+        result = {"ids": [records[position][0] for position in positions]}
+        if "documents" in include:
+            result["documents"] = [records[position][1] for position in positions]
+        if "metadatas" in include:
+            result["metadatas"] = [records[position][2] for position in positions]
+        if "embeddings" in include:
+            arrays = self._load()
+            vectors = self._vectors(len(arrays["factors"]), arrays["dimensions"])
+            result["embeddings"] = [vectors[position].tolist() for position in positions]
+        if distances is not None and "distances" in include:
+            result["distances"] = distances
+        return result
+
+    def _search(self, query: np.ndarray, n_results: int, candidates: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """Posiciones y distancias L2² de los n_results vecinos: puntuación int8 y reordenación exacta"""
+        arrays = self._load()
+        codes, factors, alive = arrays["codes"], arrays["factors"], arrays["alive"]
+        wanted = max(n_results, self.rerank_candidates)
+        # Distancia aproximada sin el término de la consulta (constante): ‖v‖² - 2·escala·(códigos·q)
+        best_positions, best_scores = [], []
+        if candidates is None:
+            blocks = ((np.arange(start, min(start + SCORE_BLOCK_ROWS, len(codes))), slice(start, start + SCORE_BLOCK_ROWS))
+                      for start in range(0, len(codes), SCORE_BLOCK_ROWS))
+        else:
+            blocks = ((candidates[start:start + SCORE_BLOCK_ROWS], candidates[start:start + SCORE_BLOCK_ROWS])
+                      for start in range(0, len(candidates), SCORE_BLOCK_ROWS))
+        for positions, selection in blocks:
+            scores = factors[selection, 1] - 2 * factors[selection, 0] * (codes[selection].astype(np.float32) @ query)
+            scores[~alive[positions]] = np.inf
+            if len(scores) > wanted:
+                top = np.argpartition(scores, wanted)[:wanted]
+                positions, scores = positions[top], scores[top]
+            best_positions.append(positions)
+            best_scores.append(scores)
+        if not best_positions:
+            return np.zeros(0, np.int64), np.zeros(0, np.float32)
+        positions = np.concatenate(best_positions)
+        scores = np.concatenate(best_scores)
+        keep = np.isfinite(scores)
+        positions, scores = positions[keep], scores[keep]
+        if len(scores) > wanted:
+            positions = positions[np.argpartition(scores, wanted)[:wanted]]
+        # Reordenación con los vectores completos, leídos en orden de archivo del mapa de memoria
+        positions = np.sort(positions)
+        vectors = self._vectors(len(factors), arrays["dimensions"])[positions]
+        distances = ((vectors - query) ** 2).sum(axis=1)
+        order = np.argsort(distances, kind="stable")[:n_results]
+        return positions[order], distances[order]
+
+    def query(self, query_embeddings=None, query_texts=None, n_results: int = 10, where=None,
+              include=("metadatas", "documents", "distances")):
+        if query_embeddings is None:
+            query_embeddings = self._embedding_function(list(query_texts))
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        with self._lock:
+            candidates = None
+            if where:
+                clause, parameters = where_clause(where)
+                candidates = np.array(
+                    [row[0] for row in self._connect().execute(f"SELECT position FROM records WHERE {clause}", parameters)],
+                    dtype=np.int64
+                )
+            results = {key: [] for key in ("ids", *include)}
+            for query in queries:
+                positions, distances = self._search(query, n_results, candidates)
+                result = self._result(positions, self._records(positions), include, distances.tolist())
+                for key in results:
+                    results[key].append(result.get(key, []))
+            return results
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+            self._arrays = None
+
+
+class QuantizedClient:
+    """Cliente con la API de ChromaDB usada por DatasetRegistry, con una colección comprimida
+    por directorio en VECTOR_STORE_PATH"""
+
+    def __init__(self, path: str = None):
+        self.path = path or settings["vector_store_path"]
+        os.makedirs(self.path, exist_ok=True)
+
+    def _collection(self, name: str, embedding_function=None) -> QuantizedCollection:
+        return QuantizedCollection(os.path.join(self.path, name), name, embedding_function)
+
+    def get_collection(self, name: str, embedding_function=None) -> QuantizedCollection:
+        if not os.path.exists(os.path.join(self.path, name, METADATA_FILE)):
+            raise ValueError(f"Collection {name} does not exist.")
+        return self._collection(name, embedding_function)
+
+    def create_collection(self, name: str, embedding_function=None, metadata: Dict[str, Any] = None) -> QuantizedCollection:
+        if os.path.exists(os.path.join(self.path, name, METADATA_FILE)):
+            raise ValueError(f"Collection {name} already exists.")
+        os.makedirs(os.path.join(self.path, name), exist_ok=True)
+        collection = self._collection(name, embedding_function)
+        collection.modify(metadata=metadata)
+        return collection
+
+    def delete_collection(self, name: str):
+        path = os.path.join(self.path, name)
+        if not os.path.exists(path):
+            raise ValueError(f"Collection {name} does not exist.")
+        shutil.rmtree(path)
+
+    def list_collections(self) -> List[QuantizedCollection]:
+        return [self._collection(name) for name in sorted(os.listdir(self.path))
+                if os.path.exists(os.path.join(self.path, name, METADATA_FILE))]
@@ -1,107 +1,593 @@
-import chromadb
 import logging
+import os
 import pandas as pd
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
 from config import settings
+from rag.datasets import DEFAULT_TENANT, DatasetCatalog, DatasetRegistry, file_hashes, tenant_slug
+from rag.dedup import OFF, SUM, RowDeduplicator
+from rag.embedding_cache import CachedEmbeddingFunction, embedding_cache
+from rag.embeddings import EmbeddingService
+from rag.granularity import DocumentGranularity
 from rag.processor import DataProcessor
+from rag.rollups import MEASURES, ROLLUP_BASE_TABLE, ROLLUP_DOCUMENT, ROLLUP_TABLE, RollupService
+from rag.stats_state import STATS_STATE, read_json, summary_from_json, summary_to_json, write_json
+from rag.table_store import ROW_COLUMN, table_store
+from rag.vector_store import collections_memory_bytes, get_client, is_persistent, is_shared, store_lock
+from services.excel_template_service import TemplatePlan
+from services.memory_service import MemoryBudgetExceeded, memory_service
+from utils.metrics import DEDUP_ROWS_REMOVED_TOTAL, INGESTED_DOCUMENTS_TOTAL, span
 
 logger = logging.getLogger(__name__)
 
 class RAGRetriever:
+    # Documentos por llamada a collection.add
+    BATCH_SIZE = 50
+    # Las consultas de resumen añaden los documentos de estadísticas al contexto
+    SUMMARY_KEYWORDS = ("total", "resumen", "estadística", "general")
+    STATS_QUERY = "estadísticas resumen general"
+    STATS_RESULTS = 4
+    # Documentos de rollup más parecidos que se añaden si la pregunta no cita ningún grupo
+    ROLLUP_RESULTS = 2
+    
     def __init__(self):
-        self.chroma_client = chromadb.Client()
-        self.collection_name = settings["collection_name"]
+        self.chroma_client = get_client()
         self.processor = DataProcessor()
+        self.embedding_function = self._resolve_embedding_function()
+        self.tables = table_store
+        # Cubo de agregados por dataset para responder preguntas a nivel de grupo
+        self.rollups = RollupService(self.tables)
+        # Una colección por (inquilino, hash del contenido) en lugar de una global; los
+        # activos se comparten con los demás workers si el almacén también es compartido
+        self.datasets = DatasetRegistry(
+            self.chroma_client, self.embedding_function,
+            persistent=is_persistent(), memory_bytes=collections_memory_bytes(),
+            catalog=DatasetCatalog(settings["dataset_catalog_path"] if is_shared() else None),
+            tables=self.tables
+        )
+        self._stats_query_embedding = None
+        # Último error de ingesta, para informar del estado en /health/ready
+        self.last_error = None
+        self.last_dataset: Optional[Dict[str, Any]] = None
+    
+    @staticmethod
+    def _resolve_embedding_function():
+        """Función de embedding explícita (la misma que usaría ChromaDB por defecto) para medir y reutilizar embeddings de consulta"""
+        embedding_function = EmbeddingService().get_embedding_function()
+        if embedding_function is None:
+            from chromadb.utils import embedding_functions
+            embedding_function = embedding_functions.DefaultEmbeddingFunction()
+        # Reingestar textos ya vistos no vuelve a ejecutar el modelo
+        if embedding_cache.enabled:
+            embedding_function = CachedEmbeddingFunction(embedding_function, embedding_cache)
+        return embedding_function
+        
+    def ingest_dataset(self, csv_path: str, tenant: str = DEFAULT_TENANT, plan: Dict[str, Any] = None,
+                       template: TemplatePlan = None, granularity: DocumentGranularity = None,
+                       dedup: RowDeduplicator = None) -> Dict[str, Any]:
+        """Indexa un CSV en la colección de su dataset y lo activa para el inquilino.
+        Con template se lee con el plan de esa plantilla de Excel en lugar de como facturas.
+        granularity decide cuántas filas van en cada documento y dedup qué filas repetidas se
+        descartan antes de crearlos (por defecto, lo de la configuración).
+        Si el mismo contenido ya está indexado con las mismas opciones solo se activa."""
+        granularity = granularity or DocumentGranularity()
+        dedup = dedup or RowDeduplicator()
+        # El contenido sin opciones identifica el archivo de origen (lo usa DuckDB para encontrar el dataset)
+        dataset_id, source_hash = file_hashes(csv_path, granularity.signature() + dedup.signature(), "")
+        dataset = {"dataset_id": dataset_id, "tenant": tenant_slug(tenant), "source": os.path.basename(csv_path),
+                   "granularity": granularity.mode}
+        if template is not None:
+            dataset["template"] = template.name
+        # Una sola ingesta a la vez entre todos los workers: el que llega después reutiliza el dataset
+        with store_lock:
+            result = self._ingest_locked(csv_path, tenant, dataset, plan, template, granularity, dedup)
+        self.datasets.catalog.set_source(tenant_slug(tenant), source_hash, dataset_id)
+        return result
+    
+    def _ingest_locked(self, csv_path: str, tenant: str, dataset: Dict[str, Any], plan: Dict[str, Any],
+                       template: TemplatePlan = None, granularity: DocumentGranularity = None,
+                       dedup: RowDeduplicator = None) -> Dict[str, Any]:
+        dataset_id = dataset["dataset_id"]
+        existing = self.datasets.get(tenant, dataset_id)
+        if existing is not None:
+            if self.tables.enabled and not (self.tables.exists(tenant, dataset_id)
+                                            and self.tables.exists(tenant, dataset_id, ROLLUP_TABLE)):
+                # Dataset indexado antes de existir el almacén columnar: solo faltan sus tablas
+                self._build_table(csv_path, tenant, dataset_id, template,
+                                  RowDeduplicator.from_metadata(existing.metadata or {}))
+            self.datasets.activate(tenant, dataset_id)
+            logger.info(f"Dataset {dataset_id} ya indexado: se reutiliza sin reingestar")
+            return {**dataset, "documents": existing.count(), "reused": True}
         
-    def initialize_collection(self, csv_path: str) -> bool:
+        # Comprobar el presupuesto de memoria antes de crear la colección
+        plan = plan or memory_service.plan_ingestion(csv_path)
+        collection = self.datasets.create(tenant, dataset_id, dataset["source"], dataset.get("template"),
+                                          {**granularity.to_metadata(), **dedup.to_metadata()})
+        try:
+            # Cargar, procesar e indexar los datos (por bloques si no caben completos en memoria)
+            logger.info(f"Cargando datos desde {csv_path} en {collection.name} (modo {plan['mode']})")
+            with self.tables.writer(tenant, dataset_id) as table:
+                if template is not None:
+                    chunk_rows = plan["chunk_rows"] if plan["mode"] == "chunked" else None
+                    state = self._ingest_template(collection, csv_path, template, chunk_rows, table, granularity, dedup)
+                elif plan["mode"] == "chunked":
+                    state = self._ingest_chunked(collection, csv_path, plan["chunk_rows"], table, granularity, dedup)
+                else:
+                    state = self._ingest_full(collection, csv_path, table, granularity, dedup)
+            builder = template.rollup_builder() if template is not None else None
+            total = state["documents"] + self._index_rollups(collection, tenant, dataset_id, state["rollup"], builder)
+            # Agregados combinables para anexar filas sin recalcular todo el dataset (solo facturas)
+            if template is None:
+                self._save_state(tenant, dataset_id, state)
+        except Exception:
+            # No dejar un dataset a medias: el activo anterior sigue disponible
+            self.datasets.delete(tenant, dataset_id)
+            raise
+        self.datasets.mark_ready(collection, total)
+        self.datasets.activate(tenant, dataset_id)
+        self.datasets.evict()
+        INGESTED_DOCUMENTS_TOTAL.inc(total)
+        DEDUP_ROWS_REMOVED_TOTAL.inc(dedup.rows_removed)
+        logger.info(f"Datos cargados en ChromaDB: {total} documentos ({state['rows']} filas, granularidad {granularity.mode}, "
+                    f"{dedup.rows_removed} filas repetidas descartadas)")
+        return {**dataset, "documents": total, "rows": state["rows"], "reused": False, "ingest_mode": plan["mode"],
+                "dedup": dedup.report()}
+    
+    def initialize_collection(self, csv_path: str, plan: Dict[str, Any] = None, tenant: str = DEFAULT_TENANT) -> bool:
         """Configura la colección de ChromaDB a partir de un archivo CSV"""
         try:
-            # Eliminar colección si existe
-            try:
-                self.chroma_client.delete_collection(self.collection_name)
-                logger.info(f"Colección anterior {self.collection_name} eliminada")
-            except:
-                pass
-            
-            # Crear nueva colección
-            collection = self.chroma_client.create_collection(name=self.collection_name)
-            
-            # Cargar y procesar datos
-            logger.info(f"Cargando datos desde {csv_path}")
-            df = pd.read_csv(csv_path)
-            
-            # Verificar columnas necesarias
-            required_columns = ["fecha", "cliente", "pais", "importe"]
-            missing_columns = [col for col in required_columns if col not in df.columns]
-            if missing_columns:
-                raise ValueError(f"Faltan columnas requeridas: {missing_columns}")
-            
-            # Procesar datos
-            df_processed = self.processor.process_dataframe(df)
-            logger.info(f"Datos procesados: {len(df_processed)} registros válidos")
-            
-            # Crear documentos
-            documents, metadatas, ids = self.processor.create_documents(df_processed)
-            
-            # Añadir documentos a ChromaDB
-            batch_size = 50  # Procesar en lotes para evitar problemas de memoria
-            for i in range(0, len(documents), batch_size):
-                end_idx = min(i + batch_size, len(documents))
-                collection.add(
-                    documents=documents[i:end_idx],
-                    metadatas=metadatas[i:end_idx],
-                    ids=ids[i:end_idx]
-                )
-            
-            logger.info(f"Datos cargados en ChromaDB: {len(documents)} documentos")
+            self.last_dataset = self.ingest_dataset(csv_path, tenant=tenant, plan=plan)
+            self.last_error = None
             return True
-            
         except Exception as e:
             logger.error(f"Error configurando la colección: {str(e)}")
-            # Crear colección de respaldo con mensaje de error
-            collection = self.chroma_client.create_collection(name=self.collection_name)
-            collection.add(
-                documents=["Error cargando datos de facturas: " + str(e)],
-                ids=["error_1"]
-            )
+            self.last_error = str(e)
+            if isinstance(e, MemoryBudgetExceeded):
+                raise
             return False
     
-    async def query(self, user_query: str, k: int = 6) -> Dict[str, Any]:
-        """Realiza una consulta y recupera documentos relevantes"""
-        try:
-            collection = self.chroma_client.get_collection(self.collection_name)
-            
-            # Consultar ChromaDB
-            results = collection.query(
-                query_texts=[user_query],
-                n_results=k
+    @staticmethod
+    def _check_columns(df: pd.DataFrame):
+        # Verificar columnas necesarias
+        required_columns = ["fecha", "cliente", "pais", "importe"]
+        missing_columns = [col for col in required_columns if col not in df.columns]
+        if missing_columns:
+            raise ValueError(f"Faltan columnas requeridas: {missing_columns}")
+    
+    def _dedup_columns(self, csv_path: str, template: TemplatePlan = None,
+                       columns: List[str] = None) -> Tuple[List[str], List[str]]:
+        """Columnas clave por defecto y medidas de la deduplicación de un dataset de plantilla o de
+        facturas (las columnas indicadas o, si no, las de la cabecera del CSV)"""
+        if template is not None:
+            return template.columns, template.numeric_columns
+        if columns is None:
+            columns = list(pd.read_csv(csv_path, nrows=0).columns)
+        return self.processor.dedup_keys(columns), self.processor.MEASURES
+    
+    def _add_documents(self, collection, documents, metadatas, ids, upsert: bool = False):
+        # Procesar en lotes para evitar problemas de memoria; al menos un lote completo del modelo de embeddings
+        batch_size = max(self.BATCH_SIZE, getattr(self.embedding_function, "batch_size", 0))
+        write = collection.upsert if upsert else collection.add
+        for i in range(0, len(documents), batch_size):
+            end_idx = min(i + batch_size, len(documents))
+            write(
+                documents=documents[i:end_idx],
+                metadatas=metadatas[i:end_idx],
+                ids=ids[i:end_idx]
             )
-            
-            # Obtener documentos e ids
-            documents = results["documents"][0]
-            
-            # Agregar estadísticas generales para consultas de resumen
-            if any(palabra in user_query.lower() for palabra in ["total", "resumen", "estadística", "general"]):
-                # Buscar documentos de estadísticas
-                try:
-                    stats_results = collection.query(
-                        query_texts=["estadísticas resumen general"],
-                        where={"tipo": "estadistica"},
-                        n_results=4
+    
+    def _read_processed(self, csv_path: str, chunk_rows: int, template: TemplatePlan = None):
+        """Bloques procesados de un CSV de facturas o de una plantilla"""
+        if template is not None:
+            return (template.transform(chunk) for chunk in template.read(csv_path, chunk_rows))
+        return (self.processor.process_dataframe(chunk) for chunk in pd.read_csv(csv_path, chunksize=chunk_rows))
+    
+    def _build_table(self, csv_path: str, tenant: str, dataset_id: str, template: TemplatePlan = None,
+                     dedup: RowDeduplicator = None):
+        """Genera solo las tablas columnares de un dataset (filas y rollups), por bloques y con
+        las mismas filas repetidas descartadas que su colección"""
+        rollup = None
+        builder = template.rollup_builder() if template is not None else self.rollups.builder
+        dedup = dedup or RowDeduplicator()
+        columns = self._dedup_columns(csv_path, template)
+        if dedup.mode == SUM:
+            dedup.scan(self._read_processed(csv_path, memory_service.chunk_rows, template), *columns)
+        with span("ingest_table", path=csv_path):
+            with self.tables.writer(tenant, dataset_id) as table:
+                for chunk in self._read_processed(csv_path, memory_service.chunk_rows, template):
+                    chunk = dedup.apply(chunk, *columns)
+                    table.write(chunk)
+                    rollup = builder.merge(rollup, builder.partial(chunk))
+            self._write_rollups(tenant, dataset_id, builder.cube(rollup), builder)
+    
+    def _write_rollups(self, tenant: str, dataset_id: str, cube: Optional[pd.DataFrame], builder=None):
+        if cube is None:
+            return
+        builder = builder or self.rollups.builder
+        with self.tables.writer(tenant, dataset_id, ROLLUP_TABLE, metadata={"measure": builder.measure}) as table:
+            if table is not None:
+                table.write(cube)
+        self.rollups.forget(tenant, dataset_id)
+    
+    def _index_rollups(self, collection, tenant: str, dataset_id: str, rollup: Optional[pd.DataFrame],
+                       builder=None) -> int:
+        """Cubo de agregados del dataset: tabla en el almacén columnar y documentos compactos en la colección"""
+        builder = builder or self.rollups.builder
+        with span("ingest_rollups") as attributes:
+            cube = builder.cube(rollup)
+            self._write_rollups(tenant, dataset_id, cube, builder)
+            documents, metadatas, ids = builder.create_documents(cube)
+            self._add_documents(collection, documents, metadatas, ids)
+            attributes["groups"] = 0 if cube is None else len(cube)
+            attributes["documents"] = len(documents)
+        return len(documents)
+    
+    def _ingest_full(self, collection, csv_path: str, table=None,
+                     granularity: DocumentGranularity = None, dedup: RowDeduplicator = None) -> Dict[str, Any]:
+        """Ingesta con el archivo completo en memoria; devuelve los documentos y los agregados combinables
+        de las filas que quedan tras descartar las repetidas"""
+        with span("ingest_parse", path=csv_path) as attributes:
+            df = pd.read_csv(csv_path)
+            attributes["rows"] = len(df)
+        self._check_columns(df)
+        
+        # Procesar datos
+        with span("ingest_process"):
+            df_processed = self.processor.process_dataframe(df)
+        del df
+        dedup = dedup or RowDeduplicator(OFF)
+        with span("ingest_dedup", mode=dedup.mode) as attributes:
+            columns = self._dedup_columns(csv_path, columns=list(df_processed.columns))
+            df_processed = dedup.apply(df_processed, *columns)
+            attributes["rows_removed"] = dedup.rows_removed
+        memory_service.track_dataframe(f"ingest:{os.path.basename(csv_path)}", df_processed)
+        logger.info(f"Datos procesados: {len(df_processed)} registros válidos")
+        
+        # Conservar los datos tipados para leer filas exactas sin volver al CSV
+        if table is not None:
+            with span("ingest_table"):
+                table.write(df_processed)
+        
+        # Crear documentos
+        with span("ingest_documents"):
+            documents, metadatas, ids = self.processor.create_row_documents(df_processed, granularity)
+            summary = self.processor.summarize(df_processed)
+            stats_documents, stats_metadatas, stats_ids = self.processor.create_summary_documents(summary)
+            documents.extend(stats_documents)
+            metadatas.extend(stats_metadatas)
+            ids.extend(stats_ids)
+            rollup = self.rollups.builder.partial(df_processed)
+        rows = len(df_processed)
+        next_row = self._next_row(df_processed, 0)
+        del df_processed
+        
+        # Añadir documentos a ChromaDB (incluye el cálculo de embeddings)
+        with span("ingest_index", documents=len(documents)):
+            self._add_documents(collection, documents, metadatas, ids)
+        return {"documents": len(documents), "rows": rows, "summary": summary,
+                "rollup": rollup, "next_row": next_row}
+    
+    def _ingest_chunked(self, collection, csv_path: str, chunk_rows: int, table=None,
+                        granularity: DocumentGranularity = None, dedup: RowDeduplicator = None) -> Dict[str, Any]:
+        """Ingesta por bloques: solo un bloque de filas y sus documentos en memoria a la vez.
+        Las estadísticas se calculan combinando los agregados de cada bloque (y los grupos de
+        documentos, dentro de cada bloque). Las filas repetidas se descartan en todo el archivo:
+        con la semántica sum, tras una primera pasada que suma las medidas de cada clave."""
+        total = 0
+        rows = 0
+        summary = None
+        rollup = None
+        next_row = 0
+        dedup = dedup or RowDeduplicator(OFF)
+        columns = self._dedup_columns(csv_path)
+        with span("ingest_chunked", path=csv_path, chunk_rows=chunk_rows) as attributes:
+            if dedup.mode == SUM:
+                with span("ingest_dedup_scan"):
+                    dedup.scan(self._read_processed(csv_path, chunk_rows), *columns)
+            for chunk_number, chunk in enumerate(pd.read_csv(csv_path, chunksize=chunk_rows)):
+                if chunk_number == 0:
+                    self._check_columns(chunk)
+                chunk = dedup.apply(self.processor.process_dataframe(chunk), *columns)
+                if table is not None:
+                    table.write(chunk)
+                documents, metadatas, ids = self.processor.create_row_documents(chunk, granularity)
+                summary = self.processor.merge_summaries(summary, self.processor.summarize(chunk))
+                rollup = self.rollups.builder.merge(rollup, self.rollups.builder.partial(chunk))
+                next_row = self._next_row(chunk, next_row)
+                self._add_documents(collection, documents, metadatas, ids)
+                total += len(documents)
+                rows += len(chunk)
+                memory_service.ensure_within_budget(f"la ingesta del bloque {chunk_number}")
+            
+            documents, metadatas, ids = self.processor.create_summary_documents(summary)
+            self._add_documents(collection, documents, metadatas, ids)
+            total += len(documents)
+            attributes.update(documents=total, rows_removed=dedup.rows_removed)
+        return {"documents": total, "rows": rows, "summary": summary, "rollup": rollup, "next_row": next_row}
+    
+    def _ingest_template(self, collection, csv_path: str, template: TemplatePlan, chunk_rows: int = None,
+                         table=None, granularity: DocumentGranularity = None,
+                         dedup: RowDeduplicator = None) -> Dict[str, Any]:
+        """Ingesta con el plan compilado de una plantilla de Excel, por bloques si se indica chunk_rows:
+        lectura en texto, conversión por columna, filas repetidas, documentos, estadísticas y nivel fino del cubo"""
+        total = 0
+        rows = 0
+        summary = None
+        rollup = None
+        builder = template.rollup_builder()
+        dedup = dedup or RowDeduplicator(OFF)
+        columns = self._dedup_columns(csv_path, template)
+        with span("ingest_template", path=csv_path, template=template.name) as attributes:
+            if dedup.mode == SUM and chunk_rows:
+                with span("ingest_dedup_scan"):
+                    dedup.scan(self._read_processed(csv_path, chunk_rows, template), *columns)
+            for chunk_number, chunk in enumerate(template.read(csv_path, chunk_rows)):
+                with span("ingest_process"):
+                    chunk = dedup.apply(template.transform(chunk), *columns)
+                if table is not None:
+                    table.write(chunk)
+                with span("ingest_documents"):
+                    documents, metadatas, ids = template.create_documents(chunk, granularity)
+                    summary = template.merge_summaries(summary, template.summarize(chunk))
+                    rollup = builder.merge(rollup, builder.partial(chunk))
+                with span("ingest_index", documents=len(documents)):
+                    self._add_documents(collection, documents, metadatas, ids)
+                total += len(documents)
+                rows += len(chunk)
+                memory_service.ensure_within_budget(f"la ingesta del bloque {chunk_number}")
+            
+            documents, metadatas, ids = template.create_summary_documents(summary)
+            self._add_documents(collection, documents, metadatas, ids)
+            total += len(documents)
+            attributes.update(rows=rows, documents=total, rows_removed=dedup.rows_removed)
+        return {"documents": total, "rows": rows, "summary": summary, "rollup": rollup}
+    
+    @staticmethod
+    def _next_row(df: pd.DataFrame, current: int) -> int:
+        """Primer índice de fila libre tras un bloque procesado (los IDs de las filas anexadas siguen desde él)"""
+        return max(current, int(df.index.max()) + 1) if len(df) else current
+    
+    def _save_state(self, tenant: str, dataset_id: str, state: Dict[str, Any]):
+        """Guarda los agregados combinables del dataset: resumen, nivel fino del cubo y siguiente índice de fila"""
+        if not self.tables.enabled:
+            return
+        if state["rollup"] is not None:
+            with self.tables.writer(tenant, dataset_id, ROLLUP_BASE_TABLE) as table:
+                table.write(state["rollup"].reset_index())
+        # El JSON se escribe el último: si existe, el nivel fino del cubo ya está completo
+        write_json(self.tables.state_path(tenant, dataset_id, STATS_STATE), {
+            "next_row": state["next_row"],
+            "summary": summary_to_json(state["summary"]) if state["summary"] is not None else None
+        })
+    
+    def _load_state(self, tenant: str, dataset_id: str) -> Optional[Dict[str, Any]]:
+        data = read_json(self.tables.state_path(tenant, dataset_id, STATS_STATE)) if self.tables.enabled else None
+        if data is None:
+            return self._state_from_table(tenant, dataset_id)
+        rollup = None
+        base = self.tables.table(tenant, dataset_id, ROLLUP_BASE_TABLE)
+        if base is not None:
+            frame = base.to_pandas().drop(columns=[ROW_COLUMN])
+            rollup = frame.set_index([column for column in frame.columns if column not in MEASURES])
+        summary = summary_from_json(data["summary"]) if data["summary"] is not None else None
+        return {"summary": summary, "rollup": rollup, "next_row": data["next_row"]}
+    
+    def _state_from_table(self, tenant: str, dataset_id: str) -> Optional[Dict[str, Any]]:
+        """Agregados de un dataset indexado antes de guardarse su estado, leyendo su tabla columnar por lotes"""
+        table = self.tables.table(tenant, dataset_id) if self.tables.enabled else None
+        if table is None:
+            return None
+        state = {"summary": None, "rollup": None, "next_row": 0}
+        with span("stats_rebuild", rows=table.num_rows):
+            for batch in table.to_batches(max_chunksize=memory_service.chunk_rows):
+                chunk = batch.to_pandas().set_index(ROW_COLUMN)
+                state["summary"] = self.processor.merge_summaries(state["summary"], self.processor.summarize(chunk))
+                state["rollup"] = self.rollups.builder.merge(state["rollup"], self.rollups.builder.partial(chunk))
+                state["next_row"] = self._next_row(chunk, state["next_row"])
+        return state
+    
+    def _sync_documents(self, collection, before, after) -> int:
+        """Actualiza en la colección solo los documentos derivados cuyo texto cambia y borra los que
+        desaparecen; devuelve cuántos se han vuelto a indexar"""
+        previous = dict(zip(before[2], before[0]))
+        documents, metadatas, ids = [], [], []
+        for document, metadata, document_id in zip(*after):
+            if previous.get(document_id) != document:
+                documents.append(document)
+                metadatas.append(metadata)
+                ids.append(document_id)
+        self._add_documents(collection, documents, metadatas, ids, upsert=True)
+        removed = sorted(set(previous) - set(after[2]))
+        if removed:
+            collection.delete(ids=removed)
+        return len(ids)
+    
+    def _read_append(self, csv_path: str, start: int):
+        """Bloques procesados de un anexo con índices a continuación de los del dataset (IDs de
+        documento y de fila nuevos), junto al primer índice libre tras cada bloque"""
+        for chunk_number, chunk in enumerate(pd.read_csv(csv_path, chunksize=memory_service.chunk_rows)):
+            if chunk_number == 0:
+                self._check_columns(chunk)
+            chunk.index = pd.RangeIndex(start, start + len(chunk))
+            start += len(chunk)
+            yield start, self.processor.process_dataframe(chunk)
+    
+    def _remember_rows(self, tenant: str, dataset_id: str, dedup: RowDeduplicator,
+                       csv_path: str) -> Tuple[List[str], List[str]]:
+        """Registra en dedup las filas que ya tiene el dataset, leyendo su tabla columnar por lotes;
+        devuelve las columnas clave por defecto y las medidas de la deduplicación del anexo"""
+        table = self.tables.table(tenant, dataset_id) if dedup.enabled and self.tables.enabled else None
+        if table is None:
+            if dedup.enabled:
+                logger.warning(f"Dataset {dataset_id} sin tabla columnar: el anexo solo se deduplica consigo mismo")
+            return self._dedup_columns(csv_path)
+        columns = self._dedup_columns(csv_path, columns=[name for name in table.column_names if name != ROW_COLUMN])
+        with span("append_dedup_index", rows=table.num_rows):
+            for batch in table.to_batches(max_chunksize=memory_service.chunk_rows):
+                dedup.remember(batch.to_pandas(), *columns)
+        return columns
+    
+    def append_rows(self, csv_path: str, tenant: str = DEFAULT_TENANT, dataset_id: str = None) -> Dict[str, Any]:
+        """Anexa las filas de un CSV a un dataset ya indexado (por defecto, el activo del inquilino).
+        
+        Solo se procesan e indexan las filas nuevas: los agregados guardados del dataset se
+        combinan con los del anexo y se vuelven a indexar únicamente los documentos de
+        estadísticas y de rollups cuyo texto cambia. Con la deduplicación del dataset se descartan
+        también las filas que ya están en él (un periodo que se vuelve a exportar)."""
+        with store_lock:
+            dataset_id = dataset_id or self.datasets.active_id(tenant)
+            collection = self.datasets.get(tenant, dataset_id) if dataset_id else None
+            if collection is None:
+                raise ValueError(f"No hay un dataset indexado al que anexar filas para el inquilino {tenant_slug(tenant)}")
+            if (collection.metadata or {}).get("template"):
+                raise ValueError(f"El dataset {dataset_id} es de la plantilla {collection.metadata['template']}: "
+                                 f"solo se pueden anexar filas a datasets de facturas")
+            # Las filas anexadas se indexan con la granularidad del dataset (grupos propios del anexo)
+            granularity = DocumentGranularity.from_metadata(collection.metadata or {})
+            dedup = RowDeduplicator.from_metadata(collection.metadata or {})
+            state = self._load_state(tenant, dataset_id)
+            if state is None:
+                raise ValueError(f"El dataset {dataset_id} no tiene agregados guardados: vuelve a subir el archivo completo")
+            builder = self.rollups.builder
+            before_summary = self.processor.create_summary_documents(state["summary"])
+            before_rollups = builder.create_documents(builder.cube(state["rollup"]))
+            
+            rows = 0
+            with span("append", path=csv_path) as attributes:
+                columns = self._remember_rows(tenant, dataset_id, dedup, csv_path)
+                if dedup.mode == SUM:
+                    dedup.scan((chunk for _, chunk in self._read_append(csv_path, state["next_row"])), *columns)
+                with self.tables.appender(tenant, dataset_id) as table:
+                    for chunk_number, (next_row, chunk) in enumerate(self._read_append(csv_path, state["next_row"])):
+                        state["next_row"] = next_row
+                        chunk = dedup.apply(chunk, *columns)
+                        if table is not None:
+                            table.write(chunk)
+                        documents, metadatas, ids = self.processor.create_row_documents(chunk, granularity)
+                        self._add_documents(collection, documents, metadatas, ids)
+                        state["summary"] = self.processor.merge_summaries(state["summary"], self.processor.summarize(chunk))
+                        state["rollup"] = builder.merge(state["rollup"], builder.partial(chunk))
+                        rows += len(chunk)
+                        memory_service.ensure_within_budget(f"el anexo del bloque {chunk_number}")
+                
+                summary_updated = self._sync_documents(
+                    collection, before_summary, self.processor.create_summary_documents(state["summary"])
+                )
+                cube = builder.cube(state["rollup"])
+                self._write_rollups(tenant, dataset_id, cube)
+                rollups_updated = self._sync_documents(collection, before_rollups, builder.create_documents(cube))
+                self._save_state(tenant, dataset_id, state)
+                attributes.update(rows=rows, rows_removed=dedup.rows_removed,
+                                  summary_documents=summary_updated, rollup_documents=rollups_updated)
+            
+            documents = collection.count()
+            self.datasets.mark_ready(collection, documents)
+        INGESTED_DOCUMENTS_TOTAL.inc(rows + summary_updated + rollups_updated)
+        DEDUP_ROWS_REMOVED_TOTAL.inc(dedup.rows_removed)
+        logger.info(f"Dataset {dataset_id}: {rows} filas anexadas ({dedup.rows_removed} repetidas descartadas), "
+                    f"{summary_updated} documentos de estadísticas y {rollups_updated} de rollups actualizados")
+        return {
+            "dataset_id": dataset_id,
+            "tenant": tenant_slug(tenant),
+            "documents": documents,
+            "rows_added": rows,
+            "summary_documents_updated": summary_updated,
+            "rollup_documents_updated": rollups_updated,
+            "dedup": dedup.report()
+        }
+    
+    def rows(self, collection, ids: List[str], metadatas: List[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Filas tipadas de los documentos de fila recuperados (vacío si el dataset no tiene tabla).
+        Los documentos de grupo o bloque aportan las filas de origen de sus metadatos (row_ids)"""
+        metadata = collection.metadata or {}
+        row_ids = []
+        for document_id, document_metadata in zip(ids, metadatas or [None] * len(ids)):
+            row_ids.extend(DocumentGranularity.row_ids(document_metadata) or [document_id])
+        indexes = [index for index in map(self.processor.row_index, row_ids) if index is not None]
+        if not indexes or "dataset_id" not in metadata:
+            return []
+        with span("row_lookup", rows=len(indexes)):
+            return self.tables.lookup(metadata["tenant"], metadata["dataset_id"], indexes)
+    
+    def rollup_context(self, collection, user_query: str) -> List[str]:
+        """Documentos de rollup de los grupos citados en la pregunta ("cliente 2 en ES por mes")"""
+        metadata = collection.metadata or {}
+        if "dataset_id" not in metadata:
+            return []
+        return self.rollups.answer(metadata["tenant"], metadata["dataset_id"], user_query)
+    
+    async def query(self, user_query: str, k: int = 6, dataset_id: str = None, tenant: str = DEFAULT_TENANT) -> Dict[str, Any]:
+        """Realiza una consulta sobre el dataset de la sesión (o el activo del inquilino) y recupera documentos relevantes"""
+        try:
+            collection = self.datasets.resolve(tenant, dataset_id)
+            if collection is None:
+                missing = f"el dataset {dataset_id} no existe" if dataset_id else "no hay ningún dataset cargado"
+                return {
+                    "context": f"Error recuperando información: {missing}",
+                    "has_relevant_info": False
+                }
+            
+            # Embedding de la consulta
+            with span("embedding"):
+                query_embedding = self.embedding_function([user_query])
+            
+            # Consultar ChromaDB (los rollups no compiten con las filas por el top-k: van aparte)
+            with span("retrieval", k=k) as attributes:
+                results = collection.query(
+                    query_embeddings=query_embedding,
+                    where={"tipo": {"$ne": ROLLUP_DOCUMENT}},
+                    n_results=k
+                )
+                
+                # Obtener documentos e ids
+                documents = results["documents"][0]
+                ids = results["ids"][0]
+                metadatas = results["metadatas"][0]
+                
+                # Agregar estadísticas generales para consultas de resumen
+                if any(palabra in user_query.lower() for palabra in self.SUMMARY_KEYWORDS):
+                    # Buscar documentos de estadísticas
+                    try:
+                        # La consulta de estadísticas es fija: su embedding se calcula una sola vez
+                        if self._stats_query_embedding is None:
+                            self._stats_query_embedding = self.embedding_function([self.STATS_QUERY])
+                        stats_results = collection.query(
+                            query_embeddings=self._stats_query_embedding,
+                            where={"tipo": "estadistica"},
+                            n_results=self.STATS_RESULTS
+                        )
+                        # Añadir al contexto si no están ya incluidos
+                        for doc in stats_results["documents"][0]:
+                            if doc not in documents:
+                                documents.append(doc)
+                    except:
+                        pass  # Si no se puede filtrar por tipo, continuar
+                attributes["documents"] = len(documents)
+            
+            # Agregados precalculados del grupo por el que se pregunta, antes que los documentos recuperados
+            with span("rollups") as attributes:
+                rollup_documents = self.rollup_context(collection, user_query)
+                documents = rollup_documents + [doc for doc in documents if doc not in rollup_documents]
+                attributes["documents"] = len(rollup_documents)
+                # Sin grupo citado, los documentos de rollup más parecidos van detrás de las filas
+                if not rollup_documents:
+                    rollup_results = collection.query(
+                        query_embeddings=query_embedding,
+                        where={"tipo": ROLLUP_DOCUMENT},
+                        n_results=self.ROLLUP_RESULTS
                     )
-                    # Añadir al contexto si no están ya incluidos
-                    for doc in stats_results["documents"][0]:
-                        if doc not in documents:
-                            documents.append(doc)
-                except:
-                    pass  # Si no se puede filtrar por tipo, continuar
+                    documents.extend(doc for doc in rollup_results["documents"][0] if doc not in documents)
+                    attributes["similar"] = len(rollup_results["documents"][0])
             
             # Construir contexto completo
-            context = "\n\n".join(documents)
+            with span("context_build") as attributes:
+                context = "\n\n".join(documents)
+                attributes["context_chars"] = len(context)
             
             return {
                 "context": context,
-                "has_relevant_info": len(documents) > 0
+                "has_relevant_info": len(documents) > 0,
+                # Valores exactos de las filas recuperadas, leídos del almacén columnar
+                "rows": self.rows(collection, ids, metadatas)
             }
                 
         except Exception as e:
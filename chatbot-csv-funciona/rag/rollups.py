@@ -0,0 +1,270 @@
+import logging
+import threading
+from collections import OrderedDict
+from itertools import combinations
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from config import settings
+from rag.datasets import tenant_slug
+from rag.table_store import ROW_COLUMN
+from services.query_router import DEFAULT_DIMENSIONS, MONTHS
+from utils.helpers import normalize_text
+
+logger = logging.getLogger(__name__)
+
+# Nombre de la tabla de rollups en el almacén columnar
+ROLLUP_TABLE = "rollups"
+# Nivel más fino del cubo, del que se derivan los demás al anexar filas
+ROLLUP_BASE_TABLE = "rollup_base"
+# Valor de "tipo" de los documentos de rollup en la colección
+ROLLUP_DOCUMENT = "rollup"
+LEVEL_COLUMN = "nivel"
+TOTAL_LEVEL = "total"
+MEASURES = ("count", "sum", "min", "max")
+# Filas de un mismo nivel que se añaden al contexto cuando la pregunta agrupa ("por mes")
+CONTEXT_ROWS = 24
+# Índices de valores de rollups abiertos por proceso
+MAX_INDEXES = 32
+
+LABELS = {"pais": "país", "año": "año", "mes": "mes", "cliente": "cliente", "Local": "local", "fecha": "fecha"}
+
+
+def level_name(dimensions: Tuple[str, ...]) -> str:
+    return "×".join(dimensions) if dimensions else TOTAL_LEVEL
+
+
+def describe_group(group: Dict[str, str]) -> str:
+    """Texto de un grupo: "cliente 2, país ES, abril de 2024" """
+    parts = []
+    month = group.get("mes")
+    year = group.get("año")
+    for dimension, value in group.items():
+        if dimension == "mes":
+            name = MONTHS[int(value) - 1] if value.isdigit() and 1 <= int(value) <= 12 else value
+            parts.append(f"{name} de {year}" if year else name)
+        elif dimension == "año":
+            if not month:
+                parts.append(f"año {value}")
+        else:
+            parts.append(f"{LABELS.get(dimension, dimension)} {value}")
+    return ", ".join(parts)
+
+
+class RollupBuilder:
+    """Cubo de agregados (count, sum, min, max) sobre varias dimensiones, p. ej. cliente × país × año × mes.
+
+    Los datos se recorren una sola vez: un único groupby vectorizado sobre todas las dimensiones
+    da el nivel más fino, combinable entre bloques, y los demás niveles del cubo (cada subconjunto
+    de dimensiones) se derivan de él, que tiene como mucho tantas filas como grupos."""
+
+    def __init__(self, dimensions: List[str] = None, measure: str = None,
+                 max_groups: int = None, max_documents: int = None):
+        self.dimensions = dimensions or [d.strip() for d in settings["rollup_dimensions"].split(",") if d.strip()]
+        self.measure = measure or settings["rollup_measure"]
+        self.max_groups = settings["rollup_max_groups"] if max_groups is None else max_groups
+        self.max_documents = settings["rollup_max_documents"] if max_documents is None else max_documents
+
+    def partial(self, df: pd.DataFrame) -> Optional[pd.DataFrame]:
+        """Nivel más fino del cubo para un bloque de filas (None si faltan columnas)"""
+        dimensions = [d for d in self.dimensions if d in df.columns]
+        if not dimensions or self.measure not in df.columns or len(df) == 0:
+            return None
+        return df.groupby(dimensions, observed=True, sort=False)[self.measure].agg(list(MEASURES))
+
+    @staticmethod
+    def merge(left: Optional[pd.DataFrame], right: Optional[pd.DataFrame]) -> Optional[pd.DataFrame]:
+        """Combina los niveles finos de dos bloques (ingesta por bloques)"""
+        if left is None:
+            return right
+        if right is None:
+            return left
+        return RollupBuilder._reduce(pd.concat([left, right]), list(left.index.names))
+
+    @staticmethod
+    def _reduce(frame: pd.DataFrame, dimensions: List[str]) -> pd.DataFrame:
+        aggregations = {"count": "sum", "sum": "sum", "min": "min", "max": "max"}
+        if not dimensions:
+            return frame.agg(aggregations).to_frame().T
+        return frame.groupby(level=dimensions, observed=True, sort=False).agg(aggregations)
+
+    def cube(self, base: Optional[pd.DataFrame]) -> Optional[pd.DataFrame]:
+        """Todos los niveles del cubo en formato largo: una fila por grupo, dimensiones ausentes a nulo.
+        Los niveles se generan de menos a más dimensiones hasta max_groups filas."""
+        if base is None or len(base) == 0:
+            return None
+        dimensions = list(base.index.names)
+        levels = []
+        groups = 0
+        for size in range(len(dimensions) + 1):
+            for subset in combinations(dimensions, size):
+                frame = base if size == len(dimensions) else self._reduce(base, list(subset))
+                if groups + len(frame) > self.max_groups:
+                    logger.info(f"Rollup {level_name(subset)} omitido: superaría {self.max_groups} grupos")
+                    continue
+                frame = frame.reset_index(drop=size == 0)
+                for dimension in dimensions:
+                    frame[dimension] = frame[dimension].astype(str) if dimension in subset else None
+                frame[LEVEL_COLUMN] = level_name(subset)
+                levels.append(frame[dimensions + [LEVEL_COLUMN] + list(MEASURES)])
+                groups += len(frame)
+        cube = pd.concat(levels, ignore_index=True)
+        cube["count"] = cube["count"].astype("int64")
+        for column in ("sum", "min", "max"):
+            cube[column] = cube[column].astype("float64")
+        return cube
+
+    def document(self, group: Dict[str, str], values: Dict[str, Any]) -> str:
+        average = values["sum"] / values["count"] if values["count"] else 0.0
+        return (
+            f"Resumen de {describe_group(group)}: {int(values['count'])} registros, "
+            f"{self.measure} total {values['sum']:.2f}, promedio {average:.2f}, "
+            f"mínimo {values['min']:.2f} y máximo {values['max']:.2f}."
+        )
+
+    def create_documents(self, cube: Optional[pd.DataFrame]) -> Tuple[List[str], List[Dict[str, Any]], List[str]]:
+        """Documentos compactos de los grupos, de los niveles más generales a los más finos, hasta max_documents"""
+        documents, metadatas, ids = [], [], []
+        if cube is None:
+            return documents, metadatas, ids
+        dimensions = [column for column in cube.columns if column not in MEASURES and column != LEVEL_COLUMN]
+        for record in cube[cube[LEVEL_COLUMN] != TOTAL_LEVEL].head(self.max_documents).to_dict("records"):
+            group = {dimension: record[dimension] for dimension in dimensions if record[dimension] is not None}
+            documents.append(self.document(group, record))
+            metadatas.append({
+                "tipo": ROLLUP_DOCUMENT,
+                "nivel": record[LEVEL_COLUMN],
+                **group,
+                "count": int(record["count"]),
+                "sum": float(record["sum"])
+            })
+            ids.append("rollup_" + "|".join(f"{dimension}={value}" for dimension, value in group.items()))
+        return documents, metadatas, ids
+
+
+class RollupIndex:
+    """Resuelve una pregunta a grupos de la tabla de rollups: valores de dimensión citados
+    ("cliente 2", "ES", "abril", "2024") y agrupaciones pedidas ("por mes")"""
+
+    def __init__(self, table: pa.Table, builder: RollupBuilder):
+        self.table = table
+        self.builder = builder
+        self.dimensions = [name for name in table.column_names
+                           if name not in MEASURES and name not in (LEVEL_COLUMN, ROW_COLUMN)]
+        self.levels = set(table.column(LEVEL_COLUMN).unique().to_pylist())
+        # Valores de cada dimensión (de su nivel de una sola dimensión) por forma normalizada
+        self.values: Dict[str, Dict[str, str]] = {}
+        for dimension in self.dimensions:
+            level = self.table.filter(pc.equal(self.table.column(LEVEL_COLUMN), dimension))
+            self.values[dimension] = {
+                normalize_text(value): value for value in level.column(dimension).to_pylist() if value
+            }
+
+    def _filters(self, question: str, text: str) -> Dict[str, str]:
+        words = set(text.split())
+        tokens = text.split()
+        bigrams = {f"{a} {b}" for a, b in zip(tokens, tokens[1:])}
+        raw_words = set(question.replace(",", " ").replace("?", " ").split())
+        filters = {}
+        for dimension in self.dimensions:
+            values = self.values[dimension]
+            if dimension == "mes":
+                for number, month in enumerate(MONTHS, start=1):
+                    if month in words and str(number) in values.values():
+                        filters[dimension] = str(number)
+                        break
+                continue
+            label = normalize_text(dimension)
+            for normalized, value in values.items():
+                if f"{label} {normalized}" in bigrams or (" " in normalized and f" {normalized} " in f" {text} "):
+                    filters[dimension] = value
+                    break
+                if normalized.isdigit():
+                    # Los números sueltos solo identifican años ("2024"), no clientes ni importes
+                    if dimension == "año" and normalized in words:
+                        filters[dimension] = value
+                        break
+                elif len(normalized) >= 3 and normalized in words:
+                    filters[dimension] = value
+                    break
+                elif len(normalized) < 3 and value in raw_words:
+                    # Códigos cortos ("ES", "UK") tal cual, para no confundirlos con palabras ("es")
+                    filters[dimension] = value
+                    break
+        return filters
+
+    def _group_by(self, text: str, filters: Dict[str, str]) -> List[str]:
+        group_by = []
+        for dimension in self.dimensions:
+            if dimension in filters:
+                continue
+            label = normalize_text(dimension)
+            cues = DEFAULT_DIMENSIONS.get(dimension, ()) + (f"por {label}", f"cada {label}")
+            if any(f" {cue} " in f" {text} " for cue in cues):
+                group_by.append(dimension)
+        return group_by
+
+    def answer(self, question: str) -> List[str]:
+        text = normalize_text(question)
+        filters = self._filters(question, text)
+        group_by = self._group_by(text, filters)
+        if not filters and not group_by:
+            return []
+        level = level_name(tuple(d for d in self.dimensions if d in filters or d in group_by))
+        if level not in self.levels:
+            return []
+        mask = pc.equal(self.table.column(LEVEL_COLUMN), level)
+        for dimension, value in filters.items():
+            mask = pc.and_(mask, pc.equal(self.table.column(dimension), value))
+        rows = self.table.filter(mask)
+        if group_by:
+            rows = rows.sort_by([("sum", "descending")])
+        documents = []
+        for record in rows.slice(0, CONTEXT_ROWS).to_pylist():
+            group = {dimension: record[dimension] for dimension in self.dimensions if record[dimension] is not None}
+            documents.append(self.builder.document(group, record))
+        return documents
+
+
+class RollupService:
+    """Respuestas a nivel de grupo desde las tablas de rollups del almacén columnar"""
+
+    def __init__(self, tables, builder: RollupBuilder = None):
+        self.tables = tables
+        self.builder = builder or RollupBuilder()
+        self._indexes: "OrderedDict[Tuple[str, str], RollupIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def index(self, tenant: str, dataset_id: str) -> Optional[RollupIndex]:
+        key = (tenant_slug(tenant), dataset_id)
+        # El almacén reabre la tabla si otro worker la ha reescrito (anexo): el índice solo
+        # se reutiliza mientras sea la misma tabla
+        table = self.tables.table(tenant, dataset_id, ROLLUP_TABLE)
+        with self._lock:
+            if table is None:
+                self._indexes.pop(key, None)
+                return None
+            index = self._indexes.get(key)
+            if index is not None and index.table is table:
+                self._indexes.move_to_end(key)
+                return index
+        # Los datasets de plantilla guardan su propia medida (p. ej. Venta-Impuesto) en la tabla
+        measure = (table.schema.metadata or {}).get(b"measure", b"").decode("utf-8")
+        builder = self.builder if not measure or measure == self.builder.measure else RollupBuilder(measure=measure)
+        index = RollupIndex(table, builder)
+        with self._lock:
+            self._indexes[key] = index
+            while len(self._indexes) > MAX_INDEXES:
+                self._indexes.popitem(last=False)
+        return index
+
+    def forget(self, tenant: str, dataset_id: str):
+        with self._lock:
+            self._indexes.pop((tenant_slug(tenant), dataset_id), None)
+
+    def answer(self, tenant: str, dataset_id: str, question: str) -> List[str]:
+        index = self.index(tenant, dataset_id)
+        return index.answer(question) if index is not None else []
@@ -0,0 +1,115 @@
+import base64
+import json
+import os
+from typing import Any, Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+# Nombre del archivo de estado de cada dataset en el almacén columnar
+STATS_STATE = "stats"
+
+
+class DistinctSketch:
+    """Conteo aproximado de valores distintos (HyperLogLog) combinable entre bloques.
+
+    Ocupa 2^precision bytes sea cual sea el número de valores (4 KB con la precisión por
+    defecto, error típico ~1,6%) y dos bocetos se combinan con el máximo de sus registros."""
+
+    def __init__(self, precision: int = 12, registers: np.ndarray = None):
+        self.precision = precision
+        self.registers = registers if registers is not None else np.zeros(1 << precision, dtype=np.uint8)
+
+    @classmethod
+    def from_values(cls, values: pd.Series, precision: int = 12) -> "DistinctSketch":
+        sketch = cls(precision)
+        sketch.add(values)
+        return sketch
+
+    def add(self, values: pd.Series):
+        if len(values) == 0:
+            return
+        hashes = pd.util.hash_pandas_object(values, index=False).to_numpy(dtype=np.uint64)
+        # Los bits altos eligen el registro; el rango es la posición del primer 1 en los 32 bits bajos
+        buckets = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        low = (hashes & np.uint64(0xFFFFFFFF)).astype(np.float64)
+        bit_length = np.where(low > 0, np.floor(np.log2(np.maximum(low, 1))) + 1, 0)
+        ranks = (33 - bit_length).astype(np.uint8)
+        np.maximum.at(self.registers, buckets, ranks)
+
+    def merge(self, other: "DistinctSketch") -> "DistinctSketch":
+        return DistinctSketch(self.precision, np.maximum(self.registers, other.registers))
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        # Corrección para cardinalidades pequeñas (conteo lineal)
+        if raw <= 2.5 * m and zeros:
+            return int(round(m * np.log(m / zeros)))
+        return int(round(raw))
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"precision": self.precision, "registers": base64.b64encode(self.registers.tobytes()).decode("ascii")}
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "DistinctSketch":
+        registers = np.frombuffer(base64.b64decode(data["registers"]), dtype=np.uint8).copy()
+        return cls(data["precision"], registers)
+
+
+def _series_to_json(series: pd.Series) -> list:
+    return [[key, float(value)] for key, value in zip(series.index.tolist(), series.tolist())]
+
+
+def _series_from_json(pairs: list) -> pd.Series:
+    return pd.Series([value for _, value in pairs], index=[key for key, _ in pairs], dtype="float64")
+
+
+def summary_to_json(summary: Dict[str, Any]) -> Dict[str, Any]:
+    """Agregados de DataProcessor.summarize en forma serializable"""
+    data = {}
+    for key, value in summary.items():
+        if isinstance(value, pd.Series):
+            data[key] = {"series": _series_to_json(value)}
+        elif isinstance(value, DistinctSketch):
+            data[key] = {"sketch": value.to_json()}
+        elif isinstance(value, pd.Timestamp):
+            data[key] = {"timestamp": value.isoformat()}
+        elif isinstance(value, np.generic):
+            data[key] = value.item()
+        else:
+            data[key] = value
+    return data
+
+
+def summary_from_json(data: Dict[str, Any]) -> Dict[str, Any]:
+    summary = {}
+    for key, value in data.items():
+        if isinstance(value, dict) and "series" in value:
+            summary[key] = _series_from_json(value["series"])
+        elif isinstance(value, dict) and "sketch" in value:
+            summary[key] = DistinctSketch.from_json(value["sketch"])
+        elif isinstance(value, dict) and "timestamp" in value:
+            summary[key] = pd.Timestamp(value["timestamp"])
+        else:
+            summary[key] = value
+    return summary
+
+
+def write_json(path: str, data: Dict[str, Any]):
+    """Escritura atómica: otros workers leen el estado anterior o el nuevo, nunca uno a medias"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(temporary, path)
+
+
+def read_json(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
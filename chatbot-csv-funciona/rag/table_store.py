@@ -0,0 +1,223 @@
+import glob
+import logging
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+import pyarrow as pa
+
+from config import settings
+from rag.datasets import tenant_slug
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# Columna con el índice de fila del DataFrame procesado (el de los IDs de ChromaDB)
+ROW_COLUMN = "_row"
+# Tablas abiertas por proceso; cada una es solo un mapa de memoria sobre su archivo
+MAX_OPEN_TABLES = 32
+
+
+class TableWriter:
+    """Escribe un dataset procesado por lotes en un archivo Arrow IPC temporal"""
+
+    def __init__(self, path: str, metadata: Dict[str, str] = None):
+        self.path = path
+        # Metadatos del esquema (p. ej. la medida de una tabla de rollups)
+        self.metadata = metadata
+        self.temporary = f"{path}.{os.getpid()}.tmp"
+        self.schema: Optional[pa.Schema] = None
+        self.rows = 0
+        self._sink = None
+        self._writer = None
+
+    def _schema(self, df) -> pa.Schema:
+        # Una columna vacía en el primer bloque no debe fijar el tipo null para los siguientes
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        for i, field in enumerate(schema):
+            if pa.types.is_null(field.type):
+                schema = schema.set(i, field.with_type(pa.string()))
+        schema = schema.remove_metadata()
+        return schema.with_metadata(self.metadata) if self.metadata else schema
+
+    def copy(self, table: pa.Table):
+        """Copia las filas de una tabla ya escrita, por lotes y sin pasar por pandas (anexos)"""
+        if self._writer is None:
+            self.schema = table.schema.remove(table.schema.get_field_index(ROW_COLUMN)).remove_metadata()
+            self._sink = pa.OSFile(self.temporary, "wb")
+            self._writer = pa.ipc.new_file(self._sink, table.schema.remove_metadata())
+        for batch in table.to_batches():
+            self._writer.write_batch(batch)
+        self.rows += table.num_rows
+
+    def write(self, df):
+        """Añade las filas de un DataFrame procesado, con su índice como identificador de fila"""
+        if self._writer is None:
+            self.schema = self._schema(df)
+            self._sink = pa.OSFile(self.temporary, "wb")
+            self._writer = pa.ipc.new_file(self._sink, self.schema.append(pa.field(ROW_COLUMN, pa.int64())))
+        table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        table = table.append_column(ROW_COLUMN, pa.array(df.index.to_numpy(dtype=np.int64)))
+        self._writer.write_table(table)
+        self.rows += len(df)
+
+    def commit(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._sink.close()
+        # Renombrado atómico: otros workers ven el archivo completo o ninguno
+        os.replace(self.temporary, self.path)
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._sink.close()
+        if os.path.exists(self.temporary):
+            os.remove(self.temporary)
+
+
+class TableStore:
+    """Datasets procesados en formato columnar (Arrow IPC sin comprimir), uno por archivo.
+
+    Los archivos se abren con memory-map: las columnas se leen sin copiarse y las páginas
+    las comparte el sistema operativo entre peticiones y workers. Las filas se buscan por
+    el índice que forma parte de los IDs de ChromaDB, así que un resultado de la búsqueda
+    vectorial se puede resolver a sus valores exactos y tipados sin volver a leer el CSV."""
+
+    def __init__(self, path: str = None):
+        self.path = settings["table_store_path"] if path is None else path
+        # Tablas abiertas en orden de uso, con su columna de índices ya en numpy
+        self._open: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def file_path(self, tenant: str, dataset_id: str, name: str = None) -> str:
+        """Archivo de las filas del dataset o, con name, de una tabla derivada (p. ej. rollups)"""
+        filename = f"{dataset_id}.{name}.arrow" if name else f"{dataset_id}.arrow"
+        return os.path.join(self.path, tenant_slug(tenant), filename)
+
+    def state_path(self, tenant: str, dataset_id: str, name: str) -> str:
+        """Archivo JSON con estado derivado del dataset (p. ej. sus agregados combinables)"""
+        return os.path.join(self.path, tenant_slug(tenant), f"{dataset_id}.{name}.json")
+
+    def exists(self, tenant: str, dataset_id: str, name: str = None) -> bool:
+        return self.enabled and os.path.exists(self.file_path(tenant, dataset_id, name))
+
+    @contextmanager
+    def writer(self, tenant: str, dataset_id: str, name: str = None, metadata: Dict[str, str] = None):
+        """Escritor del dataset (None si el almacén está desactivado); sin errores, sustituye al anterior"""
+        if not self.enabled:
+            yield None
+            return
+        path = self.file_path(tenant, dataset_id, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        writer = TableWriter(path, metadata)
+        try:
+            yield writer
+        except BaseException:
+            writer.abort()
+            raise
+        writer.commit()
+        self._forget(path)
+        logger.info(f"Tabla columnar {path}: {writer.rows} filas")
+
+    @contextmanager
+    def appender(self, tenant: str, dataset_id: str, name: str = None):
+        """Como writer, pero conservando delante las filas que ya tenía la tabla"""
+        existing = self.table(tenant, dataset_id, name)
+        with self.writer(tenant, dataset_id, name) as writer:
+            if writer is not None and existing is not None:
+                writer.copy(existing)
+            yield writer
+
+    def _forget(self, path: str):
+        with self._lock:
+            self._open.pop(path, None)
+
+    def _entry(self, tenant: str, dataset_id: str, name: str = None) -> Optional[Dict[str, Any]]:
+        if not self.enabled:
+            return None
+        path = self.file_path(tenant, dataset_id, name)
+        # Otro worker puede haber sustituido el archivo (anexo) o borrado el dataset:
+        # la tabla abierta solo vale mientras el archivo sea el mismo
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._forget(path)
+            return None
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._open.get(path)
+            if entry is not None and entry["signature"] == signature:
+                self._open.move_to_end(path)
+                return entry
+        table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+        rows = table.column(ROW_COLUMN).to_numpy()
+        # Las filas se escriben en orden de índice; si no, se ordena una vez al abrir
+        order = None if bool(np.all(rows[:-1] <= rows[1:])) else np.argsort(rows, kind="stable")
+        entry = {"table": table, "rows": rows if order is None else rows[order], "order": order,
+                 "signature": signature}
+        with self._lock:
+            self._open[path] = entry
+            while len(self._open) > MAX_OPEN_TABLES:
+                self._open.popitem(last=False)
+        return entry
+
+    def table(self, tenant: str, dataset_id: str, name: str = None) -> Optional[pa.Table]:
+        """Tabla Arrow del dataset (mapeada en memoria), p. ej. para registrarla en DuckDB.
+        Es el mismo objeto mientras el archivo no cambie"""
+        entry = self._entry(tenant, dataset_id, name)
+        return entry["table"] if entry else None
+
+    def take(self, tenant: str, dataset_id: str, row_indexes: Iterable[int]) -> Optional[pa.Table]:
+        """Filas con esos índices, en el mismo orden (las que no existen se omiten)"""
+        entry = self._entry(tenant, dataset_id)
+        if entry is None:
+            return None
+        wanted = np.fromiter(row_indexes, dtype=np.int64)
+        rows = entry["rows"]
+        if not len(rows):
+            return entry["table"].slice(0, 0)
+        positions = np.searchsorted(rows, wanted)
+        positions = positions[(positions < len(rows)) & (rows[np.minimum(positions, len(rows) - 1)] == wanted)]
+        if entry["order"] is not None:
+            positions = entry["order"][positions]
+        return entry["table"].take(pa.array(positions, type=pa.int64()))
+
+    def lookup(self, tenant: str, dataset_id: str, row_indexes: Iterable[int]) -> List[Dict[str, Any]]:
+        table = self.take(tenant, dataset_id, row_indexes)
+        return table.to_pylist() if table is not None else []
+
+    def _files(self, tenant: str, dataset_id: str) -> List[str]:
+        """Archivos del dataset: sus filas, sus tablas derivadas y su estado"""
+        rows = self.file_path(tenant, dataset_id)
+        directory = glob.escape(os.path.dirname(rows))
+        derived = [path for extension in ("arrow", "json")
+                   for path in glob.glob(os.path.join(directory, f"{glob.escape(dataset_id)}.*.{extension}"))]
+        return ([rows] if os.path.exists(rows) else []) + derived
+
+    def size_mb(self, tenant: str, dataset_id: str) -> Optional[float]:
+        if not self.exists(tenant, dataset_id):
+            return None
+        return round(sum(os.path.getsize(path) for path in self._files(tenant, dataset_id)) / MB, 2)
+
+    def delete(self, tenant: str, dataset_id: str):
+        if not self.enabled:
+            return
+        for path in self._files(tenant, dataset_id):
+            self._forget(path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+# Almacén compartido por el proceso
+table_store = TableStore()
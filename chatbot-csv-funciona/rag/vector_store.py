@@ -0,0 +1,142 @@
+import logging
+import os
+import threading
+from urllib.parse import urlparse
+
+from config import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo bloqueo entre hilos (un worker)
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+_client = None
+_lock = threading.Lock()
+
+
+def collections_memory_bytes() -> int:
+    """Memoria para índices HNSW residentes (por defecto, la mitad del presupuesto de memoria)"""
+    if settings["collections_memory_mb"] > 0:
+        return settings["collections_memory_mb"] * MB
+    from services.memory_service import memory_service
+    return memory_service.budget_bytes // 2
+
+
+def is_quantized() -> bool:
+    return settings["vector_store"] == "quantized"
+
+
+def is_remote() -> bool:
+    return not is_quantized() and bool(settings["chroma_server_url"])
+
+
+def is_persistent() -> bool:
+    return is_quantized() or is_remote() or bool(settings["chroma_path"])
+
+
+def index_bytes_per_document() -> int:
+    """Memoria residente estimada por documento indexado en el almacén configurado"""
+    if is_quantized():
+        from rag.quantized_store import QUANTIZED_BYTES_PER_DOC
+        return QUANTIZED_BYTES_PER_DOC
+    from services.memory_service import INDEX_BYTES_PER_DOC
+    return INDEX_BYTES_PER_DOC
+
+
+def is_shared() -> bool:
+    """Si varios procesos pueden usar el mismo almacén y el mismo catálogo de datasets"""
+    return is_persistent() and bool(settings["dataset_catalog_path"])
+
+
+def supports_workers() -> bool:
+    """Si se pueden arrancar varios workers: con CHROMA_PATH cada proceso guarda en memoria sus
+    segmentos HNSW y no ve (o sobrescribe) las escrituras de los demás; el servidor de ChromaDB y
+    el almacén cuantizado sí releen los cambios de otros procesos"""
+    return is_shared() and (is_remote() or is_quantized())
+
+
+class StoreLock:
+    """Bloqueo exclusivo de escritura en el almacén, entre hilos y entre procesos (workers).
+
+    Serializa la creación del cliente persistente (sus migraciones de SQLite no admiten
+    arranques simultáneos) y las ingestas y borrados de datasets. Las consultas no lo usan.
+    Es reentrante dentro de un mismo hilo."""
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0 and self.path and fcntl is not None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "a+")
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0 and self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._lock.release()
+
+
+store_lock = StoreLock(f"{settings['dataset_catalog_path']}.lock" if settings["dataset_catalog_path"] else None)
+
+
+def _http_client():
+    import chromadb
+    url = urlparse(settings["chroma_server_url"])
+    return chromadb.HttpClient(
+        host=url.hostname,
+        port=url.port or (443 if url.scheme == "https" else 8000),
+        ssl=url.scheme == "https"
+    )
+
+
+def get_client():
+    """Cliente de ChromaDB compartido por el proceso.
+
+    Con VECTOR_STORE=quantized se usa en su lugar el almacén comprimido de VECTOR_STORE_PATH
+    (misma API para las colecciones). Con CHROMA_SERVER_URL se usa un servidor de ChromaDB común a todos los workers. Con
+    CHROMA_PATH las colecciones se guardan en disco y ChromaDB mantiene en memoria solo los
+    índices HNSW usados más recientemente que caben en el presupuesto (LRU); sin ruta se usa
+    el cliente efímero en memoria."""
+    global _client
+    with _lock:
+        if _client is None:
+            if is_quantized():
+                from rag.quantized_store import QuantizedClient
+                _client = QuantizedClient(settings["vector_store_path"])
+                logger.info(f"Vectores cuantizados a int8 en {settings['vector_store_path']} "
+                            f"(reordenación exacta de {settings['vector_rerank_candidates']} candidatos)")
+                return _client
+            import chromadb
+            if is_remote():
+                _client = _http_client()
+                logger.info(f"ChromaDB en servidor {settings['chroma_server_url']}")
+            elif is_persistent():
+                from chromadb.config import Settings
+                with store_lock:
+                    _client = chromadb.PersistentClient(
+                        path=settings["chroma_path"],
+                        settings=Settings(
+                            chroma_segment_cache_policy="LRU",
+                            chroma_memory_limit_bytes=collections_memory_bytes()
+                        )
+                    )
+                logger.info(f"ChromaDB persistente en {settings['chroma_path']} "
+                            f"({round(collections_memory_bytes() / MB)} MB para índices residentes)")
+            else:
+                _client = chromadb.Client()
+                logger.info("ChromaDB en memoria (efímero)")
+        return _client
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Respuesta al usuario mientras los servicios pesados se están cargando
+NOT_READY_MESSAGE = "El sistema se está iniciando y cargando los datos. Inténtalo de nuevo en unos segundos."
+FAILED_MESSAGE = "El sistema no pudo cargar {name}: {error}"
+
+
+class ServiceNotReady(Exception):
+    """El servicio pedido aún no está disponible (arranque en curso o fallido)"""
+
+
+class AppState:
+    """Servicios compartidos de la aplicación y estado de su inicialización en segundo plano.
+
+    El puerto se abre sin esperar a los servicios pesados (modelo de embeddings,
+    cliente LLM, índice de ChromaDB); cada componente informa de su estado para
+    /health/ready."""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.services: Dict[str, Any] = {}
+        self.components: Dict[str, Dict[str, Any]] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def expect(self, *names: str):
+        """Declara los componentes necesarios para estar listo"""
+        for name in names:
+            self.components.setdefault(name, {"status": "pending"})
+
+    def get(self, name: str) -> Any:
+        service = self.services.get(name)
+        if service is None:
+            raise ServiceNotReady(f"El servicio {name} aún no está disponible")
+        return service
+
+    def is_ready(self, *names: str) -> bool:
+        names = names or tuple(self.components)
+        return all(self.components.get(name, {}).get("status") == "ready" for name in names)
+
+    def not_ready_message(self) -> str:
+        """Mensaje para el usuario: arranque en curso o el error del componente que falló"""
+        for name, component in self.components.items():
+            if component.get("status") == "failed":
+                return FAILED_MESSAGE.format(name=name, error=component["error"])
+        return NOT_READY_MESSAGE
+
+    async def load(self, name: str, factory: Callable, *args) -> Optional[Any]:
+        """Ejecuta factory en un hilo y registra el resultado y el estado del componente"""
+        component = self.components.setdefault(name, {})
+        component.update({"status": "loading", "error": None})
+        start = time.perf_counter()
+        try:
+            result = await asyncio.to_thread(factory, *args)
+        except Exception as e:
+            component.update({"status": "failed", "error": f"{type(e).__name__}: {e}",
+                              "seconds": round(time.perf_counter() - start, 3)})
+            logger.error(f"Error inicializando {name}: {str(e)}")
+            return None
+        component.update({"status": "ready", "seconds": round(time.perf_counter() - start, 3)})
+        if result is not None:
+            self.services[name] = result
+        logger.info(f"Componente {name} listo en {component['seconds']} s")
+        return result
+
+    def start_background(self, coroutine):
+        """Lanza la inicialización sin bloquear el arranque del servidor"""
+        self._tasks.append(asyncio.create_task(coroutine))
+
+    async def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def readiness(self) -> Dict[str, Any]:
+        return {
+            "ready": self.is_ready(),
+            "uptime_s": round(time.monotonic() - self.started_at, 3),
+            "components": {name: dict(component) for name, component in self.components.items()}
+        }
+
+
+# Estado compartido por la aplicación y los routers
+app_state = AppState()
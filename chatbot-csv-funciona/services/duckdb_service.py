@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import duckdb
+from typing import Any, Dict, List, Optional
+from config import settings
+from rag.datasets import DEFAULT_TENANT, DatasetCatalog, file_hash
+from rag.table_store import ROW_COLUMN, table_store
+from rag.vector_store import is_shared
+
+logger = logging.getLogger(__name__)
+
+
+class DuckDBService:
+    """Motor DuckDB persistente con los datasets precargados en tablas nativas"""
+
+    def __init__(self, database: Optional[str] = None, max_rows: Optional[int] = None):
+        # Una única conexión de larga duración; cada consulta usa su propio cursor
+        self.conn = duckdb.connect(database or settings["duckdb_path"])
+        self.max_rows = max_rows or settings["sql_max_rows"]
+        self._lock = threading.Lock()
+        # Las recargas se hacen en hilos: una a la vez, y las peticiones que llegan mientras tanto la esperan
+        self._refresh_lock = threading.Lock()
+        self._sources: Dict[str, Dict[str, Any]] = {}
+        # Tablas Arrow del almacén columnar; los registros son por conexión y se repiten en cada cursor
+        self._arrow_tables: Dict[str, Any] = {}
+        self.schema_fingerprint = ""
+        # Catálogo de datasets del RAG: qué dataset se indexó a partir de cada CSV
+        self.catalog = DatasetCatalog(settings["dataset_catalog_path"] if is_shared() else None)
+
+    @staticmethod
+    def _quote_literal(value: str) -> str:
+        return "'" + value.replace("'", "''") + "'"
+
+    def _stored_dataset(self, source_hash: str) -> str:
+        """Dataset indexado a partir de ese contenido según el catálogo (su id incluye la granularidad
+        y la deduplicación de la ingesta); si no consta, el de las opciones por defecto"""
+        try:
+            return self.catalog.source_dataset(DEFAULT_TENANT, source_hash) or source_hash
+        except Exception as e:
+            logger.error(f"Error consultando el catálogo de datasets: {str(e)}")
+            return source_hash
+
+    @staticmethod
+    def _stored_table(dataset_id: str):
+        """Tabla Arrow del dataset en el almacén columnar, si el RAG ya lo ha ingerido"""
+        try:
+            return table_store.table(DEFAULT_TENANT, dataset_id)
+        except Exception as e:
+            logger.error(f"Error abriendo la tabla columnar del dataset {dataset_id}: {str(e)}")
+            return None
+
+    def _drop(self, table: str):
+        kind = self.conn.execute(
+            "SELECT table_type FROM information_schema.tables WHERE table_name = ?", [table]
+        ).fetchone()
+        if kind:
+            self.conn.execute(f'DROP {"VIEW" if kind[0] == "VIEW" else "TABLE"} "{table}"')
+
+    def load_csv(self, csv_path: str, table: str = "facturas", date_columns: tuple = ("fecha",)) -> int:
+        """Carga (o recarga) un CSV en una tabla nativa con las columnas de fecha tipadas.
+        Si el CSV ya está en el almacén columnar se expone su tabla Arrow (mapeada en
+        memoria, ya procesada y con las mismas filas que indexó el RAG) como vista, sin volver
+        a leer el archivo."""
+        source_hash = file_hash(csv_path)
+        dataset_id = self._stored_dataset(source_hash)
+        arrow_table = self._stored_table(dataset_id)
+        source = f"read_csv({self._quote_literal(csv_path)}, header=true)"
+        with self._lock:
+            if self._arrow_tables.pop(f"{table}_arrow", None) is not None:
+                self.conn.unregister(f"{table}_arrow")
+            if arrow_table is not None:
+                self._arrow_tables[f"{table}_arrow"] = arrow_table
+                self.conn.register(f"{table}_arrow", arrow_table)
+                source = f'"{table}_arrow"'
+            columns = [row[0] for row in self.conn.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()]
+            # Las columnas de fecha se guardan como DATE aunque el CSV no permita detectarlas
+            casts = [f'TRY_CAST("{col}" AS DATE) AS "{col}"' for col in date_columns if col in columns]
+            replace = f" REPLACE ({', '.join(casts)})" if casts else ""
+            self._drop(table)
+            if arrow_table is not None:
+                self.conn.execute(f'CREATE VIEW "{table}" AS SELECT * EXCLUDE ("{ROW_COLUMN}"){replace} FROM {source}')
+            else:
+                self.conn.execute(f'CREATE TABLE "{table}" AS SELECT *{replace} FROM {source}')
+            rows = self.conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+
+            self._sources[table] = {
+                "path": csv_path,
+                "mtime": os.path.getmtime(csv_path),
+                "date_columns": date_columns,
+                "source_hash": source_hash,
+                "dataset_id": dataset_id,
+                "table": arrow_table
+            }
+            self.schema_fingerprint = self._compute_schema_fingerprint()
+
+        origin = "tabla columnar" if arrow_table is not None else "CSV"
+        logger.info(f"Tabla {table} cargada en DuckDB desde {csv_path} ({origin}): {rows} filas")
+        return rows
+
+    def refresh_if_changed(self):
+        """Recarga las tablas cuyo archivo de origen ha cambiado desde la última carga, o cuyo
+        dataset se ha vuelto a indexar con otras opciones o ha recibido filas anexadas.
+        Bloquea mientras dura la recarga: desde código asíncrono se llama con asyncio.to_thread"""
+        with self._refresh_lock:
+            for table, source in list(self._sources.items()):
+                try:
+                    if (os.path.getmtime(source["path"]) != source["mtime"]
+                            or self._stored_dataset(source["source_hash"]) != source["dataset_id"]
+                            or self._stored_table(source["dataset_id"]) is not source["table"]):
+                        self.load_csv(source["path"], table, source["date_columns"])
+                except OSError as e:
+                    logger.error(f"Error comprobando el origen de {table}: {str(e)}")
+
+    def _compute_schema_fingerprint(self) -> str:
+        """Huella del esquema (tablas, columnas y tipos) para invalidar cachés dependientes"""
+        schema = self.conn.execute(
+            "SELECT table_name, column_name, data_type FROM information_schema.columns "
+            "ORDER BY table_name, ordinal_position"
+        ).fetchall()
+        return hashlib.sha256(repr(schema).encode("utf-8")).hexdigest()[:16]
+
+    def execute(self, sql: str, max_rows: Optional[int] = None) -> Dict[str, Any]:
+        """Ejecuta una consulta y devuelve como máximo max_rows filas leídas en lotes Arrow"""
+        max_rows = max_rows or self.max_rows
+        cursor = self.conn.cursor()
+        try:
+            for name, arrow_table in list(self._arrow_tables.items()):
+                cursor.register(name, arrow_table)
+            reader = cursor.execute(sql).fetch_record_batch(max_rows)
+            columns = reader.schema.names
+            rows: List[tuple] = []
+            truncated = False
+            for batch in reader:
+                values = batch.to_pydict()
+                for i in range(batch.num_rows):
+                    if len(rows) >= max_rows:
+                        truncated = True
+                        break
+                    rows.append(tuple(values[col][i] for col in columns))
+                if truncated:
+                    break
+            return {"columns": columns, "rows": rows, "truncated": truncated}
+        finally:
+            cursor.close()
+
+    async def query(self, sql: str, max_rows: Optional[int] = None) -> Dict[str, Any]:
+        """Ejecuta la consulta en un hilo para no bloquear el bucle de eventos"""
+        return await asyncio.to_thread(self.execute, sql, max_rows)
+
+    @staticmethod
+    def has_values(result: Dict[str, Any]) -> bool:
+        """Si el resultado tiene alguna fila con algún valor (no solo NULL, como SUM sobre cero filas)"""
+        return any(value is not None for row in result["rows"] for value in row)
+
+    @staticmethod
+    def format_result(result: Dict[str, Any]) -> str:
+        """Representa el resultado como texto para enviarlo al cliente"""
+        text = str(result["rows"])
+        if result["truncated"]:
+            text += f" (mostrando las primeras {len(result['rows'])} filas)"
+        return text
@@ -0,0 +1,481 @@
+import csv
+import gc
+import html
+import io
+import logging
+import posixpath
+import re
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from xml.etree.ElementTree import iterparse, parse
+
+import numpy as np
+import pandas as pd
+
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:  # Motor opcional; sin él los .xlsx se leen con XlsxReader
+    CalamineWorkbook = None
+
+logger = logging.getLogger(__name__)
+
+MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+RELATIONSHIP_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PACKAGE_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+# Formatos de número integrados de Excel que son fechas u horas
+DATE_FORMAT_IDS = set(range(14, 23)) | {45, 46, 47}
+# XML descomprimido por bloque de filas: la unidad de trabajo de los procesos de lectura
+BLOCK_BYTES = 16 * 1024 * 1024
+# Filas por bloque cuando una hoja se lee celda a celda (motores alternativos)
+BLOCK_ROWS = 50000
+
+# Texto de las fechas en el CSV: siempre con hora, para que toda la columna tenga un único formato
+DATE_TEXT_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Contexto del libro (cadenas compartidas, estilos de fecha) en cada proceso de lectura
+_context: Optional[Dict[str, Any]] = None
+
+
+def _column_index(reference: str) -> int:
+    """Índice (desde 0) de la columna de una referencia de celda: "B3" -> 1"""
+    index = 0
+    for char in reference:
+        if not char.isalpha():
+            break
+        index = index * 26 + (ord(char.upper()) - 64)
+    return index - 1
+
+
+def _is_date_format(code: str) -> bool:
+    # Sin texto entre comillas ni secciones [color]/[$-locale], un formato con d, m o y es de fecha
+    code = re.sub(r'"[^"]*"|\[[^\]]*\]|\\.', "", code).lower()
+    return bool(re.search(r"[dy]|m(?!s)", code)) and "0" not in code.split(";")[0].replace("00", "")
+
+
+def _date_text(values: pd.Series) -> pd.Series:
+    """Fechas como texto, también a medianoche ("2024-03-01 00:00:00"): con dos formatos en una
+    columna, pd.to_datetime deduce el del primer valor y descarta como NaT los del otro"""
+    return values.dt.strftime(DATE_TEXT_FORMAT)
+
+
+class XlsxReader:
+    """Lectura en streaming de un .xlsx directamente desde su ZIP, sin cargar el libro.
+
+    Las filas de cada hoja se analizan con iterparse y se liberan al leerse. La tabla de cadenas
+    compartidas se lee solo hasta el índice más alto que han usado las filas leídas (Excel las
+    numera por orden de aparición), así que leer las primeras filas de un libro grande cuesta lo
+    mismo que leer las de uno pequeño. Para leer hojas enteras, blocks() entrega el XML en bloques
+    de filas completas que convert_block pasa a CSV."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._zip = zipfile.ZipFile(path)
+        names = set(self._zip.namelist())
+        self._strings: List[str] = []
+        self._strings_events = (iterparse(self._zip.open("xl/sharedStrings.xml"), events=("end",))
+                                if "xl/sharedStrings.xml" in names else None)
+        self._date_styles, self._epoch = self._read_styles(names)
+        self._sheets = self._read_sheets()
+
+    def close(self):
+        self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read_sheets(self) -> List[Tuple[str, str]]:
+        """(nombre, parte del ZIP) de cada hoja, en el orden del libro"""
+        workbook = parse(self._zip.open("xl/workbook.xml")).getroot()
+        targets = {}
+        with self._zip.open("xl/_rels/workbook.xml.rels") as f:
+            for relationship in parse(f).getroot().iter(f"{PACKAGE_NS}Relationship"):
+                target = relationship.get("Target", "")
+                targets[relationship.get("Id")] = (target.lstrip("/") if target.startswith("/")
+                                                   else posixpath.normpath(posixpath.join("xl", target)))
+        properties = workbook.find(f"{MAIN_NS}workbookPr")
+        if properties is not None and properties.get("date1904") in ("1", "true"):
+            self._epoch = datetime(1904, 1, 1)
+        return [(sheet.get("name"), targets.get(sheet.get(f"{RELATIONSHIP_NS}id")))
+                for sheet in workbook.iter(f"{MAIN_NS}sheet")]
+
+    def _read_styles(self, names) -> Tuple[set, datetime]:
+        """Índices de estilo de celda con formato de fecha (para convertir sus números a fechas)"""
+        epoch = datetime(1899, 12, 30)
+        if "xl/styles.xml" not in names:
+            return set(), epoch
+        styles = parse(self._zip.open("xl/styles.xml")).getroot()
+        custom = {int(fmt.get("numFmtId")): fmt.get("formatCode", "")
+                  for fmt in styles.iter(f"{MAIN_NS}numFmt")}
+        cell_formats = styles.find(f"{MAIN_NS}cellXfs")
+        dates = set()
+        for position, xf in enumerate(cell_formats if cell_formats is not None else []):
+            format_id = int(xf.get("numFmtId", 0))
+            if format_id in DATE_FORMAT_IDS or (format_id in custom and _is_date_format(custom[format_id])):
+                dates.add(position)
+        return dates, epoch
+
+    @property
+    def sheet_names(self) -> List[str]:
+        return [name for name, _ in self._sheets]
+
+    def _part(self, sheet: Optional[str]) -> str:
+        parts = dict(self._sheets)
+        part = parts.get(sheet) if sheet else (self._sheets[0][1] if self._sheets else None)
+        if part is None:
+            raise ValueError(f"La hoja {sheet} no existe en {self.path}")
+        return part
+
+    def _string(self, index: int) -> str:
+        # Avanza en la tabla de cadenas compartidas solo lo necesario
+        while index >= len(self._strings) and self._strings_events is not None:
+            try:
+                _, element = next(self._strings_events)
+            except StopIteration:
+                self._strings_events = None
+                break
+            if element.tag == f"{MAIN_NS}si":
+                self._strings.append("".join(t.text or "" for t in element.iter(f"{MAIN_NS}t")))
+                element.clear()
+        return self._strings[index] if index < len(self._strings) else ""
+
+    def load_strings(self) -> List[str]:
+        """Tabla de cadenas compartidas completa (para leer hojas enteras)"""
+        if self._strings_events is None:
+            return self._strings
+        text = self._zip.read("xl/sharedStrings.xml").decode("utf-8")
+        strings = []
+        for item in re.findall(r"<(?:\w+:)?si>(.*?)</(?:\w+:)?si>", text, re.S):
+            # Texto enriquecido: se unen las partes, sin las guías fonéticas
+            item = re.sub(r"<(?:\w+:)?rPh\b.*?</(?:\w+:)?rPh>", "", item, flags=re.S)
+            value = "".join(re.findall(r"<(?:\w+:)?t(?:\s[^>]*)?>([^<]*)</(?:\w+:)?t>", item))
+            strings.append(html.unescape(value) if "&" in value else value)
+        self._strings, self._strings_events = strings, None
+        return strings
+
+    def context(self) -> Dict[str, Any]:
+        """Lo que necesita convert_block para interpretar las celdas (se envía a cada proceso)"""
+        return {"strings": np.array(self.load_strings(), dtype=object),
+                "date_styles": np.array(sorted(self._date_styles), dtype=np.int64), "epoch": self._epoch}
+
+    def _value(self, cell) -> Any:
+        kind = cell.get("t")
+        if kind == "inlineStr":
+            return "".join(t.text or "" for t in cell.iter(f"{MAIN_NS}t"))
+        value = cell.find(f"{MAIN_NS}v")
+        if value is None or value.text is None:
+            return None
+        text = value.text
+        if kind == "s":
+            return self._string(int(text))
+        if kind == "b":
+            return text == "1"
+        if kind in ("str", "e"):
+            return text
+        number = float(text)
+        if cell.get("s") is not None and int(cell.get("s")) in self._date_styles:
+            return self._epoch + timedelta(days=number)
+        return int(number) if number.is_integer() and "." not in text and "E" not in text else number
+
+    def rows(self, sheet: Optional[str] = None, limit: int = None) -> Iterator[List[Any]]:
+        """Filas de una hoja (la primera por defecto) como listas de valores; las filas vacías
+        intermedias se devuelven como listas vacías para conservar la numeración"""
+        part = self._part(sheet)
+        produced = 0
+        with self._zip.open(part) as f:
+            events = iterparse(f, events=("start", "end"))
+            _, root = next(events)
+            for event, element in events:
+                if event != "end" or element.tag != f"{MAIN_NS}row":
+                    continue
+                number = int(element.get("r", produced + 1))
+                while produced < number - 1 and (limit is None or produced < limit):
+                    yield []
+                    produced += 1
+                if limit is not None and produced >= limit:
+                    return
+                values: List[Any] = []
+                for position, cell in enumerate(element.iter(f"{MAIN_NS}c")):
+                    index = _column_index(cell.get("r")) if cell.get("r") else position
+                    if index >= len(values):
+                        values.extend([None] * (index + 1 - len(values)))
+                    values[index] = self._value(cell)
+                while values and values[-1] is None:
+                    values.pop()
+                yield values
+                produced += 1
+                # Liberar las filas ya leídas
+                element.clear()
+                root.clear()
+
+    def blocks(self, sheet: Optional[str] = None, block_bytes: int = BLOCK_BYTES) -> Iterator[Tuple[str, str]]:
+        """(prefijo de espacio de nombres, XML) de bloques de filas completas de una hoja"""
+        with self._zip.open(self._part(sheet)) as f:
+            buffer = f.read(block_bytes)
+            match = re.search(rb"<(\w+:)?worksheet\b", buffer)
+            prefix = match.group(1).decode() if match and match.group(1) else ""
+            end_tag = f"</{prefix}row>".encode()
+            while True:
+                data = f.read(block_bytes)
+                if not data:
+                    if buffer:
+                        yield prefix, buffer.decode("utf-8")
+                    return
+                buffer += data
+                cut = buffer.rfind(end_tag)
+                if cut < 0:
+                    continue
+                cut += len(end_tag)
+                yield prefix, buffer[:cut].decode("utf-8")
+                buffer = buffer[cut:]
+
+
+def _cell_pattern(prefix: str) -> "re.Pattern":
+    p = re.escape(prefix)
+    return re.compile(
+        rf'<{p}c r="([A-Z]+)(\d+)"([^>]*?)(?:/>|>(?:(?:<{p}v>|<{p}is><{p}t(?:\s[^>]*)?>)([^<]*)'
+        rf'(?:</{p}v>|</{p}t></{p}is>)|(.*?))</{p}c>)', re.S
+    )
+
+
+def _init_worker(context: Dict[str, Any]):
+    global _context
+    _context = context
+
+
+def convert_block(prefix: str, block: str, width: Optional[int], skip_rows: int = 0,
+                  context: Dict[str, Any] = None) -> Tuple[int, int, int, str, int]:
+    """Convierte un bloque de filas del XML de una hoja en CSV con operaciones por columna.
+
+    Devuelve (primera fila, última fila, ancho, CSV, celdas descartadas por pasar del ancho).
+    Las filas (numeradas desde 1) hasta skip_rows se omiten; las vacías intermedias se escriben
+    como filas sin valores. Lanza ValueError si alguna celda no tiene el formato esperado."""
+    context = context or _context
+    collect = gc.isenabled()
+    # Millones de tuplas pequeñas: el recolector no libera nada aquí y solo añade pasadas
+    gc.disable()
+    try:
+        matches = _cell_pattern(prefix).findall(block)
+        tags = block.count(f"<{prefix}c ") + block.count(f"<{prefix}c>")
+        if len(matches) != tags:
+            raise ValueError(f"{tags - len(matches)} celdas sin referencia o con un formato no soportado")
+        if not matches:
+            return 0, 0, width or 0, "", 0
+        columns, rows, attributes, values, other = (np.array(part, dtype=object) for part in zip(*matches))
+        rows = rows.astype(np.int64)
+        keep = rows > skip_rows
+        if not keep.all():
+            columns, rows, attributes, values, other = (
+                part[keep] for part in (columns, rows, attributes, values, other)
+            )
+            if not len(rows):
+                return 0, 0, width or 0, "", 0
+
+        # Columna, estilo y tipo: pocos valores distintos, se interpretan una vez cada uno
+        codes, uniques = pd.factorize(columns)
+        columns = np.array([_column_index(column) for column in uniques], dtype=np.int64)[codes]
+        codes, uniques = pd.factorize(attributes)
+        parsed = [(re.search(r'\bs="(\d+)"', a), re.search(r'\bt="(\w+)"', a)) for a in uniques]
+        styles = np.array([int(s.group(1)) if s else -1 for s, _ in parsed], dtype=np.int64)[codes]
+        kinds = np.array([t.group(1) if t else "n" for _, t in parsed], dtype=object)[codes]
+
+        # Celdas con fórmula o texto enriquecido: su valor se extrae aparte
+        for i in np.flatnonzero(other != ""):
+            value = re.search(rf"<{prefix}v>([^<]*)</{prefix}v>", other[i])
+            if kinds[i] == "inlineStr" or value is None:
+                values[i] = "".join(re.findall(rf"<{prefix}t(?:\s[^>]*)?>([^<]*)</{prefix}t>", other[i]))
+            else:
+                values[i] = value.group(1)
+
+        shared = (kinds == "s") & (values != "")
+        text = np.flatnonzero((kinds == "inlineStr") | (kinds == "str") | (kinds == "e"))
+        text = text[["&" in value for value in values[text]]]
+        values[text] = [html.unescape(value) for value in values[text]]
+        values[shared] = context["strings"][values[shared].astype(np.int64)]
+        booleans = kinds == "b"
+        values[booleans] = np.where(values[booleans] == "1", "True", "False")
+        dates = (kinds == "n") & np.isin(styles, context["date_styles"]) & (values != "")
+        if dates.any():
+            seconds = np.round(values[dates].astype(np.float64) * 86400)
+            stamps = pd.Series(pd.Timestamp(context["epoch"]) + pd.to_timedelta(seconds, unit="s"))
+            values[dates] = _date_text(stamps).to_numpy(dtype=object)
+
+        if width is None:
+            width = int(columns.max()) + 1
+        inside = columns < width
+        dropped = int((~inside).sum())
+        first, last = int(rows.min()), int(rows.max())
+        grid = np.full((last - first + 1, width), "", dtype=object)
+        grid[rows[inside] - first, columns[inside]] = values[inside]
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(grid.tolist())
+        return first, last, width, buffer.getvalue(), dropped
+    finally:
+        if collect:
+            gc.enable()
+
+
+def _rows_to_csv(rows: List[List[Any]], width: int) -> str:
+    """CSV de filas ya leídas (motores alternativos), rellenas o recortadas al ancho"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    for row in rows:
+        row = ["" if value is None else (
+            value.strftime(DATE_TEXT_FORMAT) if isinstance(value, date)
+            else str(int(value)) if isinstance(value, float) and value.is_integer() else str(value)
+        ) for value in row[:width]]
+        writer.writerow(row + [""] * (width - len(row)))
+    return buffer.getvalue()
+
+
+def _sheet_rows(path: str, sheet: str) -> List[List[Any]]:
+    """Filas de una hoja con calamine (o pandas si no está instalado)"""
+    if CalamineWorkbook is not None:
+        return CalamineWorkbook.from_path(path).get_sheet_by_name(sheet).to_python(skip_empty_area=False)
+    frame = pd.read_excel(path, sheet_name=sheet, header=None)
+    return [[None if pd.isna(value) else value for value in row] for row in frame.itertuples(index=False)]
+
+
+def _cell_blocks(path: str, sheet: str, skip_rows: int) -> Iterator[Tuple[int, List[List[Any]]]]:
+    # Misma forma que los bloques de XML: (número de la primera fila, filas)
+    rows = _sheet_rows(path, sheet)
+    for start in range(skip_rows, len(rows), BLOCK_ROWS):
+        yield start + 1, rows[start:start + BLOCK_ROWS]
+
+
+def _header(rows: List[List[Any]], header_row: int) -> List[str]:
+    row = rows[header_row] if len(rows) > header_row else []
+    return [str(value).strip() for value in row if value not in (None, "")]
+
+
+def _ordered(executor: Optional[ProcessPoolExecutor], tasks: Iterator[Tuple], window: int) -> Iterator[Any]:
+    """Resultados de las tareas en orden, con como mucho window tareas en vuelo"""
+    if executor is None:
+        for task in tasks:
+            yield task[0](*task[1:])
+        return
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(*task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def convert_to_csv(path: str, output_path: str, header_row: int = 0, workers: int = 1,
+                   sheets: str = "matching") -> Dict[str, Any]:
+    """Convierte un libro de Excel en un CSV con sus celdas tal cual (como read_excel(header=None)).
+
+    Con sheets="matching", las hojas cuya fila header_row coincide con la de la primera se añaden a
+    continuación sin sus filas hasta la cabecera. Los bloques de filas de todas las hojas se reparten
+    entre workers procesos y se escriben en orden. Devuelve las filas escritas y las hojas leídas."""
+    streaming = path.split('.')[-1].lower() == "xlsx" and CalamineWorkbook is None
+    reader = XlsxReader(path) if streaming else None
+    try:
+        if streaming:
+            names = reader.sheet_names
+            samples = {name: list(reader.rows(name, header_row + 1)) for name in names}
+        else:
+            names = (CalamineWorkbook.from_path(path).sheet_names if CalamineWorkbook is not None
+                     else pd.ExcelFile(path).sheet_names)
+            samples = {name: sample_rows(path, header_row + 1, name)[0] for name in names}
+        header = _header(samples[names[0]], header_row)
+        selected = names[:1] + [name for name in names[1:] if sheets == "matching"
+                                and header and _header(samples[name], header_row) == header]
+        skipped = [name for name in names if name not in selected]
+        if skipped:
+            logger.info(f"Hojas de {path} sin la cabecera de la primera, no se leen: {skipped}")
+
+        if streaming:
+            context = reader.context()
+            units = [(name, 0 if i == 0 else header_row + 1, reader.blocks(name)) for i, name in enumerate(selected)]
+        else:
+            context = None
+            units = [(name, 0 if i == 0 else header_row + 1, _cell_blocks(path, name, 0 if i == 0 else header_row + 1))
+                     for i, name in enumerate(selected)]
+
+        # El primer bloque fija el ancho del CSV: se convierte antes de repartir el resto
+        _, _, first_blocks = units[0]
+        first = next(first_blocks, None)
+        if first is None:
+            open(output_path, "w", encoding="utf-8").close()
+            return {"rows": 0, "sheets": selected, "skipped_sheets": skipped}
+        if streaming:
+            head = convert_block(*first, None, 0, context)
+            width = head[2] or 1
+        else:
+            width = max((len(row) for row in first[1]), default=1)
+            head = _rows_block(*first, width)
+
+        def tasks() -> Iterator[Tuple]:
+            for index, (name, skip, blocks) in enumerate(units):
+                for block in blocks:
+                    yield (index, convert_block, *block, width, skip) if streaming \
+                        else (index, _rows_block, *block, width)
+
+        blank = ("," * (width - 1) if width > 1 else '""') + "\n"
+        last: Dict[int, int] = {}
+        written, dropped = 0, 0
+
+        def write(index: int, result: Tuple, f):
+            # Las filas vacías entre bloques (o antes de la primera celda) se escriben sin valores
+            nonlocal written, dropped
+            start, end, _, text, lost = result
+            dropped += lost
+            if not text:
+                return
+            previous = last.get(index, units[index][1])
+            f.write(blank * (start - previous - 1))
+            f.write(text)
+            written += end - previous
+            last[index] = end
+
+        _init_worker(context)
+        executor = (ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(context,))
+                    if workers > 1 else None)
+        try:
+            with open(output_path, "w", encoding="utf-8", newline="") as f:
+                write(0, head, f)
+                indexes = deque()
+
+                def submitted() -> Iterator[Tuple]:
+                    for index, *task in tasks():
+                        indexes.append(index)
+                        yield task
+
+                for result in _ordered(executor, submitted(), max(workers, 1) * 2):
+                    write(indexes.popleft(), result, f)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        if dropped:
+            logger.warning(f"{dropped} celdas de {path} fuera del ancho de la tabla ({width} columnas) descartadas")
+        return {"rows": written, "sheets": selected, "skipped_sheets": skipped}
+    finally:
+        _init_worker(None)
+        if reader is not None:
+            reader.close()
+
+
+def _rows_block(start: int, rows: List[List[Any]], width: int) -> Tuple[int, int, int, str, int]:
+    return start, start + len(rows) - 1, width, _rows_to_csv(rows, width), 0
+
+
+def sample_rows(path: str, limit: int, sheet: Optional[str] = None) -> Tuple[List[List[Any]], List[str]]:
+    """Primeras filas de un libro de Excel y los nombres de sus hojas"""
+    if path.split('.')[-1].lower() == "xlsx":
+        try:
+            with XlsxReader(path) as reader:
+                return list(reader.rows(sheet, limit)), reader.sheet_names
+        except (zipfile.BadZipFile, KeyError) as e:
+            logger.warning(f"Lectura en streaming no disponible para {path} ({str(e)}); se usa pandas")
+    sheets = pd.ExcelFile(path)
+    frame = sheets.parse(sheet or 0, header=None, nrows=limit)
+    rows = [[None if pd.isna(value) else value for value in row] for row in frame.itertuples(index=False)]
+    return rows, sheets.sheet_names
@@ -0,0 +1,482 @@
+import csv
+import json
+import logging
+import os
+import re
+import threading
+from string import Formatter
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+from config import settings
+from rag.granularity import DocumentGranularity
+from services.excel_reader import sample_rows
+
+logger = logging.getLogger(__name__)
+
+# Abreviaturas de mes de los exportes ("01-mar"), en español y en inglés
+MONTH_NUMBERS = {
+    "ene": 1, "jan": 1, "feb": 2, "mar": 3, "abr": 4, "apr": 4, "may": 5, "jun": 6, "jul": 7,
+    "ago": 8, "aug": 8, "sep": 9, "set": 9, "oct": 10, "nov": 11, "dic": 12, "dec": 12
+}
+MONTH_PATTERN = r"\b(" + "|".join(MONTH_NUMBERS) + r")[a-z]*\.?"
+# Formatos de fecha probados en orden antes del análisis libre (mucho más lento)
+DATE_FORMATS = ("ISO8601", "%d-%m-%Y", "%d-%m-%y")
+# Nombres de columna que indican fechas cuando la plantilla no fija su tipo
+DATE_NAMES = r"fecha|date|dia|day"
+# Valores con aspecto de número ("$1.559,88", "12%") o de fecha ("2024-03-01", "01/03/24", "01-mar")
+NUMBER_PATTERN = r"[\s$€%+\-]*[\d.,]+\s*[$€%]?"
+DATE_PATTERN = r"(\d{1,4}[-/.]\d{1,2}([-/.]\d{1,4})?|\d{1,2}[-/ ]" + MONTH_PATTERN + r"([-/ ]\d{2,4})?)([ t]\d{1,2}:\d{2}(:\d{2})?)?"
+# Una columna con menos valores distintos que esta fracción de filas se convierte una vez por valor
+FACTORIZE_RATIO = 0.5
+# Filas de muestra para deducir el tipo de una columna sin column_types
+SAMPLE_ROWS = 1000
+# Las filas de subtotal de los exportes horizontales empiezan así ("Total 002-GUASMO", "Total general")
+TOTAL_PREFIX = "Total"
+# Los IDs de los documentos de fila llevan el índice de la fila (como los de facturas)
+ROW_ID_PREFIX = "fila_"
+# Valores distintos del grupo principal citados en el documento de estadísticas
+TOP_GROUPS = 10
+
+
+def sniff_delimiter(line: str) -> str:
+    try:
+        return csv.Sniffer().sniff(line, delimiters=",;\t|").delimiter
+    except csv.Error:
+        return ","
+
+
+def infer_kind(column: str, sample: pd.Series) -> str:
+    """Tipo de una columna ("date", "number" o "text") por su nombre y una muestra de valores
+    (texto de un CSV o valores ya tipados de un Excel)"""
+    values = sample.dropna().astype(str).str.strip()
+    values = values[values != ""]
+    if not len(values):
+        return "text"
+    if re.search(DATE_NAMES, column, re.IGNORECASE):
+        return "date"
+    if values.str.fullmatch(NUMBER_PATTERN).mean() >= 0.8:
+        return "number"
+    if values.str.lower().str.fullmatch(DATE_PATTERN).mean() >= 0.8:
+        return "date"
+    return "text"
+
+
+def _by_unique(values: pd.Series, convert: Callable[[pd.Series], pd.Series]) -> pd.Series:
+    """Aplica una conversión vectorizada solo a los valores distintos si se repiten mucho
+    (fechas, locales, importes repetidos) y reconstruye la columna con sus códigos"""
+    codes, uniques = pd.factorize(values)
+    if len(uniques) > FACTORIZE_RATIO * len(values):
+        return convert(values)
+    converted = convert(pd.Series(uniques, dtype=values.dtype)).reset_index(drop=True)
+    # La posición extra (nula) es la de los códigos -1 de los valores vacíos
+    extended = converted.reindex(range(len(uniques) + 1))
+    return pd.Series(extended.to_numpy()[codes], index=values.index, dtype=converted.dtype)
+
+
+def to_number(values: pd.Series, decimal: str = ".") -> pd.Series:
+    """Números con símbolos de moneda y separador de miles: "$1.559,88" con decimal="," es 1559.88"""
+    thousands = "." if decimal == "," else ","
+    text = values.str.replace(r"[^\d,.\-]", "", regex=True).str.replace(thousands, "", regex=False)
+    if decimal != ".":
+        text = text.str.replace(decimal, ".", regex=False)
+    return pd.to_numeric(text, errors="coerce").astype("float64")
+
+
+def to_date(values: pd.Series, year: int) -> pd.Series:
+    """Fechas en los formatos de los exportes, incluidas las de mes abreviado sin año ("01-mar")"""
+    text = values.str.strip().str.lower().str.replace(
+        MONTH_PATTERN, lambda match: f"{MONTH_NUMBERS[match.group(1)]:02d}", regex=True
+    ).str.replace(r"[/.]", "-", regex=True)
+    text = text.where(~text.str.fullmatch(r"\d{1,2}-\d{1,2}").fillna(False), text + f"-{year}")
+    dates = pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns]")
+    for date_format in DATE_FORMATS:
+        pending = dates.isna() & text.notna()
+        if not pending.any():
+            return dates
+        dates[pending] = pd.to_datetime(text[pending], format=date_format, errors="coerce")
+    pending = dates.isna() & text.notna()
+    if pending.any():
+        dates[pending] = pd.to_datetime(text[pending], format="mixed", dayfirst=True, errors="coerce")
+    return dates
+
+
+def to_text(values: pd.Series) -> pd.Series:
+    return values.str.strip()
+
+
+class TemplatePlan:
+    """Plantilla compilada: cómo leer el archivo, convertir cada columna y crear sus documentos.
+
+    Se compila una vez por plantilla. Los conversores de columna (y los tipos deducidos si la
+    plantilla no los fija) se guardan en el plan y se reutilizan en cada bloque y cada archivo;
+    la conversión y los documentos son operaciones por columna, sin recorrer filas en Python."""
+
+    def __init__(self, template: Dict[str, Any]):
+        self.template = template
+        self.name = template["name"]
+        self.header_row = int(template.get("header_row", 0))
+        self.data_start_row = int(template.get("data_start_row", self.header_row + 1))
+        self.key_columns = list(template["key_columns"])
+        self.value_columns = list(template["value_columns"])
+        self.source_columns = self.key_columns + [c for c in self.value_columns if c not in self.key_columns]
+        # column_mappings: nombre del sistema -> columna del archivo
+        self.rename = {source: name for name, source in (template.get("column_mappings") or {}).items()}
+        self.columns = [self.rename.get(column, column) for column in self.source_columns]
+        self.delimiter = template.get("delimiter")
+        self.decimal = template.get("decimal", ".")
+        self.year = template.get("year") or pd.Timestamp.now().year
+        self.horizontal = bool(template.get("horizontal_data", False))
+        self.skip_empty = bool(template.get("skip_empty_rows", True))
+        self.row_type = template.get("row_type", "fila")
+        self.kinds: Dict[str, str] = {self.rename.get(c, c): kind for c, kind in (template.get("column_types") or {}).items()}
+        self._converters: Dict[str, Callable[[pd.Series], pd.Series]] = {}
+        self._document_parts: Optional[List[Tuple[str, Optional[str], str]]] = None
+        self._lock = threading.Lock()
+
+    # Tipos y conversores
+
+    def _converter(self, column: str, sample: pd.Series) -> Callable[[pd.Series], pd.Series]:
+        with self._lock:
+            converter = self._converters.get(column)
+            if converter is not None:
+                return converter
+            kind = self.kinds.get(column) or infer_kind(column, sample.head(SAMPLE_ROWS))
+            self.kinds[column] = kind
+            if kind == "number":
+                decimal = self.decimal
+                converter = lambda values: _by_unique(values, lambda unique: to_number(unique, decimal))
+            elif kind == "date":
+                year = self.year
+                converter = lambda values: _by_unique(values, lambda unique: to_date(unique, year))
+            else:
+                converter = to_text
+            self._converters[column] = converter
+            return converter
+
+    def _kind(self, column: str) -> str:
+        return self.kinds.get(column, "text")
+
+    def _is_date(self, column: str) -> bool:
+        """Tipo fecha, fijado o (antes de leer datos) deducido del nombre de la columna"""
+        kind = self.kinds.get(column)
+        return kind == "date" if kind else bool(re.search(DATE_NAMES, column, re.IGNORECASE))
+
+    @property
+    def date_column(self) -> Optional[str]:
+        return next((column for column in self.columns if self._kind(column) == "date"), None)
+
+    @property
+    def numeric_columns(self) -> List[str]:
+        return [column for column in self.columns if self._kind(column) == "number"]
+
+    @property
+    def measure(self) -> Optional[str]:
+        measure = self.template.get("measure")
+        if measure:
+            return self.rename.get(measure, measure)
+        return self.numeric_columns[0] if self.numeric_columns else None
+
+    @property
+    def dimensions(self) -> List[str]:
+        dimensions = self.template.get("dimensions")
+        if dimensions:
+            return [self.rename.get(d, d) for d in dimensions]
+        dimensions = [c for c in self.columns if c not in self.value_columns and self._kind(c) == "text"]
+        return dimensions + (["año", "mes"] if self.date_column else [])
+
+    @property
+    def group_column(self) -> Optional[str]:
+        """Dimensión de texto principal de las estadísticas (Local, Ubicacion...)"""
+        return next((d for d in self.dimensions if d in self.columns and self._kind(d) == "text"), None)
+
+    @property
+    def document_group_by(self) -> List[str]:
+        """Claves de los documentos agrupados: las de la plantilla o la dimensión principal por mes"""
+        group_by = self.template.get("document_group_by")
+        if group_by:
+            return [self.rename.get(key, key) for key in group_by]
+        return [key for key in (self.group_column, "mes" if self.date_column else None) if key]
+
+    # Lectura
+
+    def header(self, path: str) -> List[str]:
+        """Columnas de la fila de cabecera del archivo"""
+        if path.split('.')[-1].lower() in ['xlsx', 'xls']:
+            rows, _ = sample_rows(path, self.header_row + 1)
+            row = rows[self.header_row] if len(rows) > self.header_row else []
+            return [str(value).strip() if value is not None else "" for value in row]
+        with open(path, "r", encoding="utf-8-sig", errors="replace") as f:
+            for _ in range(self.header_row):
+                f.readline()
+            line = f.readline().rstrip("\r\n")
+        delimiter = self.delimiter or sniff_delimiter(line)
+        return [column.strip() for column in next(csv.reader([line], delimiter=delimiter), [])]
+
+    def matches(self, path: str) -> bool:
+        try:
+            return set(self.source_columns) <= set(self.header(path))
+        except Exception:
+            return False
+
+    def read(self, path: str, chunk_rows: int = None) -> Iterator[pd.DataFrame]:
+        """Bloques de filas en texto con las columnas de la plantilla, índice desde la primera fila de datos"""
+        names = self.header(path)
+        missing = [column for column in self.source_columns if column not in names]
+        if missing:
+            raise ValueError(f"El archivo no coincide con la plantilla {self.name}: faltan columnas {missing}")
+        with open(path, "r", encoding="utf-8-sig", errors="replace") as f:
+            for _ in range(self.header_row):
+                f.readline()
+            delimiter = self.delimiter or sniff_delimiter(f.readline())
+        reader = pd.read_csv(
+            path, sep=delimiter, header=None, names=names, skiprows=self.data_start_row,
+            usecols=self.source_columns, dtype=str, keep_default_na=False, na_values=[""],
+            encoding="utf-8-sig", chunksize=chunk_rows or None
+        )
+        chunks = reader if chunk_rows else [reader]
+        # En los exportes horizontales la clave solo aparece en la primera fila de cada bloque
+        fill = [c for c in self.key_columns if self.horizontal and not self._is_date(self.rename.get(c, c))]
+        last: Dict[str, Any] = {}
+        for chunk in chunks:
+            chunk = chunk[self.source_columns]
+            if fill:
+                chunk = chunk.copy()
+                for column in fill:
+                    chunk[column] = chunk[column].ffill()
+                    if column in last:
+                        chunk[column] = chunk[column].fillna(last[column])
+                    valid = chunk[column].dropna()
+                    if len(valid):
+                        last[column] = valid.iloc[-1]
+            yield chunk.rename(columns=self.rename)
+
+    def transform(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        """Convierte un bloque leído con read: descarta subtotales y filas vacías y tipa las columnas"""
+        df = chunk
+        if self.horizontal:
+            keys = [self.rename.get(c, c) for c in self.key_columns if not self._is_date(self.rename.get(c, c))]
+            totals = pd.Series(False, index=df.index)
+            for column in keys:
+                totals |= df[column].str.strip().str.startswith(TOTAL_PREFIX).fillna(False)
+            df = df[~totals]
+        df = pd.DataFrame({column: self._converter(column, df[column])(df[column]) for column in self.columns},
+                          index=df.index)
+        if self.skip_empty:
+            values = [self.rename.get(c, c) for c in self.value_columns]
+            df = df.dropna(subset=values, how="all")
+        date_column = self.date_column
+        if date_column:
+            df = df.dropna(subset=[date_column])
+            df["mes"] = df[date_column].dt.month
+            df["año"] = df[date_column].dt.year
+        return df
+
+    # Documentos
+
+    def _parts(self) -> List[Tuple[str, Optional[str], str]]:
+        if self._document_parts is None:
+            document = self.template.get("document") or (
+                f"{self.name}: " + ", ".join(f"{column} {{{column}}}" for column in self.columns) + "."
+            )
+            self._document_parts = [(literal, field, spec) for literal, field, spec, _ in Formatter().parse(document)]
+        return self._document_parts
+
+    def _format(self, values: pd.Series, column: str, spec: str) -> pd.Series:
+        kind = self._kind(column)
+        if kind == "date":
+            text = values.dt.strftime(spec or "%d/%m/%Y")
+        elif kind == "number":
+            text = values.map(("{:" + (spec or ".2f") + "}").format)
+        else:
+            text = values.astype(str)
+        return text.where(values.notna(), "-")
+
+    def create_documents(self, df: pd.DataFrame, granularity: DocumentGranularity = None) -> Tuple[List[str], List[Dict[str, Any]], List[str]]:
+        """Un documento por fila, construido columna a columna con el formato de la plantilla
+        (o uno por grupo o bloque de filas según la granularidad)"""
+        if not len(df):
+            return [], [], []
+        if granularity is not None and not granularity.per_row:
+            return granularity.create_documents(
+                df, ROW_ID_PREFIX, self.columns, self.date_column, self.measure, self.name,
+                self.document_group_by, {"plantilla": self.name}
+            )
+        text = pd.Series("", index=df.index, dtype=object)
+        for literal, field, spec in self._parts():
+            text = text + literal
+            if field is not None:
+                text = text + self._format(df[field], field, spec).astype(object)
+        metadata_frame = df[self.columns + [c for c in ("mes", "año") if c in df.columns]].copy()
+        for column in self.columns:
+            if self._kind(column) == "date":
+                metadata_frame[column] = metadata_frame[column].dt.strftime("%Y-%m-%d")
+        metadatas = [
+            {"tipo": self.row_type, "plantilla": self.name,
+             **{key: value for key, value in record.items() if value is not None and value == value}}
+            for record in metadata_frame.astype(object).to_dict("records")
+        ]
+        ids = [f"{ROW_ID_PREFIX}{index}" for index in df.index]
+        return text.tolist(), metadatas, ids
+
+    # Estadísticas combinables por bloques
+
+    def summarize(self, df: pd.DataFrame) -> Dict[str, Any]:
+        measure = self.measure
+        date_column = self.date_column
+        group = self.group_column
+        return {
+            "count": len(df),
+            "totals": df[self.numeric_columns].sum(),
+            "min": df[measure].min() if measure else None,
+            "max": df[measure].max() if measure else None,
+            "fecha_min": df[date_column].min() if date_column else None,
+            "fecha_max": df[date_column].max() if date_column else None,
+            "groups": df.groupby(group)[measure].sum() if group and measure else None
+        }
+
+    @staticmethod
+    def merge_summaries(left: Optional[Dict[str, Any]], right: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if left is None or left["count"] == 0:
+            return right
+        if right is None or right["count"] == 0:
+            return left
+
+        def combine(a, b, function):
+            return b if a is None or pd.isna(a) else a if b is None or pd.isna(b) else function(a, b)
+
+        return {
+            "count": left["count"] + right["count"],
+            "totals": left["totals"].add(right["totals"], fill_value=0),
+            "min": combine(left["min"], right["min"], min),
+            "max": combine(left["max"], right["max"], max),
+            "fecha_min": combine(left["fecha_min"], right["fecha_min"], min),
+            "fecha_max": combine(left["fecha_max"], right["fecha_max"], max),
+            "groups": None if left["groups"] is None else left["groups"].add(right["groups"], fill_value=0)
+        }
+
+    def create_summary_documents(self, summary: Optional[Dict[str, Any]]) -> Tuple[List[str], List[Dict[str, Any]], List[str]]:
+        """Documentos de estadísticas de la plantilla: totales de cada columna numérica y ranking por grupo"""
+        documents, metadatas, ids = [], [], []
+        if not summary or summary["count"] == 0:
+            return documents, metadatas, ids
+        measure = self.measure
+        general = f"Resumen general de {self.name}:\nTotal de registros: {summary['count']}\n"
+        for column, total in summary["totals"].items():
+            general += f"Total {column}: {total:.2f}\n"
+        if measure and not pd.isna(summary["min"]):
+            general += (
+                f"{measure} promedio: {summary['totals'][measure] / summary['count']:.2f}\n"
+                f"{measure} mínimo: {summary['min']:.2f}\n"
+                f"{measure} máximo: {summary['max']:.2f}\n"
+            )
+        if summary["fecha_min"] is not None and not pd.isna(summary["fecha_min"]):
+            general += f"Periodo: {summary['fecha_min'].strftime('%d/%m/%Y')} a {summary['fecha_max'].strftime('%d/%m/%Y')}\n"
+        if summary["groups"] is not None:
+            general += f"Número de valores de {self.group_column}: {len(summary['groups'])}"
+        documents.append(general.rstrip("\n"))
+        metadatas.append({"tipo": "estadistica", "subtipo": "general", "plantilla": self.name})
+        ids.append("stats_general")
+
+        if summary["groups"] is not None and len(summary["groups"]):
+            ranking = summary["groups"].sort_values(ascending=False)
+            text = f"Estadísticas por {self.group_column} ({measure}):\n"
+            for value, total in ranking.head(TOP_GROUPS).items():
+                text += f"- {value}: {total:.2f}\n"
+            if len(ranking) > TOP_GROUPS:
+                text += f"Menor {measure}: {ranking.index[-1]} con {ranking.iloc[-1]:.2f}\n"
+            documents.append(text)
+            metadatas.append({"tipo": "estadistica", "subtipo": self.group_column, "plantilla": self.name})
+            ids.append(f"stats_{self.group_column}")
+        return documents, metadatas, ids
+
+    def rollup_builder(self):
+        from rag.rollups import RollupBuilder
+        return RollupBuilder(dimensions=self.dimensions, measure=self.measure)
+
+
+class ExcelTemplateService:
+    """Plantillas de Excel predefinidas y guardadas, compiladas una sola vez en planes de ingesta"""
+
+    REQUIRED_FIELDS = ("name", "key_columns", "value_columns")
+
+    def __init__(self, path: str = None):
+        self.path = settings["excel_templates_path"] if path is None else path
+        self._plans: Dict[str, TemplatePlan] = {}
+        self._lock = threading.Lock()
+
+    def _saved(self) -> Dict[str, Dict[str, Any]]:
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return {template["name"]: template for template in json.load(f)}
+        except Exception as e:
+            logger.error(f"Error leyendo las plantillas de {self.path}: {str(e)}")
+            return {}
+
+    def list(self) -> List[Dict[str, Any]]:
+        return list({**settings["default_templates"], **self._saved()}.values())
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        return self._saved().get(name) or settings["default_templates"].get(name)
+
+    def save(self, template: Dict[str, Any]) -> Dict[str, Any]:
+        """Guarda (o sustituye) una plantilla; su plan se vuelve a compilar en el siguiente uso"""
+        missing = [field for field in self.REQUIRED_FIELDS if not template.get(field)]
+        if missing:
+            raise ValueError(f"Faltan campos en la plantilla: {missing}")
+        saved = self._saved()
+        saved[template["name"]] = template
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(list(saved.values()), f, ensure_ascii=False, indent=2)
+        with self._lock:
+            self._plans.pop(template["name"], None)
+        logger.info(f"Plantilla {template['name']} guardada")
+        return template
+
+    def compile(self, name: str) -> TemplatePlan:
+        with self._lock:
+            plan = self._plans.get(name)
+        if plan is not None:
+            return plan
+        template = self.get(name)
+        if template is None:
+            raise ValueError(f"Plantilla desconocida: {name}")
+        plan = TemplatePlan(template)
+        with self._lock:
+            self._plans.setdefault(name, plan)
+            return self._plans[name]
+
+    def detect(self, path: str) -> Optional[Dict[str, Any]]:
+        """Plantilla cuyas columnas clave y de valor están todas en el archivo (la más específica)"""
+        candidates = [t for t in self.list() if all(t.get(field) for field in self.REQUIRED_FIELDS)]
+        matches = [t for t in candidates if self.compile(t["name"]).matches(path)]
+        if not matches:
+            return None
+        return max(matches, key=lambda t: len(t["key_columns"]) + len(t["value_columns"]))
+
+    def match(self, columns: List[str]) -> Optional[Dict[str, Any]]:
+        """Como detect, pero con las columnas ya leídas del archivo (sin volver a abrirlo)"""
+        present = {str(column).strip() for column in columns}
+        matches = [t for t in self.list() if all(t.get(field) for field in self.REQUIRED_FIELDS)
+                   and set(t["key_columns"]) | set(t["value_columns"]) <= present]
+        if not matches:
+            return None
+        return max(matches, key=lambda t: len(t["key_columns"]) + len(t["value_columns"]))
+
+    def resolve(self, name: str, path: str) -> Optional[TemplatePlan]:
+        """Plan de ingesta de un archivo: el de la plantilla indicada o, sin nombre, el de la que
+        coincida con sus columnas. None si corresponde la ingesta propia de facturas"""
+        template = self.get(name) if name else self.detect(path)
+        if name and template is None:
+            raise ValueError(f"Plantilla desconocida: {name}")
+        if template is None or template.get("pipeline") == "facturas":
+            return None
+        return self.compile(template["name"])
+
+
+# Servicio compartido por el proceso
+template_service = ExcelTemplateService()
@@ -1,23 +1,50 @@
 import os
+import io
+import csv
 import logging
+import tempfile
+from datetime import date, datetime
 import pandas as pd
 from fastapi import UploadFile
-from typing import Tuple
+from typing import Any, Dict, List, Tuple
 from config import settings
+from services.excel_reader import convert_to_csv, sample_rows
+from services.excel_template_service import infer_kind, sniff_delimiter
+from services.memory_service import MemoryBudgetExceeded
 
 logger = logging.getLogger(__name__)
 
 class FileService:
     """Servicio para operaciones con archivos"""
     
+    # Tamaño de cada lectura al copiar un archivo subido a disco
+    UPLOAD_CHUNK_BYTES = 1024 * 1024
+    # Muestra leída para analizar un archivo sin cargarlo: bytes de un CSV y filas de datos
+    SNIFF_BYTES = 64 * 1024
+    SNIFF_ROWS = 200
+    # Filas iniciales en las que se busca la cabecera (títulos de reporte antes de la tabla)
+    SNIFF_HEADER_ROWS = 20
+    # Codificaciones probadas en orden; latin-1 acepta cualquier byte y cierra la lista
+    ENCODINGS = ("utf-8-sig", "cp1252", "latin-1")
+    
     @staticmethod
     async def save_upload_file(file: UploadFile) -> str:
-        """Guarda un archivo subido y devuelve su ruta"""
+        """Guarda un archivo subido y devuelve su ruta (copia por bloques, sin cargarlo entero en memoria)"""
         file_path = os.path.join(settings["uploads_dir"], file.filename)
+        max_bytes = settings["max_upload_mb"] * 1024 * 1024
         
-        content = await file.read()
+        written = 0
         with open(file_path, "wb") as f:
-            f.write(content)
+            while True:
+                content = await file.read(FileService.UPLOAD_CHUNK_BYTES)
+                if not content:
+                    break
+                written += len(content)
+                if written > max_bytes:
+                    f.close()
+                    os.remove(file_path)
+                    raise MemoryBudgetExceeded(f"El archivo supera el tamaño máximo de {settings['max_upload_mb']} MB")
+                f.write(content)
             
         return file_path
     
@@ -29,16 +56,155 @@ class FileService:
         
         # Cargar según el tipo de archivo
         if extension in ['xlsx', 'xls']:
-            df = pd.read_excel(file_path)
-            processed_path = os.path.join(
-                settings["processed_dir"], 
-                f"{os.path.splitext(filename)[0]}.csv"
-            )
-            df.to_csv(processed_path, index=False)
+            processed_path = FileService.to_csv(file_path)
+            df = pd.read_csv(processed_path)
         elif extension == 'csv':
             df = pd.read_csv(file_path)
             processed_path = file_path
         else:
             raise ValueError(f"Formato de archivo no soportado: {extension}")
             
-        return df, processed_path
\ No newline at end of file
+        return df, processed_path
+    
+    @staticmethod
+    def to_csv(file_path: str) -> str:
+        """Ruta de un CSV con las celdas del archivo tal cual, sin interpretar la cabecera
+        (las plantillas deciden en qué fila está); los CSV se usan directamente.
+        Los Excel se convierten en streaming, con las hojas de la misma cabecera a continuación
+        de la primera (EXCEL_SHEETS) y sus bloques de filas repartidos entre procesos"""
+        filename = os.path.basename(file_path)
+        if filename.split('.')[-1].lower() not in ['xlsx', 'xls']:
+            return file_path
+        # Nombre único por subida: dos archivos con el mismo nombre (p. ej. de dos inquilinos)
+        # convertidos a la vez no se sobrescriben el CSV
+        os.makedirs(settings["processed_dir"], exist_ok=True)
+        descriptor, processed_path = tempfile.mkstemp(
+            prefix=f"{os.path.splitext(filename)[0]}.", suffix=".csv", dir=settings["processed_dir"]
+        )
+        os.close(descriptor)
+        rows, _ = sample_rows(file_path, FileService.SNIFF_HEADER_ROWS)
+        result = convert_to_csv(
+            file_path, processed_path, header_row=FileService._header_row(rows),
+            workers=settings["excel_read_workers"], sheets=settings["excel_sheets"]
+        )
+        logger.info(f"Excel {filename} convertido a CSV: {result['rows']} filas de las hojas {result['sheets']}")
+        return processed_path
+    
+    @staticmethod
+    def sniff_file(file_path: str, sample_size: int = None) -> Dict[str, Any]:
+        """Estructura de un archivo deducida de una muestra, sin cargarlo: separador, codificación,
+        fila de cabecera, columnas con su tipo y primeras filas. De un CSV solo se leen los primeros
+        KB; de un Excel, las primeras filas de la primera hoja"""
+        limit = (sample_size or FileService.SNIFF_ROWS) + FileService.SNIFF_HEADER_ROWS
+        extension = file_path.split('.')[-1].lower()
+        if extension in ['xlsx', 'xls']:
+            rows, sheets = sample_rows(file_path, limit)
+            delimiter, encoding = None, None
+        elif extension == 'csv':
+            rows, delimiter, encoding = FileService._sample_csv(file_path, limit)
+            sheets = []
+        else:
+            raise ValueError(f"Formato de archivo no soportado: {extension}")
+        
+        header_row = FileService._header_row(rows)
+        header = rows[header_row] if rows else []
+        columns = [str(name).strip() if name not in (None, "") else f"columna_{i + 1}" for i, name in enumerate(header)]
+        width = len(columns)
+        data = [(row + [None] * width)[:width] for row in rows[header_row + 1:]]
+        sample = pd.DataFrame(data, columns=columns, dtype=object)
+        
+        return {
+            "columns": columns,
+            "column_types": {column: infer_kind(column, sample[column]) for column in columns},
+            "delimiter": delimiter,
+            "encoding": encoding,
+            "header_row": header_row,
+            "sheets": sheets,
+            "preview": [{column: FileService._json_value(value) for column, value in zip(columns, row)}
+                        for row in data[:5]]
+        }
+    
+    @staticmethod
+    def _sample_csv(file_path: str, limit: int) -> Tuple[List[List[Any]], str, str]:
+        """Primeras filas de un CSV con su separador y codificación, leyendo solo SNIFF_BYTES"""
+        with open(file_path, "rb") as f:
+            raw = f.read(FileService.SNIFF_BYTES)
+            # Descartar la última línea si quedó cortada por el límite de lectura
+            if f.read(1) and b"\n" in raw:
+                raw = raw[:raw.rindex(b"\n") + 1]
+        for encoding in FileService.ENCODINGS:
+            try:
+                text = raw.decode(encoding)
+                break
+            except UnicodeDecodeError:
+                continue
+        lines = text.splitlines()
+        delimiter = sniff_delimiter("\n".join(lines[:FileService.SNIFF_HEADER_ROWS]))
+        rows = list(csv.reader(io.StringIO(text), delimiter=delimiter))[:limit]
+        rows = [[value if value.strip() else None for value in row] for row in rows]
+        for row in rows:
+            while row and row[-1] is None:
+                row.pop()
+        return rows, delimiter, encoding.replace("-sig", "")
+    
+    @staticmethod
+    def _header_row(rows: List[List[Any]]) -> int:
+        """Primera fila que ocupa casi todo el ancho de la tabla sin números ni fechas
+        (los títulos de un reporte ocupan una o dos celdas y se saltan)"""
+        widths = [sum(value is not None for value in row) for row in rows]
+        if not widths or not max(widths):
+            return 0
+        width = pd.Series([w for w in widths if w]).mode().max()
+        for i, row in enumerate(rows[:FileService.SNIFF_HEADER_ROWS]):
+            cells = [value for value in row if value is not None]
+            if len(cells) >= max(1, 0.8 * width) and all(
+                isinstance(value, str) and infer_kind("", pd.Series([value])) == "text" for value in cells
+            ):
+                return i
+        return 0
+    
+    @staticmethod
+    def _json_value(value: Any) -> Any:
+        # Las fechas de Excel llegan como datetime
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        return value
+    
+    @staticmethod
+    def inspect_file(file_path: str, chunk_rows: int) -> Tuple[List[str], int]:
+        """Columnas y número de filas de un CSV leyéndolo por bloques"""
+        columns = list(pd.read_csv(file_path, nrows=0).columns)
+        rows = sum(len(chunk) for chunk in pd.read_csv(file_path, usecols=[0], chunksize=chunk_rows))
+        return columns, rows
+    
+    @staticmethod
+    def read_columns(file_path: str, header_row: int = 0, delimiter: str = None) -> List[str]:
+        """Columnas del archivo sin cargar los datos (header_row y delimiter, los de sniff_file)"""
+        extension = file_path.split('.')[-1].lower()
+        if extension in ['xlsx', 'xls']:
+            rows, _ = sample_rows(file_path, header_row + 1)
+            header = rows[header_row] if len(rows) > header_row else []
+            return [str(name) if name is not None else f"Unnamed: {i}" for i, name in enumerate(header)]
+        return list(pd.read_csv(file_path, skiprows=header_row, sep=delimiter or ",", nrows=0).columns)
+    
+    @staticmethod
+    def map_columns(file_path: str, mappings: Dict[str, str], output_path: str, chunk_rows: int = None,
+                    header_row: int = 0, delimiter: str = None) -> Tuple[int, List[str]]:
+        """Guarda en output_path las columnas del archivo renombradas según el mapeo.
+        Con chunk_rows (solo CSV) se procesa por bloques para acotar la memoria."""
+        columns = FileService.read_columns(file_path, header_row, delimiter)
+        selected = {system_col: file_col for system_col, file_col in mappings.items() if file_col in columns}
+        
+        if file_path.split('.')[-1].lower() in ['xlsx', 'xls']:
+            file_path, delimiter = FileService.to_csv(file_path), ","
+        chunks = pd.read_csv(file_path, skiprows=header_row, sep=delimiter or ",", chunksize=chunk_rows)
+        if not chunk_rows:
+            chunks = [chunks]
+        
+        rows = 0
+        for i, chunk in enumerate(chunks):
+            df_mapped = pd.DataFrame({system_col: chunk[file_col] for system_col, file_col in selected.items()})
+            df_mapped.to_csv(output_path, index=False, mode="w" if i == 0 else "a", header=(i == 0))
+            rows += len(df_mapped)
+        
+        return rows, list(selected.keys())
@@ -1,6 +1,8 @@
 import logging
+import time
 from openai import AsyncOpenAI
 from config import settings
+from utils.metrics import LLM_TOKENS_TOTAL, observe_stage
 
 logger = logging.getLogger(__name__)
 
@@ -14,9 +16,20 @@ class LLMService:
         )
         self.model = settings["model"]
     
-    async def generate_response(self, context: str, query: str, websocket):
-        """Genera una respuesta utilizando el LLM y la envía por websocket"""
+    async def generate_response(self, context: str, query: str, websocket, history: str = "") -> str:
+        """Genera una respuesta utilizando el LLM, la envía por websocket y devuelve el texto completo
+        (vacío si la generación falla)"""
+        response_text = ""
         try:
+            # Historial acotado de la sesión (resumen + turnos recientes)
+            history_block = ""
+            if history:
+                history_block = f"""
+            [HISTORIAL]
+            {history}
+            [FIN HISTORIAL]
+            """
+
             # Crear prompt con instrucciones detalladas
             system_prompt = f"""
             [INSTRUCCIÓN]
@@ -32,7 +45,7 @@ class LLMService:
             [CONTEXTO]
             {context}
             [FIN CONTEXTO]
-            
+            {history_block}
             [PREGUNTA]
             {query}
             [FIN PREGUNTA]
@@ -44,6 +57,9 @@ class LLMService:
             ]
             
             # Solicitar respuesta al modelo con parámetros optimizados
+            start = time.perf_counter()
+            first_token_at = None
+            tokens = 0
             response = await self.client.chat.completions.create(
                 model=self.model,
                 messages=completion_messages,
@@ -60,14 +76,28 @@ class LLMService:
                     not chunk.choices[0].delta.content):
                     continue
                 
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    observe_stage("llm_ttft", first_token_at - start, model=self.model)
+                tokens += 1
+                response_text += chunk.choices[0].delta.content
                 await websocket.send_json({
                     "action": "append_system_response",
                     "content": chunk.choices[0].delta.content
                 })
+            
+            # Duración del streaming desde el primer token y tokens generados
+            if first_token_at is not None:
+                observe_stage("llm_stream", time.perf_counter() - first_token_at, tokens=tokens)
+            LLM_TOKENS_TOTAL.inc(tokens)
                 
         except Exception as e:
             logger.error(f"Error generando respuesta: {str(e)}")
             await websocket.send_json({
                 "action": "append_system_response",
                 "content": f"Error: {str(e)}"
-            })
\ No newline at end of file
+            })
+            # Una respuesta interrumpida no entra en el historial de la sesión
+            return ""
+        
+        return response_text
\ No newline at end of file
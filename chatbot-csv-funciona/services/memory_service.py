@@ -0,0 +1,201 @@
+import logging
+import os
+import threading
+import time
+import weakref
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+import psutil
+
+from config import settings
+from utils.metrics import COLLECTION_VECTORS, PROCESS_RSS
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Memoria residente por documento indexado en Chroma en memoria (vector float32 de 384
+# dimensiones, enlaces HNSW, texto, metadatos y sus índices en SQLite); medido con chromadb 0.5
+INDEX_BYTES_PER_DOC = 6144
+DEFAULT_EMBEDDING_DIMENSIONS = 384
+DEFAULT_HNSW_M = 16
+
+
+class MemoryBudgetExceeded(Exception):
+    """La operación superaría el presupuesto de memoria configurado"""
+
+
+class MemoryService:
+    """Contabilidad de memoria del proceso, DataFrames y colecciones, y presupuestos de ingesta"""
+
+    def __init__(self, budget_mb: int = None, chunk_rows: int = None, memory_factor: float = None):
+        budget_mb = settings["memory_budget_mb"] if budget_mb is None else budget_mb
+        self.budget_bytes = budget_mb * MB if budget_mb > 0 else self._default_budget()
+        self.chunk_rows = chunk_rows or settings["ingest_chunk_rows"]
+        self.memory_factor = memory_factor or settings["ingest_memory_factor"]
+        self._frames: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _container_limit() -> Optional[int]:
+        """Límite de memoria del cgroup (Docker), si existe"""
+        for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+            try:
+                with open(path, "r") as f:
+                    value = f.read().strip()
+                if value.isdigit() and int(value) < psutil.virtual_memory().total:
+                    return int(value)
+            except OSError:
+                continue
+        return None
+
+    def _default_budget(self) -> int:
+        limit = self._container_limit() or psutil.virtual_memory().total
+        # Con varios workers cada uno recibe su parte del límite
+        return int(limit * 0.8) // max(settings["workers"], 1)
+
+    @staticmethod
+    def rss_bytes() -> int:
+        rss = psutil.Process().memory_info().rss
+        PROCESS_RSS.set(rss)
+        return rss
+
+    def track_dataframe(self, name: str, df: "pd.DataFrame"):
+        """Registra un DataFrame para la contabilidad; se marca como liberado al recolectarse"""
+        info = {
+            "name": name,
+            "rows": len(df),
+            "columns": len(df.columns),
+            "bytes": int(df.memory_usage(deep=True).sum()),
+            "tracked_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "alive": True
+        }
+        with self._lock:
+            self._frames[name] = info
+        weakref.finalize(df, self._release, name, info)
+
+    def _release(self, name: str, info: Dict[str, Any]):
+        with self._lock:
+            if self._frames.get(name) is info:
+                info["alive"] = False
+
+    def dataframes(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(info) for info in self._frames.values()]
+
+    @staticmethod
+    def collection_stats(chroma_client=None) -> List[Dict[str, Any]]:
+        """Número de vectores y bytes estimados por colección de Chroma"""
+        from rag.vector_store import get_client, index_bytes_per_document, is_quantized
+        if chroma_client is None:
+            chroma_client = get_client()
+
+        stats = []
+        for collection in chroma_client.list_collections():
+            count = collection.count()
+            dimensions = DEFAULT_EMBEDDING_DIMENSIONS
+            if count:
+                sample = collection.peek(limit=1).get("embeddings")
+                if sample is not None and len(sample):
+                    dimensions = len(sample[0])
+            hnsw_m = (collection.metadata or {}).get("hnsw:M", DEFAULT_HNSW_M)
+            if is_quantized():
+                # Solo los códigos int8 están en memoria; los vectores float32 se leen del disco
+                vector_bytes = count * dimensions
+                index_bytes = 0
+            else:
+                vector_bytes = count * dimensions * 4
+                # Cada nodo HNSW guarda ~2*M enlaces de 4 bytes en la capa base
+                index_bytes = count * hnsw_m * 2 * 4
+            COLLECTION_VECTORS.set(count, collection=collection.name)
+            stats.append({
+                "name": collection.name,
+                "vectors": count,
+                "dimensions": dimensions,
+                "vector_bytes": vector_bytes,
+                "index_bytes_estimate": index_bytes,
+                "resident_mb_estimate": round(count * index_bytes_per_document() / MB, 2)
+            })
+        return stats
+
+    def report(self, chroma_client=None) -> Dict[str, Any]:
+        """Informe completo para el endpoint de administración"""
+        rss = self.rss_bytes()
+        try:
+            collections = self.collection_stats(chroma_client)
+        except Exception as e:
+            logger.error(f"Error leyendo colecciones de Chroma: {str(e)}")
+            collections = []
+        return {
+            "rss_mb": round(rss / MB, 1),
+            "budget_mb": round(self.budget_bytes / MB, 1),
+            "budget_used": round(rss / self.budget_bytes, 3),
+            "system_available_mb": round(psutil.virtual_memory().available / MB, 1),
+            "dataframes": self.dataframes(),
+            "collections": collections,
+            "ingest_chunk_rows": self.chunk_rows
+        }
+
+    @staticmethod
+    def _estimate_rows(path: str, file_bytes: int) -> int:
+        """Filas estimadas a partir de una muestra de 1 MB"""
+        with open(path, "rb") as f:
+            sample = f.read(MB)
+        lines = max(sample.count(b"\n"), 1)
+        return max(int(file_bytes / (len(sample) / lines)), 1)
+
+    def plan_ingestion(self, path: str) -> Dict[str, Any]:
+        """Decide si un archivo se ingiere completo, por bloques o se rechaza.
+
+        Lanza MemoryBudgetExceeded si ni siquiera por bloques cabe en el presupuesto."""
+        file_bytes = os.path.getsize(path)
+        extension = path.rsplit(".", 1)[-1].lower()
+        rows = self._estimate_rows(path, file_bytes) if extension == "csv" else None
+        rss = self.rss_bytes()
+        available = self.budget_bytes - rss
+
+        # Lo que queda residente en el almacén de vectores tras la ingesta, sea cual sea el modo
+        from rag.vector_store import index_bytes_per_document
+        index_bytes = (rows or 0) * index_bytes_per_document()
+        full_bytes = int(file_bytes * self.memory_factor) + index_bytes
+        plan = {
+            "path": path,
+            "file_mb": round(file_bytes / MB, 2),
+            "estimated_rows": rows,
+            "rss_mb": round(rss / MB, 1),
+            "budget_mb": round(self.budget_bytes / MB, 1),
+            "estimated_mb": round(full_bytes / MB, 1)
+        }
+
+        if full_bytes <= available:
+            plan["mode"] = "full"
+            return plan
+
+        # Solo los CSV se pueden leer por bloques
+        if rows is not None:
+            chunk_bytes = int(file_bytes * min(1.0, self.chunk_rows / rows) * self.memory_factor) + index_bytes
+            if chunk_bytes <= available:
+                plan.update({"mode": "chunked", "chunk_rows": self.chunk_rows, "estimated_mb": round(chunk_bytes / MB, 1)})
+                logger.warning(f"Ingesta por bloques de {self.chunk_rows} filas: {plan}")
+                return plan
+
+        raise MemoryBudgetExceeded(
+            f"El archivo ({plan['file_mb']} MB) necesitaría ~{plan['estimated_mb']} MB y solo quedan "
+            f"{round(available / MB, 1)} MB del presupuesto de {plan['budget_mb']} MB"
+        )
+
+    def ensure_within_budget(self, stage: str):
+        """Aborta una operación en curso si el proceso ya supera el presupuesto"""
+        rss = self.rss_bytes()
+        if rss > self.budget_bytes:
+            raise MemoryBudgetExceeded(
+                f"Memoria del proceso ({round(rss / MB, 1)} MB) por encima del presupuesto "
+                f"({round(self.budget_bytes / MB, 1)} MB) durante {stage}"
+            )
+
+
+# Instancia compartida: la contabilidad de DataFrames es global al proceso
+memory_service = MemoryService()
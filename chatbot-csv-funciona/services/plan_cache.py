@@ -0,0 +1,57 @@
+import logging
+from collections import OrderedDict
+from typing import Optional
+from config import settings
+from utils.helpers import normalize_text
+
+logger = logging.getLogger(__name__)
+
+
+class PlanCache:
+    """Caché LRU que asocia preguntas normalizadas con SQL ya validado"""
+
+    def __init__(self, max_entries: Optional[int] = None):
+        self.max_entries = max_entries or settings["plan_cache_size"]
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._schema_fingerprint = ""
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        return normalize_text(question)
+
+    def _check_schema(self, schema_fingerprint: str):
+        """Vacía la caché si el esquema de las tablas ha cambiado"""
+        if schema_fingerprint != self._schema_fingerprint:
+            if self._entries:
+                logger.info(f"Esquema modificado: se invalidan {len(self._entries)} planes SQL")
+            self._entries.clear()
+            self._schema_fingerprint = schema_fingerprint
+
+    def get(self, question: str, schema_fingerprint: str) -> Optional[str]:
+        """Devuelve el SQL validado para la pregunta o None si no está en caché"""
+        self._check_schema(schema_fingerprint)
+        key = self.normalize(question)
+        sql = self._entries.get(key)
+        if sql is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return sql
+
+    def put(self, question: str, sql: str, schema_fingerprint: str):
+        """Guarda un SQL que se ha ejecutado correctamente sobre el esquema indicado"""
+        self._check_schema(schema_fingerprint)
+        key = self.normalize(question)
+        self._entries[key] = sql
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
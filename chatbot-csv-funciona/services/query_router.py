@@ -0,0 +1,220 @@
+import json
+import logging
+import math
+import os
+import re
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+from config import settings
+from utils.helpers import normalize_text
+
+logger = logging.getLogger(__name__)
+
+ROUTE_SQL = "sql"
+ROUTE_AGGREGATION = "aggregation"
+ROUTE_RAG = "rag"
+ROUTES = (ROUTE_SQL, ROUTE_AGGREGATION, ROUTE_RAG)
+
+# Medidas que puede calificar un superlativo ("mayor importe", "menor facturación")
+MEASURE_NOUNS = r"(importe\w*|facturacion|total\w*|venta\w*|ingreso\w*)"
+
+# Métricas reconocidas (expresión sobre el texto normalizado -> métrica). "mayor" y "menor" solo
+# son métricas delante de una medida: "importe mayor que cien" es un filtro
+METRIC_KEYWORDS = {
+    "total": "sum", "suma": "sum", "importe total": "sum", "facturacion": "sum",
+    "promedio": "avg", "media": "avg", "medio": "avg",
+    "maximo": "max", f"mayor {MEASURE_NOUNS}": "max",
+    "minimo": "min", f"menor {MEASURE_NOUNS}": "min",
+    "cuantas": "count", "cuantos": "count", "numero de": "count", "cantidad de": "count"
+}
+
+# Qué se cuenta: "cuántos clientes" son clientes distintos, no facturas por cliente
+COUNT_OBJECT = re.compile(r"\b(?:cuant[oa]s|numero de|cantidad de) (?:(?:distint|diferent)\w* )?(\w+)")
+COUNTED_ROWS = re.compile(r"^(factur|venta|registro|fila|cobro|ingreso)")
+COUNTED_ENTITIES = {"clientes": "cliente", "paises": "pais", "meses": "mes"}
+
+# Comparaciones y cantidades escritas con letras: son filtros aunque no haya cifras
+COMPARISONS = re.compile(
+    r"\b(mayor|menor|superior|inferior|mas|menos) (que|de|a)\b|\bpor (encima|debajo) de\b"
+    r"|\b(al menos|como minimo|como maximo|hasta)\b|\bentre \w+ y\b"
+)
+NUMBER_WORDS = re.compile(
+    r"\b(cero|uno|dos|tres|cuatro|cinco|seis|siete|ocho|nueve|diez|once|doce|trece|catorce|quince"
+    r"|dieci\w+|veinte|veinti\w+|treinta|cuarenta|cincuenta|sesenta|setenta|ochenta|noventa"
+    r"|cien|ciento|\w+cientos|quinientos|mil|millon\w*)\b"
+)
+
+# Sustantivos de los datos (facturas, importes, clientes, países): sin ellos una palabra de métrica
+# ("cuántos empleados", "la media aritmética") no es una pregunta sobre el dataset
+DATA_NOUNS = re.compile(r"\b(factur\w*|importe\w*|venta\w*|client\w*|pais\w*|ingreso\w*|cobr\w*)\b")
+
+# Dimensiones de agrupación por defecto (dataset de facturas)
+DEFAULT_DIMENSIONS = {
+    "cliente": ("por cliente", "cada cliente", "clientes", "que cliente", "cliente con"),
+    "pais": ("por pais", "cada pais", "paises", "que pais", "pais con"),
+    "mes": ("por mes", "cada mes", "meses", "mensual", "que mes", "mes con")
+}
+
+MONTHS = ("enero", "febrero", "marzo", "abril", "mayo", "junio", "julio", "agosto",
+          "septiembre", "octubre", "noviembre", "diciembre")
+
+# Ejemplos semilla; se amplían con las preguntas registradas en producción
+SEED_EXAMPLES: List[Tuple[str, str]] = [
+    ("cual es el importe total de las facturas", ROUTE_AGGREGATION),
+    ("total facturado por cliente", ROUTE_AGGREGATION),
+    ("importe promedio por pais", ROUTE_AGGREGATION),
+    ("cuantas facturas hay por mes", ROUTE_AGGREGATION),
+    ("cuantos clientes hay", ROUTE_AGGREGATION),
+    ("que cliente tiene mayor importe total", ROUTE_AGGREGATION),
+    ("cual fue el mes con mayor facturacion", ROUTE_AGGREGATION),
+    ("facturas del cliente 2 en enero de 2024", ROUTE_SQL),
+    ("importe de las facturas de uk en febrero", ROUTE_SQL),
+    ("cuantas facturas emitio el cliente 1 en 2024", ROUTE_SQL),
+    ("lista las facturas de espana con importe mayor a 10", ROUTE_SQL),
+    ("facturas con importe mayor que cien", ROUTE_SQL),
+    ("facturas entre el 2024 01 01 y el 2024 02 15", ROUTE_SQL),
+    ("que dias facturo el cliente 3", ROUTE_SQL),
+    ("hola que tal", ROUTE_RAG),
+    ("que servicios ofrece lostsys", ROUTE_RAG),
+    ("necesito formacion en devops", ROUTE_RAG),
+    ("podeis desarrollar una tienda online", ROUTE_RAG),
+    ("explicame la tendencia de ventas", ROUTE_RAG),
+    ("gracias por la ayuda", ROUTE_RAG),
+]
+
+
+class QueryRouter:
+    """Enrutador local (reglas + Naive Bayes de palabras) que elige la ruta SQL, agregación o RAG sin llamar al LLM"""
+
+    def __init__(self, log_path: Optional[str] = None, dimensions: Optional[Dict[str, tuple]] = None):
+        self.log_path = log_path if log_path is not None else settings["router_log_path"]
+        self.dimensions = dimensions or DEFAULT_DIMENSIONS
+        self._route_counts: Counter = Counter()
+        self._token_counts: Dict[str, Counter] = {route: Counter() for route in ROUTES}
+        self._token_totals: Counter = Counter()
+        self._vocabulary: set = set()
+        self.train(SEED_EXAMPLES + self._load_logged_examples())
+
+    @staticmethod
+    def _tokenize(text: str) -> List[str]:
+        """Unigramas y bigramas del texto normalizado"""
+        words = text.split()
+        return words + [f"{a}_{b}" for a, b in zip(words, words[1:])]
+
+    def _load_logged_examples(self) -> List[Tuple[str, str]]:
+        """Lee las preguntas etiquetadas registradas por log_decision"""
+        examples = []
+        if not self.log_path or not os.path.exists(self.log_path):
+            return examples
+        try:
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    # Solo resultados confirmados: las suposiciones del propio enrutador no lo reentrenan
+                    if record.get("confirmed") and record.get("route") in ROUTES and record.get("question"):
+                        examples.append((record["question"], record["route"]))
+        except Exception as e:
+            logger.error(f"Error cargando preguntas registradas: {str(e)}")
+        return examples
+
+    def train(self, examples: List[Tuple[str, str]]):
+        """Añade ejemplos etiquetados al clasificador"""
+        for question, route in examples:
+            tokens = self._tokenize(normalize_text(question))
+            self._route_counts[route] += 1
+            self._token_counts[route].update(tokens)
+            self._token_totals[route] += len(tokens)
+            self._vocabulary.update(tokens)
+        logger.info(f"Enrutador entrenado con {sum(self._route_counts.values())} preguntas")
+
+    def _classify(self, tokens: List[str]) -> Tuple[str, float]:
+        """Naive Bayes multinomial con suavizado de Laplace; devuelve la ruta y su probabilidad"""
+        total = sum(self._route_counts.values())
+        vocabulary_size = len(self._vocabulary) + 1
+        scores = {}
+        for route in ROUTES:
+            score = math.log((self._route_counts[route] + 1) / (total + len(ROUTES)))
+            denominator = self._token_totals[route] + vocabulary_size
+            counts = self._token_counts[route]
+            for token in tokens:
+                score += math.log((counts[token] + 1) / denominator)
+            scores[route] = score
+
+        best = max(scores, key=scores.get)
+        norm = sum(math.exp(value - scores[best]) for value in scores.values())
+        return best, 1.0 / norm
+
+    def _detect_metric(self, text: str) -> Optional[str]:
+        for keyword, metric in METRIC_KEYWORDS.items():
+            if re.search(rf"\b{keyword}\b", text):
+                return metric
+        return None
+
+    def _detect_group_by(self, text: str, exclude: Optional[str] = None) -> Optional[str]:
+        for dimension, keywords in self.dimensions.items():
+            if dimension != exclude and any(keyword in text for keyword in keywords):
+                return dimension
+        return None
+
+    @staticmethod
+    def _counted(text: str) -> Tuple[bool, Optional[str]]:
+        """Qué cuenta la pregunta: (si se sabe, dimensión de valores distintos o None si son filas).
+        "cuántas facturas" cuenta filas, "cuántos clientes" clientes distintos; otra cosa no se sabe"""
+        match = COUNT_OBJECT.search(text)
+        if match is None:
+            return False, None
+        counted = match.group(1)
+        if counted in COUNTED_ENTITIES:
+            return True, COUNTED_ENTITIES[counted]
+        return bool(COUNTED_ROWS.match(counted)), None
+
+    @staticmethod
+    def _has_filters(question: str, text: str) -> bool:
+        """Detecta filtros concretos (números, fechas, meses, códigos de país) que requieren SQL a medida"""
+        if re.search(r"\d", text) or COMPARISONS.search(text) or NUMBER_WORDS.search(text):
+            return True
+        if any(re.search(rf"\b{month}\b", text) for month in MONTHS):
+            return True
+        # Los códigos de país se buscan en mayúsculas para no confundir "ES" con el verbo "es"
+        if re.search(r"\b(ES|UK)\b", question):
+            return True
+        return bool(re.search(r"\b(espana|reino unido)\b", text))
+
+    def route(self, question: str) -> Dict[str, Any]:
+        """Elige la ruta de la pregunta: reglas de alta precisión y, si no aplican, el clasificador"""
+        text = normalize_text(question)
+        metric = self._detect_metric(text)
+        # Un recuento de algo que no son filas ni una dimensión conocida no se precalcula
+        understood, distinct = self._counted(text) if metric == "count" else (True, None)
+        group_by = self._detect_group_by(text, exclude=distinct)
+        has_filters = self._has_filters(question, text)
+        about_data = bool(DATA_NOUNS.search(text))
+        decision = {"metric": metric, "group_by": group_by, "distinct": distinct}
+
+        # Regla: métrica sobre los datos sin filtros concretos -> agregación precalculable sin LLM
+        if metric and understood and about_data and not has_filters:
+            return {"route": ROUTE_AGGREGATION, **decision, "reason": "regla", "confidence": 1.0}
+
+        route, confidence = self._classify(self._tokenize(text))
+        if route == ROUTE_AGGREGATION and (has_filters or not metric or not understood or not about_data):
+            # Una agregación con filtros o que no se entiende del todo necesita SQL generado; sin
+            # sustantivos de los datos decide el LLM (responde "No" si no se puede contestar con la tabla)
+            route = ROUTE_SQL
+        return {"route": route, **decision, "reason": "clasificador", "confidence": confidence}
+
+    def log_decision(self, question: str, route: str):
+        """Registra la ruta que finalmente respondió la pregunta para reentrenar el enrutador.
+        Solo para resultados confirmados fuera del enrutador: SQL generado por el LLM que se ha
+        ejecutado, o el "No" del LLM que manda la pregunta a RAG. Las rutas que elige el propio
+        enrutador no se registran para que sus errores no se refuercen"""
+        if not self.log_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"question": question, "route": route, "confirmed": True}, ensure_ascii=False) + "\n")
+        except Exception as e:
+            logger.error(f"Error registrando la decisión del enrutador: {str(e)}")
@@ -0,0 +1,195 @@
+import logging
+import re
+import uuid
+from typing import Any, Dict, List, Optional
+from config import settings
+from rag.datasets import DEFAULT_TENANT, tenant_slug
+from utils.metrics import ACTIVE_SESSIONS
+
+logger = logging.getLogger(__name__)
+
+# Longitud máxima de la línea del resumen de cada mensaje compactado
+CONDENSE_MAX_CHARS = 300
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?;:])\s+|\n+")
+# Cifras con separadores, signo, moneda o porcentaje: 1.234,56 | -12 | $300 | 15%
+NUMBER_PATTERN = re.compile(r"[$€]?-?\d(?:[\d.,]*\d)?%?")
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimación rápida de tokens (~4 caracteres por token) sin cargar un tokenizador"""
+    if not text:
+        return 0
+    return max(1, len(text) // 4)
+
+
+class ConversationSession:
+    """Estado de una conversación: ventana acotada de turnos recientes y resumen de los antiguos"""
+
+    def __init__(self, session_id: str, max_tokens: int, summary_max_tokens: int,
+                 tenant: str = DEFAULT_TENANT, dataset_id: Optional[str] = None):
+        self.session_id = session_id
+        # Dataset de la sesión; None = el activo del inquilino
+        self.tenant = tenant_slug(tenant)
+        self.dataset_id = dataset_id
+        self.max_tokens = max_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.messages: List[Dict[str, str]] = []
+        self.summary_lines: List[str] = []
+        self._window_tokens = 0
+        self._summary_tokens = 0
+
+    def add_message(self, role: str, content: str):
+        """Añade un mensaje a la ventana y compacta los turnos antiguos si se supera el límite.
+        Los mensajes vacíos (una respuesta fallida del LLM) no entran en el historial"""
+        if not content or not content.strip():
+            return
+        self.messages.append({"role": role, "content": content})
+        self._window_tokens += estimate_tokens(content)
+        self._compact()
+
+    def _compact(self):
+        """Mueve los mensajes más antiguos al resumen hasta que la ventana cabe en el presupuesto"""
+        # Se conserva siempre el último mensaje aunque por sí solo supere el límite
+        while self._window_tokens > self.max_tokens and len(self.messages) > 1:
+            old_message = self.messages.pop(0)
+            self._window_tokens -= estimate_tokens(old_message["content"])
+            self._add_to_summary(old_message)
+
+    def _add_to_summary(self, message: Dict[str, str]):
+        """Condensa un mensaje en una línea del resumen acotado"""
+        speaker = "Usuario" if message["role"] == "user" else "Asistente"
+        line = f"- {speaker}: {self._condense(message['content'])}"
+        self.summary_lines.append(line)
+        self._summary_tokens += estimate_tokens(line)
+
+        # El resumen también está acotado: se descartan las líneas más antiguas
+        while self._summary_tokens > self.summary_max_tokens and len(self.summary_lines) > 1:
+            dropped = self.summary_lines.pop(0)
+            self._summary_tokens -= estimate_tokens(dropped)
+
+    @staticmethod
+    def _facts(sentence: str) -> List[str]:
+        """Cifras y entidades de una frase: números y palabras en mayúscula que no abren la frase
+        (clientes, locales, países...)"""
+        facts = NUMBER_PATTERN.findall(sentence)
+        for position, word in enumerate(sentence.split()):
+            word = word.strip(".,;:!?()[]\"'¿¡*")
+            if len(word) > 1 and not any(ch.isdigit() for ch in word) and (
+                    word.isupper() or (position > 0 and word[0].isupper())):
+                facts.append(word)
+        return facts
+
+    @staticmethod
+    def _condense(text: str, max_chars: int = CONDENSE_MAX_CHARS) -> str:
+        """Resumen extractivo de un mensaje: las frases con más cifras y entidades (y la primera),
+        en su orden original, y al final las cifras y entidades que no caben en ellas"""
+        sentences = [" ".join(s.split()) for s in SENTENCE_PATTERN.split(text) if s.strip()]
+        if not sentences:
+            return ""
+        facts = [ConversationSession._facts(sentence) for sentence in sentences]
+        # Puntuación: las cifras valen el doble que las entidades; la primera frase da el tema
+        scores = [2 * len(NUMBER_PATTERN.findall(s)) + len(f) + (2 if i == 0 else 0)
+                  for i, (s, f) in enumerate(zip(sentences, facts))]
+        chosen, length = set(), 0
+        for index in sorted(range(len(sentences)), key=lambda i: (-scores[i], i)):
+            if length + len(sentences[index]) + 1 <= max_chars:
+                chosen.add(index)
+                length += len(sentences[index]) + 1
+        condensed = " ".join(sentences[i] for i in sorted(chosen))
+        # Las cifras y entidades de las frases descartadas se conservan como lista
+        missing = []
+        for index, sentence_facts in enumerate(facts):
+            if index not in chosen:
+                missing.extend(f for f in sentence_facts if f not in condensed and f not in missing)
+        if missing:
+            extra = ""
+            for fact in missing:
+                candidate = f"{extra}, {fact}" if extra else fact
+                if len(condensed) + len(candidate) + 4 > max_chars:
+                    break
+                extra = candidate
+            if extra:
+                condensed = f"{condensed} [{extra}]" if condensed else f"[{extra}]"
+        if not condensed:
+            # Ni una frase ni una cifra caben: primera frase truncada
+            condensed = sentences[0][:max_chars - 3].rstrip() + "..."
+        return condensed
+
+    @property
+    def summary(self) -> str:
+        """Resumen acumulado de los turnos compactados"""
+        return "\n".join(self.summary_lines)
+
+    def get_messages(self) -> List[Dict[str, str]]:
+        """Devuelve el historial listo para el LLM: resumen (si existe) seguido de la ventana reciente"""
+        messages = []
+        if self.summary_lines:
+            messages.append({
+                "role": "system",
+                "content": f"Resumen de la conversación anterior:\n{self.summary}"
+            })
+        return messages + list(self.messages)
+
+    def render_history(self, include_last: bool = False) -> str:
+        """Representa el historial como texto para incrustarlo en un prompt"""
+        window = self.messages if include_last else self.messages[:-1]
+        lines = []
+        if self.summary_lines:
+            lines.append(f"Resumen:\n{self.summary}")
+        for message in window:
+            speaker = "Usuario" if message["role"] == "user" else "Asistente"
+            lines.append(f"{speaker}: {message['content']}")
+        return "\n".join(lines)
+
+
+class SessionService:
+    """Gestiona las sesiones de conversación en el servidor, una por websocket"""
+
+    def __init__(self, max_tokens: Optional[int] = None, summary_max_tokens: Optional[int] = None):
+        self.max_tokens = max_tokens or settings["session_max_tokens"]
+        self.summary_max_tokens = summary_max_tokens or settings["session_summary_max_tokens"]
+        self._sessions: Dict[str, ConversationSession] = {}
+
+    def create_session(self, tenant: str = DEFAULT_TENANT, dataset_id: Optional[str] = None) -> ConversationSession:
+        """Crea una sesión nueva con identificador único, opcionalmente ligada a un dataset"""
+        session_id = uuid.uuid4().hex
+        session = ConversationSession(session_id, self.max_tokens, self.summary_max_tokens,
+                                      tenant=tenant, dataset_id=dataset_id)
+        self._sessions[session_id] = session
+        ACTIVE_SESSIONS.set(len(self._sessions))
+        logger.info(f"Sesión {session_id} creada para {session.tenant} ({len(self._sessions)} activas)")
+        return session
+
+    def get_session(self, session_id: str) -> Optional[ConversationSession]:
+        return self._sessions.get(session_id)
+
+    def close_session(self, session_id: str):
+        """Libera el estado de una sesión al cerrarse su websocket"""
+        if self._sessions.pop(session_id, None) is not None:
+            ACTIVE_SESSIONS.set(len(self._sessions))
+            logger.info(f"Sesión {session_id} cerrada ({len(self._sessions)} activas)")
+
+    @property
+    def active_sessions(self) -> int:
+        return len(self._sessions)
+
+    @staticmethod
+    def extract_user_message(data: Any) -> str:
+        """Obtiene el texto del mensaje nuevo del cliente.
+
+        Acepta el formato actual ({"role": "user", "content": ...}) y el antiguo,
+        en el que el cliente enviaba la transcripción completa como lista.
+        """
+        if isinstance(data, list):
+            if not data:
+                raise ValueError("Mensaje vacío")
+            data = data[-1]
+        if isinstance(data, dict) and "content" in data:
+            return str(data["content"])
+        raise ValueError("Formato de mensaje no soportado")
+
+    @staticmethod
+    def bind_dataset(data: Any, session: ConversationSession):
+        """Liga la sesión al dataset indicado en el mensaje ({"dataset_id": ...}), si lo hay"""
+        if isinstance(data, dict) and data.get("dataset_id"):
+            session.dataset_id = str(data["dataset_id"])
@@ -11,8 +11,10 @@ function submitText() {
 
     lines.innerHTML += "<div class='line'>" + txt + "</div>";
 
-    linesData.push( { "role": "user", "content": txt } );
-    socket.send( JSON.stringify( linesData ) );
+    // El historial se mantiene en el servidor: solo se envía el mensaje nuevo
+    var message = { "role": "user", "content": txt };
+    linesData.push( message );
+    socket.send( JSON.stringify( message ) );
 }
 
 function opensocket( url ) {
@@ -1,5 +1,7 @@
 import os
+import re
 import logging
+import unicodedata
 from config import settings
 
 logger = logging.getLogger(__name__)
@@ -19,4 +21,11 @@ def format_file_size(size_bytes):
         if size_bytes < 1024.0:
             return f"{size_bytes:.2f} {unit}"
         size_bytes /= 1024.0
-    return f"{size_bytes:.2f} TB"
\ No newline at end of file
+    return f"{size_bytes:.2f} TB"
+
+def normalize_text(text: str) -> str:
+    """Normaliza un texto para compararlo: minúsculas, sin tildes, sin puntuación ni espacios repetidos"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
\ No newline at end of file
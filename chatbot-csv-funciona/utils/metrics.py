@@ -0,0 +1,237 @@
+import contextvars
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterable, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Identificador de la petición en curso, propagado a los logs
+request_id_var: contextvars.ContextVar = contextvars.ContextVar("request_id", default="-")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 600.0)
+
+
+def new_request_id() -> str:
+    """Genera un identificador de petición y lo asocia al contexto actual"""
+    request_id = uuid.uuid4().hex[:12]
+    request_id_var.set(request_id)
+    return request_id
+
+
+def get_request_id() -> str:
+    return request_id_var.get()
+
+
+class RequestIdFilter(logging.Filter):
+    """Añade el request_id del contexto a cada registro de log"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+def _format_labels(label_names: Tuple[str, ...], label_values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple[str, ...], Dict] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.setdefault(key, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["buckets"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, {"buckets": list(s["buckets"]), "sum": s["sum"], "count": s["count"]})
+                     for key, s in self._values.items()]
+        lines = []
+        for key, state in items:
+            for bound, count in zip(self.buckets, state["buckets"]):
+                labels = _format_labels(self.label_names, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.label_names, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {state['count']}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {state['sum']}")
+            lines.append(f"{self.name}_count{labels} {state['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """Registro de métricas del proceso con exportación en formato texto de Prometheus"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, label_names: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: Iterable[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names: Iterable[str] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_DURATION = REGISTRY.histogram(
+    "chatbot_stage_duration_seconds",
+    "Duración de cada etapa de una petición o ingesta",
+    ("stage",)
+)
+REQUESTS_TOTAL = REGISTRY.counter(
+    "chatbot_requests_total",
+    "Peticiones atendidas por tipo y resultado",
+    ("kind", "status")
+)
+LLM_TOKENS_TOTAL = REGISTRY.counter(
+    "chatbot_llm_output_tokens_total",
+    "Fragmentos de texto (aprox. tokens) recibidos del LLM en streaming"
+)
+INGESTED_DOCUMENTS_TOTAL = REGISTRY.counter(
+    "chatbot_ingested_documents_total",
+    "Documentos añadidos al índice vectorial"
+)
+DEDUP_ROWS_REMOVED_TOTAL = REGISTRY.counter(
+    "chatbot_dedup_rows_removed_total",
+    "Filas repetidas descartadas antes de crear documentos"
+)
+ACTIVE_SESSIONS = REGISTRY.gauge(
+    "chatbot_active_sessions",
+    "Sesiones websocket abiertas"
+)
+EVENT_LOOP_LAG = REGISTRY.histogram(
+    "chatbot_event_loop_lag_seconds",
+    "Retraso del event loop respecto al intervalo esperado del latido"
+)
+EVENT_LOOP_BLOCKED_TOTAL = REGISTRY.counter(
+    "chatbot_event_loop_blocked_total",
+    "Bloqueos del event loop por encima del umbral configurado"
+)
+PROFILES_SAVED_TOTAL = REGISTRY.counter(
+    "chatbot_profiles_saved_total",
+    "Perfiles guardados de peticiones lentas",
+    ("kind",)
+)
+PROCESS_RSS = REGISTRY.gauge(
+    "chatbot_process_rss_bytes",
+    "Memoria residente del proceso"
+)
+COLLECTION_VECTORS = REGISTRY.gauge(
+    "chatbot_collection_vectors",
+    "Vectores por colección de Chroma",
+    ("collection",)
+)
+EMBEDDING_CACHE_LOOKUPS_TOTAL = REGISTRY.counter(
+    "chatbot_embedding_cache_lookups_total",
+    "Búsquedas en la caché de embeddings por resultado (hit/miss)",
+    ("result",)
+)
+
+
+def observe_stage(stage: str, seconds: float, **attributes):
+    """Registra la duración de una etapa en el histograma y como log estructurado"""
+    STAGE_DURATION.observe(seconds, stage=stage)
+    record = {"span": stage, "request_id": request_id_var.get(), "duration_ms": round(seconds * 1000, 3), **attributes}
+    logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+@contextmanager
+def span(stage: str, **attributes):
+    """Mide una etapa; los atributos añadidos al diccionario devuelto se incluyen en el log"""
+    start = time.perf_counter()
+    attributes = dict(attributes)
+    try:
+        yield attributes
+    except Exception:
+        attributes["status"] = "error"
+        raise
+    finally:
+        attributes.setdefault("status", "ok")
+        observe_stage(stage, time.perf_counter() - start, **attributes)
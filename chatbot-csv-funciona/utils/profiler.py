@@ -0,0 +1,226 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from config import settings
+from utils.metrics import EVENT_LOOP_BLOCKED_TOTAL, EVENT_LOOP_LAG, PROFILES_SAVED_TOTAL, get_request_id
+
+logger = logging.getLogger(__name__)
+
+# Los request_id son hexadecimales; se valida antes de construir rutas de archivo
+REQUEST_ID_PATTERN = re.compile(r"^[0-9a-f]{6,32}$")
+
+
+class RequestProfiler:
+    """Perfilado opcional con cProfile; solo se conservan los perfiles de peticiones lentas"""
+
+    def __init__(self, enabled: bool = None, threshold_ms: float = None, directory: str = None, max_files: int = None):
+        self.enabled = settings["profiling_enabled"] if enabled is None else enabled
+        self.threshold_ms = settings["profile_threshold_ms"] if threshold_ms is None else threshold_ms
+        self.directory = directory or settings["profile_dir"]
+        self.max_files = max_files or settings["profile_max_files"]
+        # cProfile perfila el hilo completo: una sola petición perfilada a la vez
+        self._lock = threading.Lock()
+        self._index: Dict[str, Dict[str, Any]] = {}
+
+    def configure(self, enabled: Optional[bool] = None, threshold_ms: Optional[float] = None):
+        """Activa o desactiva el perfilado en caliente (endpoint de administración)"""
+        if enabled is not None:
+            self.enabled = enabled
+        if threshold_ms is not None:
+            self.threshold_ms = threshold_ms
+        logger.info(f"Perfilado {'activado' if self.enabled else 'desactivado'} (umbral {self.threshold_ms} ms)")
+
+    @contextmanager
+    def profile(self, kind: str, **attributes):
+        """Perfila el bloque si está activado; guarda el perfil si supera el umbral"""
+        if not self.enabled or not self._lock.acquire(blocking=False):
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Otro perfilador activo en el proceso
+            self._lock.release()
+            logger.warning(f"No se pudo iniciar el perfilado: {str(e)}")
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            duration_ms = (time.perf_counter() - start) * 1000
+            self._lock.release()
+            if duration_ms >= self.threshold_ms:
+                self._save(profiler, kind, duration_ms, attributes)
+
+    def _save(self, profiler: cProfile.Profile, kind: str, duration_ms: float, attributes: Dict[str, Any]):
+        request_id = get_request_id()
+        if not REQUEST_ID_PATTERN.match(request_id):
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{request_id}.prof")
+            profiler.dump_stats(path)
+            self._index[request_id] = {
+                "request_id": request_id,
+                "kind": kind,
+                "duration_ms": round(duration_ms, 1),
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                **attributes
+            }
+            PROFILES_SAVED_TOTAL.inc(kind=kind)
+            logger.warning(f"Petición lenta ({kind}, {duration_ms:.0f} ms): perfil guardado en {path}")
+            self._prune()
+        except Exception as e:
+            logger.error(f"Error guardando perfil: {str(e)}")
+
+    def _prune(self):
+        """Conserva solo los max_files perfiles más recientes"""
+        files = sorted(
+            (os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".prof")),
+            key=os.path.getmtime
+        )
+        for path in files[:-self.max_files]:
+            os.remove(path)
+            self._index.pop(os.path.basename(path)[:-len(".prof")], None)
+
+    def path_for(self, request_id: str) -> Optional[str]:
+        """Ruta del perfil de una petición, o None si no existe"""
+        if not REQUEST_ID_PATTERN.match(request_id):
+            return None
+        path = os.path.join(self.directory, f"{request_id}.prof")
+        return path if os.path.exists(path) else None
+
+    def list_profiles(self) -> List[Dict[str, Any]]:
+        """Perfiles disponibles, del más reciente al más antiguo"""
+        if not os.path.isdir(self.directory):
+            return []
+        profiles = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".prof"):
+                continue
+            request_id = name[:-len(".prof")]
+            path = os.path.join(self.directory, name)
+            info = dict(self._index.get(request_id, {"request_id": request_id}))
+            info["size_bytes"] = os.path.getsize(path)
+            info["mtime"] = os.path.getmtime(path)
+            profiles.append(info)
+        profiles.sort(key=lambda info: info["mtime"], reverse=True)
+        return profiles
+
+    def summary(self, request_id: str, limit: int = 30, sort: str = "cumulative") -> Optional[str]:
+        """Resumen en texto (pstats) de las funciones más costosas"""
+        path = self.path_for(request_id)
+        if path is None:
+            return None
+        stream = io.StringIO()
+        pstats.Stats(path, stream=stream).sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "threshold_ms": self.threshold_ms,
+            "directory": self.directory,
+            "max_files": self.max_files
+        }
+
+
+class EventLoopMonitor:
+    """Detecta llamadas bloqueantes en el event loop.
+
+    Una tarea del loop marca un latido periódico; un hilo vigilante comprueba el
+    latido y, si se retrasa más del umbral, captura la pila del hilo del loop
+    (la llamada que lo está bloqueando)."""
+
+    def __init__(self, threshold_ms: float = None, interval_ms: float = 50, max_incidents: int = 50):
+        self.threshold = (settings["loop_lag_threshold_ms"] if threshold_ms is None else threshold_ms) / 1000
+        self.interval = interval_ms / 1000
+        self._incidents: deque = deque(maxlen=max_incidents)
+        self._last_beat = time.monotonic()
+        self._open_incident: Optional[Dict[str, Any]] = None
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Arranca el monitor; debe llamarse desde el event loop (p. ej. en el arranque de la app)"""
+        if self.running:
+            return
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._task = loop.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="event-loop-watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"Monitor del event loop activo (umbral {self.threshold * 1000:.0f} ms)")
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic()
+            self._last_beat = expected
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - expected - self.interval)
+            EVENT_LOOP_LAG.observe(lag)
+            incident = self._open_incident
+            if incident is not None:
+                # Duración real del bloqueo, conocida cuando el loop vuelve a responder
+                incident["blocked_ms"] = round(lag * 1000, 1)
+                self._open_incident = None
+
+    def _watch(self):
+        reported_beat = None
+        while not self._stop.wait(min(self.interval, self.threshold / 2)):
+            beat = self._last_beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold or beat == reported_beat:
+                continue
+            reported_beat = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            incident = {
+                "detected_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "blocked_ms": round(blocked * 1000, 1),
+                "stack": stack
+            }
+            self._incidents.append(incident)
+            self._open_incident = incident
+            EVENT_LOOP_BLOCKED_TOTAL.inc()
+            logger.warning(f"Event loop bloqueado más de {blocked * 1000:.0f} ms en:\n{stack}")
+
+    def incidents(self) -> List[Dict[str, Any]]:
+        """Bloqueos detectados, del más reciente al más antiguo"""
+        return list(reversed(self._incidents))
+
+
+# Instancias compartidas por la aplicación y los endpoints de administración
+request_profiler = RequestProfiler()
+loop_monitor = EventLoopMonitor()